@@ -19,6 +19,19 @@
 # 5: OPTIONAL - km distance to process within each array (block_size)
 # 6: input flag if existing data can 
 #     be over written (overwrite_data) 1. True, 2. False
+# 7: OPTIONAL - overview pyramid level to sample (overview_level)
+#     0 = full resolution. Level n samples a minimum aggregated
+#     overview with cells 2^n times larger than z_raster. Z_NODE is
+#     always sampled from z_raster at full resolution.
+# 8: OPTIONAL - folder where the overviews are cached (overview_dir)
+# 9: OPTIONAL - raster reader backend. Default is "arcpy". Can also 
+#     read the rasters with 1. "arcpy", 2. "gdal", 3. "numpy" arrays 
+#     added with raster_io.register_array(), or 4. "memmap" for 
+#     uncompressed GeoTIFF, ENVI, or ESRI .flt rasters (raster_backend)
+# 10: OPTIONAL - path/name of a checkpoint file (checkpoint_file). The
+#     sampled elevations are saved to it after each block. If the run
+#     stops a rerun with the same inputs starts after the last saved
+#     block. The file is deleted when the run is complete.
 
 # OUTPUTS
 # 0. point feature class (edit nodes_fc) - Added fields 
@@ -35,15 +48,19 @@
 # Import system modules
 from __future__ import division, print_function
 import sys
+import os
 import gc
 import time
 import traceback
+import json
 from datetime import timedelta
+from hashlib import md5
 import arcpy
 import itertools
 from arcpy import env
-from math import ceil
+from math import ceil, floor
 from collections import defaultdict
+from raster_io import open_raster, raster_fingerprint
 
 # ----------------------------------------------------------------------
 # Start Fill in Data
@@ -54,6 +71,10 @@ z_raster = r"D:\Projects\TTools_9\JohnsonCreek.gdb\jc_be_m_mosaic"
 z_units = "Meters"
 block_size = 5 # OPTIONAL defualt to 5
 overwrite_data = True
+overview_level = 0 # OPTIONAL 0 = full resolution
+overview_dir = r"D:\Projects\TTools_9\overviews" # OPTIONAL
+raster_backend = "arcpy" # OPTIONAL "arcpy", "gdal", "numpy", or "memmap"
+checkpoint_file = r"D:\Projects\TTools_9\step3_checkpoint.json" # OPTIONAL
 # End Fill in Data
 # ----------------------------------------------------------------------
 
@@ -65,27 +86,34 @@ overwrite_data = True
 #z_units = parameters[4].valueAsText
 #block_size =  parameters[5].valueAsText
 #overwrite_data = parameters[6].valueAsText
+#overview_level = parameters[7].valueAsText # Needs to be a int
+#overview_dir = parameters[8].valueAsText
+#raster_backend = parameters[9].valueAsText
+#checkpoint_file = parameters[10].valueAsText
 
 def nested_dict(): 
     """Build a nested dictionary"""
     return defaultdict(nested_dict)
 
-def read_nodes_fc1(nodes_fc, overwrite_data, addFields):
-    """Reads the input point feature class and returns the
-    NODE_ID and X/Y coordinates as a nested dictionary"""
+def read_nodes_fc(nodes_fc, overwrite_data, addFields):
+    """Reads the input point feature class, adds new fields, and returns
+    the STREAM_ID, STREAM_KM, LENGTH, ELEVATION, Z_NODE, GRADIENT, and
+    X/Y coordinates as a nested dictionary with NODE_ID as the key.
+    The whole table is read once and shared by the elevation and
+    gradient calculations. Nodes that need elevation sampling are
+    flagged with SAMPLE_Z."""
     nodeDict = nested_dict()
-    incursorFields = ["NODE_ID", "SHAPE@X","SHAPE@Y"]
+    incursorFields = ["NODE_ID", "STREAM_ID", "STREAM_KM", "LENGTH",
+                      "SHAPE@X","SHAPE@Y"] + addFields
 
     # Get a list of existing fields
     existingFields = []
     for f in arcpy.ListFields(nodes_fc):
         existingFields.append(f.name)
 
-    # Check to see if the last field exists if yes add it. 
-    # Grabs last field becuase often the first field, emergent, is zero
-    if overwrite_data is False and (addFields[len(addFields)-1] in existingFields) is True:
-        incursorFields.append(addFields[len(addFields)-1])
-    else:
+    # If the Z_NODE field does not exist yet everything needs to be
+    # sampled. Uses Z_NODE becuase ELEVATION can legitimately be zero.
+    if ("Z_NODE" in existingFields) is False:
         overwrite_data = True
         
     # Check to see if all the new fields exist and add them if not
@@ -97,76 +125,27 @@ def read_nodes_fc1(nodes_fc, overwrite_data, addFields):
     proj = arcpy.Describe(nodes_fc).spatialReference
 
     with arcpy.da.SearchCursor(nodes_fc, incursorFields,"",proj) as Inrows:
-        if overwrite_data is True:
-            for row in Inrows:
-                nodeID =row[0]
-                nodeDict[nodeID]["POINT_X"] = row[1]
-                nodeDict[nodeID]["POINT_Y"] = row[2]
-        else:
-            for row in Inrows:
-                # Is the data null or zero, if yes grab it.
-                if row[3] is None or row[3] == 0 or row[3] < -9998:
-                    nodeID =row[0]
-                    nodeDict[nodeID]["POINT_X"] = row[1]
-                    nodeDict[nodeID]["POINT_Y"] = row[2]
+        for row in Inrows:
+            nodeID = row[0]
+            nodeDict[nodeID]["STREAM_ID"] = row[1]
+            nodeDict[nodeID]["STREAM_KM"] = row[2]
+            nodeDict[nodeID]["LENGTH"] = row[3]
+            nodeDict[nodeID]["POINT_X"] = row[4]
+            nodeDict[nodeID]["POINT_Y"] = row[5]
+            for f, field in enumerate(addFields):
+                nodeDict[nodeID][field] = row[f+6]
+            
+            # Is the data null or zero, if yes it is
+            # sampled and will be overwritten.
+            z_node = nodeDict[nodeID]["Z_NODE"]
+            if (overwrite_data is True or z_node is None or
+                z_node == 0 or z_node < -9998):
+                nodeDict[nodeID]["SAMPLE_Z"] = True
+            else:
+                nodeDict[nodeID]["SAMPLE_Z"] = False
               
     return nodeDict
 
-def read_nodes_fc2(nodes_fc, overwrite_data, addFields):
-    """Reads the input point file, adds new fields, and returns the
-    STREAM_ID, STREAM_KM, NODE_ID, LENGTH, ELEVATION, and X/Y coordinates
-    as a nested dictionary"""
-    
-    nodeDict = nested_dict()
-    incursorFields = ["STREAM_ID", "STREAM_KM", "NODE_ID", "LENGTH", "ELEVATION", "SHAPE@X","SHAPE@Y"]
-    
-    # Get a list of existing fields
-    existingFields = []
-    for f in arcpy.ListFields(nodes_fc):
-        existingFields.append(f.name)    
-
-    # Check to see if the 1st field exists if yes add it to 
-    # the cursorfields to be retreived.
-    if overwrite_data is False and (addFields[0] in existingFields) is True:
-        incursorFields.append(addFields[0])
-    else:
-        overwrite_data = True
-
-    # Check to see if all the new fields exist and add them if not
-    for f in addFields:
-        if (f in existingFields) is False:
-            arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED")    
-
-    # Determine input point spatial units
-    proj = arcpy.Describe(nodes_fc).spatialReference
-
-    with arcpy.da.SearchCursor(nodes_fc,incursorFields,"",proj) as Inrows:
-        if overwrite_data is True:
-            for row in Inrows:
-                streamID = row[0]
-                stream_km = row[1]
-                nodeDict[streamID][stream_km]["NODE_ID"] = row[2]
-                nodeDict[streamID][stream_km]["LENGTH"] = row[3]
-                nodeDict[streamID][stream_km]["ELEVATION"] = row[4]
-                nodeDict[streamID][stream_km]["POINT_X"] = row[5]
-                nodeDict[streamID][stream_km]["POINT_Y"] = row[6]
-        else:
-            for row in Inrows:
-                # if the data is null or zero (0 = default for shapefile),
-                # it is retreived and will be overwritten.
-                if row[7] is None or row[7] < -9998:
-                    streamID = row[0]
-                    stream_km = row[1]                    
-                    nodeDict[streamID][stream_km]["NODE_ID"] = row[2] 
-                    nodeDict[streamID][stream_km]["LENGTH"] = row[3]
-                    nodeDict[streamID][stream_km]["ELEVATION"] = row[4]
-                    nodeDict[streamID][stream_km]["POINT_X"] = row[5]
-                    nodeDict[streamID][stream_km]["POINT_Y"] = row[6]
-    if len(nodeDict) == 0:
-        sys.exit("The gradient field checked in the input point feature class "+
-                 "have existing data. There is nothing to process. Exiting")    
-    return nodeDict
-
 def calculate_gradient(zList, len_list, smooth_flag):
     
     skipupNodes = [0]
@@ -191,36 +170,50 @@ def calculate_gradient(zList, len_list, smooth_flag):
             
     return (gradientList)
 
-def update_nodes_fc1(nodeDict, nodes_fc, addFields, nodes_to_query):
+def update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_update):
     """Updates the input point feature class with data from
-    the nodes dictionary with node_id as the primary key"""
-    #print("Updating input point feature class")
+    the nodes dictionary with node_id as the primary key. All the
+    fields are written in one pass through the feature class."""
+    print("Updating input point feature class")
     
-    # Build a query to retreive just the nodes that needs updating
-    whereclause = """{0} IN ({1})""".format("NODE_ID", ','.join(str(i) for i in nodes_to_query))
+    nodes_to_update = set(nodes_to_update)
 
-    with arcpy.da.UpdateCursor(nodes_fc,["NODE_ID"] + addFields, whereclause) as cursor:
+    with arcpy.da.UpdateCursor(nodes_fc,["NODE_ID"] + addFields) as cursor:
         for row in cursor:
-            for f, field in enumerate(addFields):
-                nodeID =row[0]
-                row[f+1] = nodeDict[nodeID][field]
+            nodeID = row[0]
+            if nodeID in nodes_to_update:
+                for f, field in enumerate(addFields):
+                    row[f+1] = nodeDict[nodeID][field]
                 cursor.updateRow(row)
 
-def update_nodes_fc2(nodeDict, nodes_fc, addFields, nodes_to_query):
-    """Updates the input point feature class with data from
-    the nodes dictionary with stream IDs as the primary key"""
-    print("Updating input point feature class")
-
-    # Build a query to retreive just the nodes that needs updating
-    whereclause = """{0} IN ({1})""".format("NODE_ID", ','.join(str(i) for i in nodes_to_query))
-
-    with arcpy.da.UpdateCursor(nodes_fc,["STREAM_ID","NODE_ID","STREAM_KM"] + addFields, whereclause) as cursor:  
-        for row in cursor:
-            for f, field in enumerate(addFields):
-                streamID = row[0]
-                stream_km =row[2]
-                row[f+3] = nodeDict[streamID][stream_km][field]
-                cursor.updateRow(row)
+def write_checkpoint(checkpoint_file, config, nodeDict, nodes_done):
+    """Saves the ELEVATION and Z_NODE of the sampled nodes to a json
+    file. The file is written to a temporary file and then renamed so
+    a crash while writing keeps the previous checkpoint."""
+
+    checkpoint = {"config": config,
+                  "nodeIDs": nodes_done,
+                  "ELEVATION": [float(nodeDict[nodeID]["ELEVATION"]) for nodeID in nodes_done],
+                  "Z_NODE": [float(nodeDict[nodeID]["Z_NODE"]) for nodeID in nodes_done]}
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(checkpoint, f)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    os.rename(temp_file, checkpoint_file)
+
+def read_checkpoint(checkpoint_file, config):
+    """Returns the checkpoint dictionary or None if there is no
+    checkpoint file or it was made with different inputs"""
+
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if checkpoint["config"] != config:
+        print("The checkpoint file was made with different inputs. Starting over.")
+        return None
+    return checkpoint
 
 def create_block_list(nodeDict, nodes, buffer, block_size):
     """Returns two lists, one containting the coordinate extent
@@ -304,14 +297,15 @@ def sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m):
     block_x_max = block[2]
     block_y_max = block[3]
     
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))   
+    reader = open_raster(z_raster, raster_backend)
+    x_cellsize = float(reader.get_property("CELLSIZEX"))
+    y_cellsize = float(reader.get_property("CELLSIZEY"))   
 
     # Get the coordinates extent of the input raster
-    raster_x_min = float(arcpy.GetRasterProperties_management(z_raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(z_raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(z_raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(z_raster, "TOP").getOutput(0))
+    raster_x_min = float(reader.get_property("LEFT"))
+    raster_y_min = float(reader.get_property("BOTTOM"))
+    raster_x_max = float(reader.get_property("RIGHT"))
+    raster_y_max = float(reader.get_property("TOP"))
       
     # Calculate the X and Y offset from the upper left node 
     # coordinates bounding box    
@@ -338,15 +332,16 @@ def sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m):
     
     # Construct the array. Note returned array is (row, col) so (y, x)
     try:
-        raster_array = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                                ncols, nrows, nodata_to_value)
+        raster_array = reader.read_numpy(block_x_min_center, block_y_min_center,
+                                         ncols, nrows, nodata_to_value)
     except:
         tbinfo = traceback.format_exc()
         pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"       
         sys.exit(pymsg)    
     
-    # convert array values to meters if needed
-    if con_z_to_m is not None:
+    # convert array values to meters if needed. A factor of 1 is
+    # skipped so a memmap window is not copied.
+    if con_z_to_m is not None and con_z_to_m != 1:
         raster_array = raster_array * con_z_to_m
     
     z_list = []
@@ -382,6 +377,48 @@ def sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m):
         
     return z_list
 
+def sample_node_cells(nodes_in_block, z_raster, con_z_to_m):
+    """Returns a list of the full resolution raster value at each
+    node. Used for Z_NODE when the block is sampled from an overview
+    so Z_NODE is the elevation at the node and not the lowest
+    elevation of the overview cell. The cells are read in one window
+    around the nodes in the block."""
+    
+    if con_z_to_m is not None:
+        nodata_to_value = -9999 / con_z_to_m
+    else:
+        nodata_to_value = -9999
+    
+    reader = open_raster(z_raster, raster_backend)
+    x_min = float(reader.get_property("LEFT"))
+    y_max = float(reader.get_property("TOP"))
+    x_cellsize = float(reader.get_property("CELLSIZEX"))
+    y_cellsize = float(reader.get_property("CELLSIZEY"))
+    
+    # raster row/col of each node
+    cols = [int(floor((node[1] - x_min) / x_cellsize)) for node in nodes_in_block]
+    rows = [int(floor((y_max - node[2]) / y_cellsize)) for node in nodes_in_block]
+    
+    # one window around all the nodes in the block
+    row0 = min(rows)
+    col0 = min(cols)
+    try:
+        z_array = reader.read_window(row0, col0, max(rows) - row0 + 1,
+                                     max(cols) - col0 + 1, nodata_to_value)
+    except:
+        tbinfo = traceback.format_exc()
+        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"       
+        sys.exit(pymsg)
+    
+    z_node = []
+    for row, col in zip(rows, cols):
+        z = z_array[row - row0, col - col0]
+        if con_z_to_m is not None:
+            z = z * con_z_to_m
+        z_node.append(z)
+    
+    return z_node
+
 def from_z_units_to_meters_con(zUnits):
     """Returns the converstion factor to get from the input z
     units to meters"""
@@ -412,6 +449,43 @@ def from_meters_con(inFeature):
                  "linear units of feet or meters.")   
     return con_from_m
 
+def get_overview_raster(z_raster, overview_level, overview_dir):
+    """Returns the path to a minimum aggregated overview of the 
+    elevation raster with cells 2^overview_level times larger. Each
+    pyramid level is built from the level below it and cached as a 
+    tif in overview_dir so it can be reused on later runs. Cached 
+    overviews are rebuilt if the elevation raster has changed."""
+    
+    if not os.path.exists(overview_dir):
+        os.makedirs(overview_dir)
+    
+    # the path hash keeps rasters with the same name in different
+    # folders from using or deleting each other's overviews
+    base = os.path.splitext(os.path.basename(z_raster))[0]
+    path_hash = md5(os.path.normcase(os.path.abspath(z_raster)).encode("utf-8")).hexdigest()[:8]
+    fingerprint = raster_fingerprint(z_raster, raster_backend)[:12]
+    
+    arcpy.CheckOutExtension("Spatial")
+    
+    level_raster = z_raster
+    for level in range(1, overview_level + 1):
+        prefix = "{0}_{1}_min{2}_".format(base, path_hash, 2**level)
+        overview = os.path.join(overview_dir, prefix + fingerprint + ".tif")
+        
+        if not arcpy.Exists(overview):
+            # Remove overviews built from an older version of the raster
+            for name in os.listdir(overview_dir):
+                if name.startswith(prefix):
+                    arcpy.Delete_management(os.path.join(overview_dir, name))
+                    
+            print("Building overview level {0}".format(level))
+            agg = arcpy.sa.Aggregate(level_raster, 2, "MINIMUM", "EXPAND", "DATA")
+            agg.save(overview)
+            del agg
+        level_raster = overview
+    
+    return level_raster
+
 #enable garbage collection
 gc.enable()
 
@@ -461,8 +535,19 @@ try:
     else:
         block_size = int(con_from_m * block_size * 1000)
     
+    # Use a cached minimum aggregated overview for coarse runs. Each
+    # overview cell holds the lowest elevation of the cells it covers 
+    # so the search window shrinks by the same factor.
+    if overview_level in ["#", "", None]: overview_level = 0
+    overview_level = int(overview_level)
+    if overview_level > 0:
+        sample_raster_path = get_overview_raster(z_raster, overview_level, overview_dir)
+        searchCells = int(ceil(searchCells / 2**overview_level))
+    else:
+        sample_raster_path = z_raster
+    
     # Get the elevation raster cell size
-    cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
+    cellsize = float(open_raster(sample_raster_path, raster_backend).get_property("CELLSIZEX"))
     
     # calculate the buffer distance (in raster spatial units) to add to 
     # the base bounding box when extracting to an array. The buffer is 
@@ -479,16 +564,34 @@ try:
     cell_moves = [i for i in range(searchCells*-1, searchCells+1, 1)]
     cellcoords = list(itertools.product(cell_moves, cell_moves))
     
-    # read the data into a nested dictionary
-    addFields = ["ELEVATION", "Z_NODE"]
-    nodeDict = read_nodes_fc1(nodes_fc, overwrite_data, addFields)
-    if len(nodeDict) != 0:
-        
-        # Get a list of the nodes, sort them
-        nodes = nodeDict.keys()
-        nodes.sort()
-        n_nodes = len(nodes)
-        
+    # read the data into a nested dictionary. The node table is 
+    # read once and shared by the elevation and gradient steps.
+    addFields = ["ELEVATION", "Z_NODE", "GRADIENT"]
+    nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
+    n_nodes = len(nodeDict)
+    
+    # Get a list of the nodes that need elevations, sort them
+    nodes = [nodeID for nodeID in nodeDict if nodeDict[nodeID]["SAMPLE_Z"]]
+    nodes.sort()
+    
+    # Restore the elevations sampled before a run stopped
+    use_checkpoint = checkpoint_file not in ["#", "", None]
+    nodes_done = []
+    if use_checkpoint:
+        config = [nodes_fc, z_raster, searchCells, overview_level,
+                  con_z_to_m, nodes]
+        checkpoint = read_checkpoint(checkpoint_file, config)
+        if checkpoint is not None:
+            nodes_done = checkpoint["nodeIDs"]
+            for i, nodeID in enumerate(nodes_done):
+                nodeDict[nodeID]["ELEVATION"] = checkpoint["ELEVATION"][i]
+                nodeDict[nodeID]["Z_NODE"] = checkpoint["Z_NODE"][i]
+            print("Resuming from the checkpoint. {0} of {1} nodes ".format(len(nodes_done), len(nodes)) +
+                  "were already sampled")
+            nodes = sorted(set(nodes).difference(nodes_done))
+            del checkpoint
+    
+    if nodes:
         # Build the block list
         block_extents, block_nodes = create_block_list(nodeDict, nodes, buffer, block_size)
         
@@ -502,17 +605,24 @@ try:
             
             print("Processing block {0} of {1}".format(p + 1, len(block_extents)))
         
-            z_list = sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m)
+            z_list = sample_raster(block, nodes_in_block, sample_raster_path, cellcoords, con_z_to_m)
+            
+            if sample_raster_path != z_raster:
+                # Z_NODE is always sampled at full resolution
+                z_node = sample_node_cells(z_list, z_raster, con_z_to_m)
+                for i, row in enumerate(z_list):
+                    row[4] = z_node[i]
             
-            # Update the node fc
+            # Update the node dict
             for row in z_list:
                 nodeDict[row[0]]["ELEVATION"] = row[3]
                 nodeDict[row[0]]["Z_NODE"] = row[4]
-                
-            nodes_to_query = [row[0] for row in z_list]
             
-            # Write the elevation data to the TTools point feature class 
-            update_nodes_fc1(nodeDict, nodes_fc, addFields, nodes_to_query)
+            # Save the block elevations so they are kept if the
+            # run stops before everything is written
+            if use_checkpoint:
+                nodes_done.extend(row[0] for row in z_list)
+                write_checkpoint(checkpoint_file, config, nodeDict, nodes_done)
         
             total_samples = total_samples + len(z_list)
             del z_list
@@ -521,32 +631,52 @@ try:
     else:
         print("The elevation field checked in the input point feature class " +
               "have existing data. Andvancing to gradient processing")
-    del(nodeDict)
     
     # Start on gradients
     
-    # read the data into a nested dictionary
-    addFields = ["GRADIENT"]
-    nodeDict = read_nodes_fc2(nodes_fc, overwrite_data, addFields)    
-    nodes_to_query = []
-
-    for n, streamID in enumerate(nodeDict):
-        print("Calculating gradients stream {0} of {1}".format(n + 1, len(nodeDict)))
+    # Group the nodes by stream. A stream gets new gradients if any 
+    # of its elevations were just sampled or it has missing gradients.
+    streamDict = nested_dict()
+    streams_to_update = set()
+    for nodeID in nodeDict:
+        streamID = nodeDict[nodeID]["STREAM_ID"]
+        stream_km = nodeDict[nodeID]["STREAM_KM"]
+        streamDict[streamID][stream_km] = nodeID
+        
+        gradient = nodeDict[nodeID]["GRADIENT"]
+        if (nodeDict[nodeID]["SAMPLE_Z"] or gradient is None or
+            gradient < -9998):
+            streams_to_update.add(streamID)
+    
+    if len(streams_to_update) == 0:
+        sys.exit("The gradient field checked in the input point feature class "+
+                 "have existing data. There is nothing to process. Exiting")
+    
+    nodes_to_update = []
+    for n, streamID in enumerate(streams_to_update):
+        print("Calculating gradients stream {0} of {1}".format(n + 1, len(streams_to_update)))
             
-        stream_kms = nodeDict[streamID].keys()
-        stream_kms.sort(reverse=True)        
+        stream_kms = streamDict[streamID].keys()
+        stream_kms.sort(reverse=True)
+        stream_nodes = [streamDict[streamID][km] for km in stream_kms]
     
-        z_list = [nodeDict[streamID][km]["ELEVATION"] for km in stream_kms]
-        len_list = [nodeDict[streamID][km]["LENGTH"] for km in stream_kms]
+        z_list = [nodeDict[nodeID]["ELEVATION"] for nodeID in stream_nodes]
+        len_list = [nodeDict[nodeID]["LENGTH"] for nodeID in stream_nodes]
         
         # Calculate Gradient
         gradientList = calculate_gradient(z_list, len_list, smooth_flag)
         
-        for i, km in enumerate(stream_kms):
-            nodeDict[streamID][km]["GRADIENT"] = gradientList[i]
-            nodes_to_query.append(nodeDict[streamID][km]["NODE_ID"])
-
-    update_nodes_fc2(nodeDict, nodes_fc, addFields, nodes_to_query)
+        for i, nodeID in enumerate(stream_nodes):
+            nodeDict[nodeID]["GRADIENT"] = gradientList[i]
+            nodes_to_update.append(nodeID)
+    
+    # Write the elevation and gradient data to the 
+    # TTools point feature class in a single pass
+    update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_update)
+    
+    # The run is complete so the checkpoint is not needed
+    if use_checkpoint and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
     
     endTime = time.time()
     gc.collect()  
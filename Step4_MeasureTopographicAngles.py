@@ -10,7 +10,10 @@
 # INPUTS
 # 0: Input TTools point feature class(nodes_fc)
 # 1: input the directions to 
-#    sample (topo_directions) 1. [W,S,E], 2. [NE,E,SE,S,SW,W,NW,N]
+#    sample (topo_directions) 1. [W,S,E], 2. [NE,E,SE,S,SW,W,NW,N],
+#    a number of evenly spaced directions greater than 2 (e.g. 16 or 36),
+#    or a list of azimuths. The sky view factor (TOPO_SVF) is also 
+#    calculated for a number greater than 2 or a list.
 # 2: input the maximum km distance to search (searchDistance_max_km)
 # 3: input elevation raster (z_raster)
 # 4: input elevation raster z units (z_units) 
@@ -18,17 +21,66 @@
 # 5: output sample point file name/path (topo_fc)
 # 6: input flag if existing data can be over
 #     written (overwrite_data) True or False
+# 7: OPTIONAL - topo angle engine (topo_engine) 1. "rays" samples
+#     each topo line, 2. "sweep" calculates the topo angle for every
+#     raster cell in the block with a convex hull sweep and samples
+#     the nodes from the result. Faster when nodes are dense. Needs
+#     square raster cells. Directions that do not follow the raster
+#     grid (not multiples of 45 degrees, and N coded as 365) are 
+#     sampled the same way as "rays". 3. "stream" samples each 
+#     topo line over its full length with the elevations read from 
+#     a fixed size tile cache. Nodes are finished as they are 
+#     processed so memory use stays constant on large projects.
+#     Set benchmark_engines = True to check the three engines give 
+#     the same results on a projection in feet.
+# 8: OPTIONAL - maximum topo angle error in degrees for skippy 
+#     stepping (skippy_max_error). The step along the topo line grows 
+#     with distance from the node. The error bound holds for terrain 
+#     slopes up to 200%. 0 samples every cell. "rays" engine only. 
+#     Set benchmark_skippy = True to check the error bound and print 
+#     the speed on synthetic terrain.
+# 9: OPTIONAL - number of processes to use (processes). Each block's
+#     elevation array is put in shared memory and the topo lines are 
+#     split across the processes. "#" uses all cores. Default is 1. 
+#     "rays" engine only.
+# 10: OPTIONAL - path to a checkpoint file (checkpoint_file). The 
+#     last completed block and the topo angle maximums of unfinished 
+#     nodes are saved to a numpy .npz file every checkpoint_interval 
+#     blocks. "#" for none.
+# 11: OPTIONAL - number of blocks between checkpoints 
+#     (checkpoint_interval). Default is 10.
+# 12: OPTIONAL - flag to restart from the checkpoint file (resume) 
+#     True or False. The inputs must be the same as the run that
+#     made the checkpoint.
+# 13: OPTIONAL - memory in megabytes for the "stream" engine tile 
+#     cache (tile_cache_mb). Default is 1024.
+# 14: OPTIONAL - folder for the horizon cache (horizon_cache_dir). 
+#     The topo angle results are saved for the raster cell of each 
+#     node by elevation raster path, z units, azimuth, and search 
+#     distance. Later runs read nodes in cached cells from the cache
+#     and only calculate the rest. The topo lines start at the raster cell 
+#     center of the node. "#" for no cache.
+# 15: OPTIONAL - raster reader backend. Default is "arcpy". Can also 
+#     read the rasters with 1. "arcpy", 2. "gdal", 3. "numpy" arrays 
+#     added with raster_io.register_array(), or 4. "memmap" for 
+#     uncompressed GeoTIFF, ENVI, or ESRI .flt rasters (raster_backend)
+# 16: OPTIONAL - flag to skip elevation samples that can not be the 
+#     maximum topo angle (use_max_pyramid) True or False. A pyramid 
+#     of the highest elevation in squares of 16 cells and larger is 
+#     built with one pass over the raster (saved in horizon_cache_dir 
+#     if set). Samples in squares too low to beat a sample already 
+#     read on the topo line are not read. The results are the same.
+#     "stream" engine only. Set benchmark_pyramid = True to print the
+#     samples and tiles read on synthetic terrain.
 
 # OUTPUTS
 # 0. point feature class (edit nodes_fc) - Added fields with topographic 
-#     shade angles for each direction at each node
+#     shade angles for each direction at each node and the sky view factor
 # 1. point feature class (new) - point for each x/y location 
 #     of the maximum elevation.
 
 # Future Updates
 # find the bug that generates off array samples (see s. willamette)
-# update fc after each topo line sample so data isn't lost if the 
-# script crashes
 # eliminate arcpy and use gdal for reading/writing feature class data
 
 # This version is for manual starts from within python.
@@ -43,12 +95,18 @@ import os
 import gc
 import time
 import traceback
+import json
+import ctypes
 from datetime import timedelta
+from hashlib import md5
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
 import arcpy
 from arcpy import env
-from math import radians, sin, cos, hypot, ceil
-from collections import defaultdict
+from math import radians, sin, cos, hypot, ceil, floor
+from collections import defaultdict, OrderedDict
 import numpy as np
+from raster_io import open_raster, raster_fingerprint, register_array
 
 # ----------------------------------------------------------------------
 # Start Fill in Data
@@ -60,6 +118,19 @@ z_units = "Meters"
 topo_fc = r"D:\Projects\TTools_9\JohnsonCreek.gdb\topo_samples"
 block_size = "#" # OPTIONAL defualt to 5
 overwrite_data = True
+topo_engine = "rays" # OPTIONAL "rays", "sweep", or "stream"
+skippy_max_error = 0 # OPTIONAL max angle error in degrees for skippy stepping, 0 = off
+benchmark_skippy = False # OPTIONAL run skippy_benchmark() and exit
+processes = 1 # OPTIONAL number of processes, "#" uses all cores
+checkpoint_file = "#" # OPTIONAL path to a checkpoint file, "#" = no checkpoints
+checkpoint_interval = 10 # OPTIONAL number of blocks between checkpoints
+resume = False # OPTIONAL restart from the checkpoint file
+tile_cache_mb = 1024 # OPTIONAL memory for the "stream" engine tile cache
+horizon_cache_dir = "#" # OPTIONAL folder for the horizon cache, "#" = no cache
+raster_backend = "arcpy" # OPTIONAL "arcpy", "gdal", "numpy", or "memmap"
+use_max_pyramid = False # OPTIONAL skip samples below the max angle, "stream" engine only
+benchmark_pyramid = False # OPTIONAL run pyramid_benchmark() and exit
+benchmark_engines = False # OPTIONAL run engine_benchmark() and exit
 # End Fill in Data
 
 # Used for debugging. Currently turned off. 
@@ -76,6 +147,16 @@ plot_dir = r"D:\Projects\TTools_9\plots"
 #z_units = parameters[4].valueAsText
 #topo_fc = parameters[5].valueAsText
 #overwrite_data = parameters[6].valueAsText True/False
+#topo_engine = parameters[7].valueAsText
+#skippy_max_error = parameters[8].valueAsText
+#processes = parameters[9].valueAsText
+#checkpoint_file = parameters[10].valueAsText
+#checkpoint_interval = parameters[11].valueAsText
+#resume = parameters[12].valueAsText True/False
+#tile_cache_mb = parameters[13].valueAsText
+#horizon_cache_dir = parameters[14].valueAsText
+#raster_backend = parameters[15].valueAsText
+#use_max_pyramid = parameters[16].valueAsText True/False
 
 def nested_dict(): 
     """Build a nested dictionary"""
@@ -274,47 +355,214 @@ def from_z_units_to_meters_con(zUnits):
     
     return con_z_to_m
 
-def build_search_array(searchDistance_min, searchDistance_max, cellsize, use_skippy):
-    """Build a numpy array from the minimum to the max
-    search distance by increments of the cellsize."""
+def get_azimuths(topo_directions):
+    """Returns the list of azimuths to sample. 1 is [W,S,E], 2 is the
+    eight compass directions (north coded as 365), a number greater
+    than 2 is that many evenly spaced directions ending at north (360),
+    and a list is used as is."""
+    
+    if isinstance(topo_directions, (list, tuple)):
+        return [float(a) for a in topo_directions]
+    
+    topo_directions = int(topo_directions)
+    if topo_directions == 2: # All directions
+        return [45,90,135,180,225,270,315,365]
+    if topo_directions > 2:
+        return [x * 360.0 / topo_directions for x in range(1, topo_directions + 1)]
+    return [270,180,90]
+
+def topo_field_name(a):
+    """Returns the nodes fc field name for the azimuth. The compass
+    directions use the TOPO_NE style names, others use the azimuth
+    in hundredths of a degree padded to five digits so the name fits
+    the 10 character shapefile limit, e.g. 22.5 is TOPO_02250"""
+    
+    compassdict = {45:"TOPO_NE",90:"TOPO_E",135:"TOPO_SE",
+                   180:"TOPO_S",225:"TOPO_SW",270:"TOPO_W",
+                   315:"TOPO_NW",360:"TOPO_N",365:"TOPO_N"}
+    if a in compassdict:
+        return compassdict[a]
+    return "TOPO_{0:05d}".format(int(round(a * 100)))
+
+def azimuth_cellsize(a, x_cellsize, y_cellsize):
+    """Returns the distance to move along the azimuth so each step
+    moves one raster cell in the main direction of travel"""
+    
+    if a in [45,135,225,315]:
+        return hypot(x_cellsize, y_cellsize)
+    if a in [90,270]:
+        return x_cellsize
+    if a in [180,360,365]:
+        return y_cellsize
+    
+    dx = abs(sin(radians(a)))
+    dy = abs(cos(radians(a)))
+    if dx < 1e-9: return y_cellsize
+    if dy < 1e-9: return x_cellsize
+    return min(x_cellsize / dx, y_cellsize / dy)
+
+def sky_view_factor(topo_angles, azimuths):
+    """Returns the sky view factor for a flat surface from the 
+    topographic angles (degrees) in the azimuth directions. This
+    is the average of cos^2 of the horizon angle, each direction
+    weighted by half the angle to the directions on either side of
+    it so uneven azimuth lists are not biased. Negative and no data 
+    angles are treated as a flat horizon."""
+    
+    svf = [cos(radians(max(angle, 0))) ** 2 for angle in topo_angles]
+    if len(svf) == 1:
+        return svf[0]
+    
+    # 365 is north
+    order = sorted(range(len(azimuths)), key=lambda i: azimuths[i] % 360)
+    a_sorted = [azimuths[i] % 360 for i in order]
+    total = 0
+    for k, i in enumerate(order):
+        before = (a_sorted[k] - a_sorted[k - 1]) % 360
+        after = (a_sorted[(k + 1) % len(order)] - a_sorted[k]) % 360
+        total = total + svf[i] * (before + after) / 2
+    return total / 360
+
+def build_search_array(searchDistance_min, searchDistance_max, cellsize, use_skippy, max_angle_error=0):
+    """Build a numpy array of the multiples of the cellsize from the
+    minimum up to (not including) the max search distance. If 
+    use_skippy is True the increment grows with distance (see 
+    skippy_distances). max_angle_error defaults to 0 (every cell) 
+    like skippy_max_error. The array is empty if there are no
+    distances in the range."""
     
     # use next cell over to avoid divide by zero errors
     if searchDistance_min <= 0: searchDistance_min = cellsize
     
     if use_skippy:
         # This is a modified version of the skippy 
-        # algorithm from Greg Pelletier. It is not being used but I'm 
-        # keeping it in here in case someone wants to turn it on.
-        # It needs to be fixed so the ncells are adjusted based on distance
-        searchDistance = searchDistance_min
-        distanceList = [searchDistance_min]
-        
-        #ncells = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-        
-        ncells = 1
-        while not searchDistance > searchDistance_max:
-            if ncells <= 10:
-                searchDistance_m = searchDistance + (cellsize)
-            if 10 < ncells <= 20:
-                searchDistance = searchDistance + (cellsize * 3)
-            if 20 < ncells <= 40:
-                searchDistance = searchDistance + (cellsize * 6)
-            if 40 < ncells <= 50:
-                searchDistance = searchDistance + (cellsize * 12)
-            if 50 < ncells <= 60:
-                searchDistance = searchDistance + (cellsize * 25)
-            if ncells > 60:
-                searchDistance = searchDistance + (cellsize * 50)
-            distanceList.append(searchDistance)
-            ncells = ncells + 1
-        distance_array = np.array(distanceList)
+        # algorithm from Greg Pelletier. The distances are taken from 
+        # one list per cellsize that starts at the node so topo lines
+        # split across blocks are sampled the same as if they were not.
+        distance_array = skippy_distances(cellsize, max_angle_error, searchDistance_max)
+        i0, i1 = np.searchsorted(distance_array, [searchDistance_min, searchDistance_max])
+        distance_array = distance_array[i0:i1]
     else:
-        if (searchDistance_max - searchDistance_min >= cellsize):
-            distance_array = np.arange(searchDistance_min, searchDistance_max, cellsize)
-        else:
-            distance_array = np.array([searchDistance_min])
+        # The distances are counted from the node for the same reason
+        distance_array = cellsize * np.arange(ceil(searchDistance_min / cellsize),
+                                              ceil(searchDistance_max / cellsize))
     return distance_array
 
+# skippy distance arrays by (cellsize, max_angle_error)
+skippy_dict = {}
+
+def skippy_distances(cellsize, max_angle_error, searchDistance_max, max_slope=2.0):
+    """Returns the skippy search distances from one cell out to at
+    least searchDistance_max. A cell missed after the sample at 
+    distance d is at most one step s further along the topo line and
+    one cell diagonal c to the side, so with terrain slopes up to 
+    max_slope (rise/run) it is at most max_slope * (s + c) higher.
+    The topo angle error is then at most 
+    (max_slope * (s + c) + s / 2) / d radians. The step is the largest
+    multiple of the cellsize that keeps this under max_angle_error,
+    and never less than one cell. Near the node every cell is 
+    sampled."""
+    
+    key = (cellsize, max_angle_error, max_slope)
+    if key in skippy_dict and skippy_dict[key][-1] >= searchDistance_max:
+        return skippy_dict[key]
+    
+    error = radians(max_angle_error)
+    diagonal = hypot(cellsize, cellsize)
+    searchDistance = cellsize
+    distanceList = [searchDistance]
+    while searchDistance < searchDistance_max:
+        step = (searchDistance * error - max_slope * diagonal) / (max_slope + 0.5)
+        ncells = max(int(step / cellsize), 1)
+        searchDistance = searchDistance + (cellsize * ncells)
+        distanceList.append(searchDistance)
+    skippy_dict[key] = np.array(distanceList)
+    return skippy_dict[key]
+
+def ridged_terrain(nrows, ncols, cellsize, seed=1):
+    """Builds a synthetic elevation array of sharp crested ridges
+    at several scales and random orientations. Used by 
+    skippy_benchmark()."""
+    
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:nrows, 0:ncols] * cellsize
+    z_array = np.zeros((nrows, ncols))
+    wavelength = max(nrows, ncols) * cellsize / 2.0
+    amplitude = 400.0
+    while wavelength > cellsize * 4:
+        theta = rng.uniform(0, np.pi)
+        phase = rng.uniform(0, 2 * np.pi)
+        along = x * np.cos(theta) + y * np.sin(theta)
+        z_array += amplitude * (1 - np.abs(np.sin(np.pi * along / wavelength + phase)))
+        wavelength = wavelength / 2.0
+        amplitude = amplitude / 2.0
+    return z_array.astype(np.float32)
+
+def skippy_benchmark(max_angle_errors=[0.25, 0.5, 1.0, 2.0],
+                     n_nodes=200, cellsize=1.0, searchDistance_max=1000, seed=1):
+    """Compares skippy stepping against stepping every cell on 
+    synthetic ridged terrain scaled to the 200% slope skippy assumes.
+    Checks the topo angle error (skippy - every cell) is within each
+    max_angle_error and prints the run time and error. No rasters
+    or feature classes are read, but the script still needs arcpy to
+    import. Returns a list of 
+    [max_angle_error, seconds, speedup, mean error, max abs error]."""
+    
+    azimuths = [45,90,135,180,225,270,315,365]
+    azimuthdisdict = dict((a, azimuth_cellsize(a, cellsize, cellsize)) for a in azimuths)
+    
+    # The nodes are in a small square in the middle with
+    # room for the longest topo line on all sides
+    margin = int(ceil(searchDistance_max / cellsize)) + 2
+    ncells = 2 * margin + 100
+    z_array = ridged_terrain(ncells, ncells, cellsize, seed).astype(float)
+    block_y_max = ncells * cellsize
+    
+    # Scale the terrain so the steepest slope between neighbor cells
+    # is under 200% / 1.09. Paths along rows, columns, and diagonals 
+    # are up to 8.3% longer than the straight line so no two cells 
+    # are more than 200% apart.
+    slope = max(np.abs(np.diff(z_array, axis=0)).max(),
+                np.abs(np.diff(z_array, axis=1)).max(),
+                np.abs(z_array[1:, 1:] - z_array[:-1, :-1]).max() / np.sqrt(2),
+                np.abs(z_array[1:, :-1] - z_array[:-1, 1:]).max() / np.sqrt(2)) / cellsize
+    z_array = z_array * (2.0 / 1.09 / slope)
+    
+    rng = np.random.RandomState(seed)
+    block_samples = []
+    for nodeID in range(n_nodes):
+        row = rng.randint(margin, ncells - margin)
+        col = rng.randint(margin, ncells - margin)
+        node_x = (col + 0.5) * cellsize
+        node_y = block_y_max - (row + 0.5) * cellsize
+        for a in azimuths:
+            block_samples.append([nodeID, 0, a, z_array[row, col],
+                                  node_x, node_y, node_x, node_y,
+                                  0, searchDistance_max])
+    
+    def run(max_angle_error):
+        skippy_dict.clear()
+        t0 = time.time()
+        topo_samples = march_rays(z_array, 0, block_y_max, cellsize, cellsize,
+                                  block_samples, azimuthdisdict, 1.0,
+                                  searchDistance_max, skippy_max_error=max_angle_error)
+        return time.time() - t0, np.array([s[7] for s in topo_samples])
+    
+    t_cell, angles_cell = run(0)
+    print("Every cell: {0:.2f} seconds, {1} topo lines".format(t_cell, len(block_samples)))
+    
+    results = []
+    for max_angle_error in max_angle_errors:
+        t_skippy, angles_skippy = run(max_angle_error)
+        error = angles_skippy - angles_cell
+        results.append([max_angle_error, t_skippy, t_cell / t_skippy,
+                        error.mean(), np.abs(error).max()])
+        print("Skippy {0} deg: {1:.2f} seconds ({2:.1f}x), ".format(*results[-1][:3]) +
+              "mean error {0:.4f} deg, max error {1:.4f} deg".format(*results[-1][3:]))
+        assert results[-1][4] <= max_angle_error, \
+            "Skippy topo angle error is over {0} degrees".format(max_angle_error)
+    return results
+
 def coord_to_array(easting, northing, block_x_min, block_y_max, x_cellsize, y_cellsize):
     """converts x/y coordinates to col and row of the array"""
     xy = []
@@ -366,11 +614,14 @@ def create_block_fc(block_segments, b, block_fc, proj):
             cursor.insertRow([poly, b, s])
             poly_array.removeAll() 
 
-def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
-    """Returns two lists, one containting the coordinate extent
-    for each block that will be itterativly extracted to an array
-    and the other containing the start and stop distances for each
-    topo line that is within the block extent."""
+def create_blocks(nodeDict, block_size, azimuths, searchDistance_max):
+    """Returns a dictionary with the coordinate extent of each block 
+    that will be itterativly extracted to an array, the start and stop
+    distances for each topo line that is within the block extent, and
+    the nodes that are finished after the block is processed. The 
+    blocks are a regular grid, so each topo line is split where it 
+    crosses the block edges in one vectorized pass over all the 
+    lines (a grid DDA) and each piece goes to the block it is in."""
     
     print("Preparing blocks and topo sampling")
     
@@ -383,9 +634,6 @@ def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
     nodes.sort()    
     
     topo_list = []
-    x_coord_list = []
-    y_coord_list = []
-    
     for nodeID in nodes:
         node_x = nodeDict[nodeID]["POINT_X"]
         node_y = nodeDict[nodeID]["POINT_Y"]
@@ -397,28 +645,78 @@ def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
             end_x = ((searchDistance_max * sin(radians(a))) + node_x)
             end_y = ((searchDistance_max * cos(radians(a))) + node_y)
             
-            x_coord_list.append(end_x)
-            y_coord_list.append(end_y)
-            
             topo_list.append([nodeID, streamID, a, z_node, node_x, node_y, end_x, end_y])
     
+    node_x = np.array([topo[4] for topo in topo_list])
+    node_y = np.array([topo[5] for topo in topo_list])
+    end_x = np.array([topo[6] for topo in topo_list])
+    end_y = np.array([topo[7] for topo in topo_list])
+    dx = end_x - node_x
+    dy = end_y - node_y
+    
     # calculate bounding box extent for samples
-    x_min = min(x_coord_list)
-    x_max = max(x_coord_list)
-    y_min = min(y_coord_list)
-    y_max = max(y_coord_list)
+    x_min = min(node_x.min(), end_x.min())
+    x_max = max(node_x.max(), end_x.max())
+    y_min = min(node_y.min(), end_y.min())
+    y_max = max(node_y.max(), end_y.max())
     
     x_width = int(x_max - x_min + 1)
     y_width = int(y_max - y_min + 1)
     
-    block_extents = []
-    block_samples = []
-    b = 0
-     
-    # Build blocks
-    for x in range(0, x_width, block_size):
-        for y in range(0, y_width, block_size):
-            
+    # number of block cols and rows
+    nx = len(range(0, x_width, block_size))
+    ny = len(range(0, y_width, block_size))
+    
+    def crossings(p0, dp, n):
+        """Returns the topo line index and the fraction of the topo 
+        line length (t) where each line crosses the block edges 
+        between the n blocks along one axis"""
+        lo = np.minimum(p0, p0 + dp) / block_size
+        hi = np.maximum(p0, p0 + dp) / block_size
+        k_first = np.maximum(np.floor(lo).astype(int) + 1, 1)
+        k_last = np.minimum(np.ceil(hi).astype(int) - 1, n - 1)
+        count = np.maximum(k_last - k_first + 1, 0)
+        line = np.repeat(np.arange(len(p0)), count)
+        k = k_first[line] + np.arange(len(line)) - np.repeat(np.cumsum(count) - count, count)
+        return line, (k * block_size - p0[line]) / dp[line]
+    
+    line_x, t_x = crossings(node_x - x_min, dx, nx)
+    line_y, t_y = crossings(node_y - y_min, dy, ny)
+    
+    # Sort the start, end, and crossings along each line. Each
+    # pair of neighbors is the piece of the line in one block.
+    lines = np.arange(len(topo_list))
+    line = np.concatenate((lines, lines, line_x, line_y))
+    t = np.concatenate((np.zeros(len(lines)), np.ones(len(lines)), t_x, t_y))
+    order = np.lexsort((t, line))
+    line = line[order]
+    t = t[order]
+    keep = (line[1:] == line[:-1]) & (t[1:] > t[:-1])
+    t0 = t[:-1][keep]
+    t1 = t[1:][keep]
+    line = line[:-1][keep]
+    
+    # The block of each piece from its middle. Cells take points on
+    # their left and top edges so the blocks do the same.
+    t_mid = (t0 + t1) / 2
+    block_col = np.floor((node_x[line] + dx[line] * t_mid - x_min) / block_size)
+    block_row = np.ceil((node_y[line] + dy[line] * t_mid - y_min) / block_size) - 1
+    block = (block_col.clip(0, nx - 1) * ny + block_row.clip(0, ny - 1)).astype(int)
+    
+    # A node can be updated after the last block 
+    # any of its topo lines are in is processed
+    last_block = np.full(len(topo_list), -1, dtype=int)
+    np.maximum.at(last_block, line, block)
+    node_last_block = {}
+    for topo, b in zip(topo_list, last_block.tolist()):
+        node_last_block[topo[0]] = max(node_last_block.get(topo[0], -1), b)
+    
+    for i, b, start, end in zip(line.tolist(), block.tolist(),
+                                (t0 * searchDistance_max).tolist(),
+                                (t1 * searchDistance_max).tolist()):
+        if b not in blockDict:
+            x = (b // ny) * block_size
+            y = (b % ny) * block_size
             # Lower left coordinate of block (in map units)
             block_x_min = min([x_min + x, x_max])
             block_y_min = min([y_min + y, y_max])
@@ -426,257 +724,45 @@ def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
             block_x_max = min([block_x_min + block_size, x_max])
             block_y_max = min([block_y_min + block_size, y_max])
             
-            nodes_to_update = []
-            topo_in_block = []
-            
-            block_segments = (((block_x_min, block_y_max), (block_x_min, block_y_min)),
-                              ((block_x_min, block_y_min), (block_x_max, block_y_min)),
-                              ((block_x_max, block_y_min), (block_x_max, block_y_max)),
-                              ((block_x_max, block_y_max), (block_x_min, block_y_max)))
-            
             #--------------------------------------------------------
-            # This is an argument for plot_it(). I used it for debugging.
-            # It's a tuple of the x/y coords for each block segment.
-            block_for_plot = ((block_x_min, block_y_max),
-                             (block_x_min, block_y_min),
-                             (block_x_min, block_y_min),
-                             (block_x_max, block_y_min),
-                             (block_x_max, block_y_min),
-                             (block_x_max, block_y_max),
-                             (block_x_max, block_y_max),
-                             (block_x_min, block_y_max))
+            # This is an argument for create_block_fc(). I used it 
+            # for debugging. It's a tuple of the x/y coords for each 
+            # block segment.
+            #block_segments = (((block_x_min, block_y_max), (block_x_min, block_y_min)),
+            #                  ((block_x_min, block_y_min), (block_x_max, block_y_min)),
+            #                  ((block_x_max, block_y_min), (block_x_max, block_y_max)),
+            #                  ((block_x_max, block_y_max), (block_x_min, block_y_max)))
             #--------------------------------------------------------
-             
-            # Now start itterating through the topo list to evaluate
-            # if any part of the topo line is in the block extent
-            for nodeID, streamID, a, z_node, node_x, node_y, end_x, end_y in topo_list:
-                
-                #--------------------------------------------------------
-                # This was used for debugging. 
-                # It slows the script WAY down.
-                #topo_line = ((node_x, node_y),(end_x, end_y))
-                #plot_it(block_for_plot, topo_line, nodeID, a, b, b0, plot_dir)
-                #create_topo_line_fc(topo_line, streamID, nodeID, a,
-                #                    topo_line_fc, proj)
-                #--------------------------------------------------------
-                
-                contains_node = False
-                contains_end = False
-                last_sample = False
-                
-                # check if the node is inside the block
-                if (block_x_min <= node_x <= block_x_max and
-                    block_y_min <= node_y <= block_y_max):
-                    contains_node = True
-                
-                # check if the topo line end point is inside the block
-                if (block_x_min <= end_x <= block_x_max and
-                    block_y_min <= end_y <= block_y_max):
-                    contains_end = True
-                    
-                # check if this is the last block to process for this node
-                if a == last_azimuth:
-                    if a == 45:
-                        # we have to get the coordinate at 
-                        # the far upper right corner
-                        searchDistance_last = (hypot(searchDistance_max, searchDistance_max))
-                        last_x = ((searchDistance_last * sin(radians(a))) + node_x)
-                        last_y = ((searchDistance_last * cos(radians(a))) + node_y)
-                    else:
-                        last_x = end_x
-                        last_y = end_y
-                        
-                    if (block_x_min <= last_x <= block_x_max and
-                        block_y_min <= last_y <= block_y_max):
-                        
-                        last_sample = True      
-            
-                # check if the entire topo line segment is inside the block
-                if contains_node and contains_end:
-                    block_search_start = 0
-                    block_search_end = searchDistance_max
-                    
-                    topo_in_block.append([nodeID, streamID, a,
-                                          z_node, 
-                                          node_x, node_y,
-                                          end_x, end_y,
-                                          block_search_start,
-                                          block_search_end])
-                    
-                    if last_sample: nodes_to_update.append(nodeID)
-                
-                # check if and where the topo segment cross the block    
-                else:
-                    distance = []
-                    
-                    # check each block segment for an intersection
-                    for i, block_segment in enumerate(block_segments):
-                        
-                        intersects, inter1_x, inter1_y, inter2_x, inter2_y = find_intersection(block_segment[0],
-                                                            block_segment[1],
-                                                            (node_x, node_y),
-                                                            (end_x, end_y), True)
-                        
-                        # if there is an intersection calculate the 
-                        # distance in fc units from node to 
-                        # that intersection
-                        if intersects:
-                            if a in [0, 180]:
-                                # need to use the y directon for these
-                                distance.append((inter1_y - node_y) / cos(radians(a)))
-                            else:
-                                distance.append((inter1_x - node_x) / sin(radians(a)))
-
-                    if (len(distance) == 1 and
-                        (0 < distance[0] < searchDistance_max) and
-                        (contains_node or contains_end)):
-                        # one intersection
-                        if contains_node:
-                            # This will be changed from zero to 
-                            # the cell size in build_search_array()
-                            # Should probably just change it here
-                            block_search_start = 0 
-                            block_search_end = distance[0]
-                        elif contains_end:
-                            # end of the topo line
-                            block_search_start = distance[0]
-                            block_search_end = searchDistance_max
-                        
-                        # part of the topo line is in the block, add it
-                        topo_in_block.append([nodeID, streamID, a,
-                                              z_node, 
-                                              node_x, node_y,
-                                              end_x, end_y,
-                                              block_search_start,
-                                              block_search_end])
-                        
-                        if last_sample and not nodeDict[nodeID]["updated"]:
-                            nodes_to_update.append(nodeID)
-                            nodeDict[nodeID]["updated"] = True
-                    
-                    elif len(distance) > 1:
-                        # two intersections, crosses the block
-                        # two intersections, end or start on block line
-                        # three intersections, collienar over length of block
-                        # three intersections, collienar w/ end or start on block line
-                        block_search_start = min(i for i in distance if i is not None)
-                        block_search_end = max(distance)
-                    
-                        topo_in_block.append([nodeID, streamID, a,
-                                              z_node, 
-                                              node_x, node_y,
-                                              end_x, end_y,
-                                              block_search_start,
-                                              block_search_end])
-                    
-                        if last_sample and contains_end and not nodeDict[nodeID]["updated"]:
-                            nodes_to_update.append(nodeID)
-                            nodeDict[nodeID]["updated"] = True
-                    
-                    elif last_sample and not contains_end and not nodeDict[nodeID]["updated"]:
-                        nodes_to_update.append(nodeID)
-                        nodeDict[nodeID]["updated"] = True
-                        
-                    del distance[:]
-                    
-            if topo_in_block:
-                
-                # order 0 left,      1 bottom,    2 right,     3 top
-                blockDict[b]["extent"] = (block_x_min, block_y_min,
-                                          block_x_max, block_y_max)
-                blockDict[b]["samples"] = topo_in_block
-                blockDict[b]["nodes_to_update"] = nodes_to_update
-                
-                #--------------------------------------------------
-                # Creates a feature class of the blocks.  
-                #create_block_fc(block_segments, b, block_fc, proj)
-                #--------------------------------------------------
-                
-            b = b + 1
-    return blockDict
-
-def find_intersection(a, b, c, d, check_collinear=True):
-    """Calculates 2D intersection coordinates of segments a-b and c-d.
-    a,b,c,d are tuples in the form of (x,y). If checking for collinearity
-    then segments that overlap or touch but do not cross will be
-    considered an interesection. Returns the min and max points of
-    intersection for overlap and the same points for intersections."""
-    
-    # a-b = block segment
-    # c-d = topo line
-    
-    Dx_Cx = d[0] - c[0]
-    Ay_Cy = a[1] - c[1]
-    Dy_Cy = d[1] - c[1]
-    Ax_Cx = a[0] - c[0]
-    Bx_Ax = b[0] - a[0]
-    By_Ay = b[1] - a[1]
-    
-    Cx_Bx = c[0] - b[0]
-    Dx_Ax = d[0] - a[0]
-    Cy_By = c[1] - b[1]
-    Dy_Ay = d[1] - a[1]    
-    
-    numerator_a = Dx_Cx * Ay_Cy - Dy_Cy * Ax_Cx
-    numerator_b = Bx_Ax * Ay_Cy - By_Ay * Ax_Cx
-    denominator = Dy_Cy * Bx_Ax - Dx_Cx * By_Ay
-        
-    if (check_collinear and numerator_a == 0 and numerator_b == 0 and denominator == 0):
-        # Lines are collinear
-        
-        # if the signs are different the 
-        # segments have some overlap
-        overlap_x = (Cx_Bx < 0) != (Dx_Ax < 0)
-        overlap_y = (Cy_By < 0) != (Dy_Ay < 0)
-        
-        point_overlap = (a == d or b == c)
-        
-        # if any are True there is an intersection
-        if (overlap_x or overlap_y or point_overlap):
-            # There is overlap 
-            x = sorted((a[0], b[0], c[0], d[0]))
-            y = sorted((a[1], b[1], c[1], d[1]))
-            
-            # min          
-            ixa = x[1]
-            iya = y[1]
             
-            # max
-            ixb = x[2]
-            iyb = y[2]
+            # order 0 left,      1 bottom,    2 right,     3 top
+            blockDict[b]["extent"] = (block_x_min, block_y_min,
+                                      block_x_max, block_y_max)
+            blockDict[b]["samples"] = []
+            blockDict[b]["nodes_to_update"] = []
             
-            return True, ixa, iya, ixb, iyb
-        return False, None, None, None, None
-    
-    if denominator == 0:
-        # Lines are parallel or 
-        # maybe collinear if check_collinear=False
+            #--------------------------------------------------
+            # Creates a feature class of the blocks.  
+            #create_block_fc(block_segments, b, block_fc, proj)
+            #--------------------------------------------------
         
-        return False, None, None, None, None
+        blockDict[b]["samples"].append(topo_list[i] + [start, end])
     
-    u_a = numerator_a / denominator
-    u_b = numerator_b / denominator
+    for nodeID in nodes:
+        blockDict[node_last_block[nodeID]]["nodes_to_update"].append(nodeID)
     
-    if (u_a >= 0) and (u_a <= 1) and (u_b >= 0) and (u_b <= 1):
-        # segments intersect
-        ixa = a[0] + Bx_Ax * u_a
-        iya = a[1] + By_Ay * u_a
-        
-        ixb = c[0] + Dx_Cx * u_b
-        iyb = c[1] + Dy_Cy * u_b
-        
-        return True, ixa, iyb, ixa, iyb
-    return False, None, None, None, None
+    return blockDict
 
-def get_topo_angles(nodeDict, block_extent, block_samples, z_raster, azimuthdisdict, searchDistance_max_m, con_z_to_m):
-    """This gets the maximum topographic angle and other informaiton for
-    each topo line within the block. The data is saved to the nodeDict
-    as a list."""
+def read_block_array(block_extent, z_raster, con_z_to_m):
+    """Reads the elevation raster within the block extent into a numpy
+    array in units of meters. The block extent is snapped out to the
+    raster cell corners. Returns the array, the snapped upper left
+    block coordinate, and the raster cell sizes."""
     
     nodata_to_value = -9999 / con_z_to_m
     
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
+    reader = open_raster(z_raster, raster_backend)
+    x_cellsize = float(reader.get_property("CELLSIZEX"))
+    y_cellsize = float(reader.get_property("CELLSIZEY"))
     
     # localize the block extent values
     block_x_min = block_extent[0]
@@ -686,10 +772,10 @@ def get_topo_angles(nodeDict, block_extent, block_samples, z_raster, azimuthdisd
 
     # Get the coordinates extent of the input raster
     # this could be in main so it doesn't have to run each time
-    raster_x_min = float(arcpy.GetRasterProperties_management(z_raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(z_raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(z_raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(z_raster, "TOP").getOutput(0))
+    raster_x_min = float(reader.get_property("LEFT"))
+    raster_y_min = float(reader.get_property("BOTTOM"))
+    raster_x_max = float(reader.get_property("RIGHT"))
+    raster_y_max = float(reader.get_property("TOP"))
       
     # Calculate the X and Y offset from the upper left node 
     # coordinates bounding box    
@@ -716,269 +802,1748 @@ def get_topo_angles(nodeDict, block_extent, block_samples, z_raster, azimuthdisd
     
     # Construct the array. Note returned array is (row, col) so (y, x)
     try:
-        z_array = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                       ncols, nrows, nodata_to_value)
+        z_array = reader.read_numpy(block_x_min_center, block_y_min_center,
+                                    ncols, nrows, nodata_to_value)
     except:
         tbinfo = traceback.format_exc()
         pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"       
         sys.exit(pymsg)    
     
-    # convert array values to meters if needed
-    z_array = z_array * con_z_to_m
+    # convert array values to meters if needed. The engines need
+    # float elevations. A float array with a factor of 1 is not copied.
+    if con_z_to_m != 1 or not np.issubdtype(z_array.dtype, np.floating):
+        z_array = z_array * con_z_to_m
+    
+    return z_array, block_x_min, block_y_max, x_cellsize, y_cellsize
+
+def get_topo_angles(nodeDict, block_extent, block_samples, z_raster, azimuthdisdict, searchDistance_max_m, con_z_to_m, skippy_max_error=0):
+    """This gets the maximum topographic angle and other informaiton for
+    each topo line within the block. The data is saved to the nodeDict
+    as a list."""
+    
+    (z_array, block_x_min, block_y_max,
+     x_cellsize, y_cellsize) = read_block_array(block_extent, z_raster, con_z_to_m)
+    
+    # Blocks with no data are sampled too so their off raster
+    # samples are counted
+    topo_samples = march_rays(z_array, block_x_min, block_y_max,
+                              x_cellsize, y_cellsize, block_samples,
+                              azimuthdisdict, con_to_m,
+                              searchDistance_max_m,
+                              skippy_max_error=skippy_max_error)
+        
+    return topo_samples
+
+def march_rays(z_array, block_x_min, block_y_max, x_cellsize, y_cellsize,
+               block_samples, azimuthdisdict, con_to_m, searchDistance_max_m,
+               max_cells=2000000, skippy_max_error=0, sample_z=None,
+               z_pyramid=None):
+    """Samples the elevation array along every topo line in the block
+    and returns the maximum topographic angle and other information
+    for each one. The topo lines are marched together as 2-D
+    (topo line x step) arrays so the elevations are gathered with one
+    index call per chunk. Chunks hold about max_cells samples.
+    If skippy_max_error > 0 the topo lines use skippy stepping.
+    sample_z is an optional function that returns the elevations
+    at the rows and cols, used in place of z_array. If z_pyramid is
+    also given samples that can not be the maximum topo angle are
+    not read (see bounded_samples)."""
+    
+    # sin/cos for each azimuth, calculated once
+    trig = dict((a, (sin(radians(a)), cos(radians(a)))) for a in azimuthdisdict)
     
-    topo_samples = []    
-    if z_array.max() > -9999:
-        # There is at least one pixel of data
-        for (nodeID, streamID, a, z_node,
-             node_x, node_y, end_x, end_y,
-             block_search_start, block_search_end) in block_samples:
+    topo_samples = []
+    i = 0
+    while i < len(block_samples):
+        # create list of distance movements along each topo line 
+        # from the block edges. This is in units of the fc. Pieces of
+        # topo lines that cross the block between two sample 
+        # distances have nothing to sample and are dropped.
+        distance_list = []
+        chunk = []
+        n_cells = 0
+        for sample in block_samples[i:]:
+            if distance_list and n_cells > max_cells: break
+            i = i + 1
+            a = sample[2]
+            distance_array = build_search_array(sample[8], sample[9],
+                                                azimuthdisdict[a],
+                                                skippy_max_error > 0,
+                                                skippy_max_error)
+            if len(distance_array) == 0: continue
+            distance_list.append(distance_array)
+            chunk.append(sample)
+            n_cells = n_cells + len(distance_array)
+        if not chunk: continue
+        
+        n_steps = np.array([len(d) for d in distance_list])
+        valid = np.arange(n_steps.max()) < n_steps[:, np.newaxis]
+        
+        # pad the shorter topo lines, the padding is masked out below
+        distance_array = np.ones(valid.shape)
+        distance_array[valid] = np.concatenate(distance_list)
+        
+        sin_a = np.array([trig[s[2]][0] for s in chunk])[:, np.newaxis]
+        cos_a = np.array([trig[s[2]][1] for s in chunk])[:, np.newaxis]
+        node_x = np.array([s[4] for s in chunk], dtype=float)[:, np.newaxis]
+        node_y = np.array([s[5] for s in chunk], dtype=float)[:, np.newaxis]
+        
+        pt_x = (distance_array * sin_a) + node_x
+        pt_y = (distance_array * cos_a) + node_y
+        
+        # convert the coordinates to the col and row of the array
+        cols = np.floor((pt_x - block_x_min) / x_cellsize).astype(int)
+        rows = np.floor((pt_y - block_y_max) / y_cellsize * -1).astype(int)
+        cols[~valid] = 0
+        rows[~valid] = 0
+        
+        # convert distances to meters
+        distance_array_m = distance_array * con_to_m
+        
+        skipped = np.zeros(valid.shape, dtype=bool)
+        if sample_z is None:
+            # Samples off the array are off raster. A negative
+            # index would wrap around to the other side.
+            nrows, ncols = z_array.shape
+            off_array = (rows < 0) | (rows >= nrows) | (cols < 0) | (cols >= ncols)
+            z_topo_array = z_array[rows.clip(0, nrows - 1), cols.clip(0, ncols - 1)]
+            z_topo_array[off_array] = -9999
+        else:
+            rows[~valid] = -1
+            if z_pyramid is None:
+                z_topo_array = sample_z(rows, cols)
+            else:
+                z_topo_array, skipped = bounded_samples(z_pyramid, sample_z, rows, cols,
+                                                        valid, [s[3] for s in chunk],
+                                                        distance_array_m)
+        z_node = np.array([s[3] for s in chunk], dtype=z_topo_array.dtype)[:, np.newaxis]
+        
+        # Calculate the topo angles along the topo lines
+        angle_array = np.degrees(np.arctan((z_topo_array - z_node) / distance_array_m))
+        # remove the off raster samples
+        na_array = (z_topo_array < -9998) & valid & ~skipped
+        angle_array[na_array] = -9999
+        angle_array[~valid | skipped] = -np.inf
+        
+        # array index at the max topo angle for each topo line
+        arryindex = angle_array.argmax(axis=1)
+        lines = np.arange(len(chunk))
+        topoAngles = angle_array[lines, arryindex]
+        z_topos = z_topo_array[lines, arryindex]
+        topoAngleDistances = distance_array[lines, arryindex]
+        off_rastersamples = na_array.sum(axis=1)
+        
+        for j, (nodeID, streamID, a, z_node,
+                node_x, node_y, end_x, end_y,
+                block_search_start, block_search_end) in enumerate(chunk):
             
-            # create list of distance movements along the topo line 
-            # from the block edges
-            # this is in units of the fc
-            cellsize = azimuthdisdict[a]
-            distance_array = build_search_array(block_search_start,
-                                                  block_search_end,
-                                                  cellsize,
-                                                  use_skippy=False)
-            z_topo_list = []
-            for distance in distance_array:
-                pt_x = ((distance * sin(radians(a))) + node_x)
-                pt_y = ((distance * cos(radians(a))) + node_y)
-               
-                xy = coord_to_array(pt_x, pt_y, block_x_min, block_y_max, x_cellsize, y_cellsize)
-                z_topo_list.append(z_array[xy[1], xy[0]])
-    
-            # convert distances to meters
-            distance_array_m = distance_array * con_to_m            
-            z_topo_array = np.array(z_topo_list)
-            # Calculate the topo angles along the topo line
-            angle_array = np.degrees(np.arctan((z_topo_array - z_node) / distance_array_m))
-            # remove the off raster samples
-            naindex = np.where(z_topo_array < -9998)
-            for x in naindex[0]: angle_array[x] = -9999            
-            # Find the max topo angle
-            topoAngle = angle_array.max()
-            # array index at the max topo angle 
-            arryindex = np.where(angle_array==topoAngle)[0][0]
-            z_topo = z_topo_array[arryindex]
+            topoAngle = topoAngles[j]
+            z_topo = z_topos[j]
             # elevation change between topo angle location and node elevation
             z_change = z_topo - z_node
             # distance from the node to topo angle location in units of fc
-            topoAngleDistance = distance_array[arryindex]
-            topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
-            topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
+            topoAngleDistance = topoAngleDistances[j]
+            topoAngle_x = (topoAngleDistance * trig[a][0]) + node_x
+            topoAngle_y = (topoAngleDistance * trig[a][1]) + node_y
             topoAngleDistance_m = topoAngleDistance * con_to_m
-            off_rastersamples = (z_topo_array < -9998).sum()
             
             topo_samples.append([topoAngle_x, topoAngle_y,
-                                  topoAngle_x, topoAngle_y,
-                                  streamID, nodeID, a,
-                                  topoAngle, z_topo,
-                                  z_node, z_change,
-                                  topoAngleDistance_m,
-                                  searchDistance_max_m,
-                                  off_rastersamples])
+                                 topoAngle_x, topoAngle_y,
+                                 streamID, nodeID, a,
+                                 topoAngle, z_topo,
+                                 z_node, z_change,
+                                 topoAngleDistance_m,
+                                 searchDistance_max_m,
+                                 off_rastersamples[j]])
         
     return topo_samples
 
-#enable garbage collection
-gc.enable()
+def create_node_blocks(nodeDict, block_size):
+    """Returns a list of the coordinate extent and the node IDs
+    of the nodes within each block. Used by the sweep engine."""
+    
+    print("Calculating block extents")
+    nodes = nodeDict.keys()
+    nodes.sort()
+    
+    x_coord_list = [nodeDict[nodeID]["POINT_X"] for nodeID in nodes]
+    y_coord_list = [nodeDict[nodeID]["POINT_Y"] for nodeID in nodes]
+    
+    # calculate bounding box extent for samples
+    x_min = min(x_coord_list)
+    x_max = max(x_coord_list)
+    y_min = min(y_coord_list) 
+    y_max = max(y_coord_list)
+    
+    x_width = int(x_max - x_min + 1)
+    y_width = int(y_max - y_min + 1)
+    
+    node_blocks = []
+    blocked = set()
+    
+    # Build data blocks
+    for x in range(0, x_width, block_size):
+        for y in range(0, y_width, block_size):
 
-try:
-    print("Step 4: Measure Topographic Angles") 
+            # Lower left coordinate of block (in map units)
+            block0_x_min = min([x_min + x, x_max])
+            block0_y_min = min([y_min + y, y_max])
+            # Upper right coordinate of block (in map units)
+            block0_x_max = min([block0_x_min + block_size, x_max])
+            block0_y_max = min([block0_y_min + block_size, y_max])
+            
+            nodes_in_block = []
+            for nodeID in nodes:
+                node_x = nodeDict[nodeID]["POINT_X"]
+                node_y = nodeDict[nodeID]["POINT_Y"]
+                if (block0_x_min <= node_x <= block0_x_max and
+                    block0_y_min <= node_y <= block0_y_max and
+                    nodeID not in blocked):
+                    nodes_in_block.append(nodeID)
+                    # nodes on a shared block edge are only used once
+                    blocked.add(nodeID)
+            
+            if nodes_in_block:
+                x_list = [nodeDict[nodeID]["POINT_X"] for nodeID in nodes_in_block]
+                y_list = [nodeDict[nodeID]["POINT_Y"] for nodeID in nodes_in_block]
+                # order 0 left,      1 bottom,    2 right,     3 top
+                node_blocks.append([(min(x_list), min(y_list),
+                                     max(x_list), max(y_list)),
+                                    nodes_in_block])
     
-    #keeping track of time
-    startTime= time.time()
+    return node_blocks
+
+def grid_direction(a):
+    """Returns the (row, col) array step for an azimuth that follows
+    the raster grid (a multiple of 45 degrees). Returns None for other
+    azimuths. 365 is not a grid direction because the rays engine
+    marches it at sin/cos(radians(365))."""
     
-    # Check if the node fc exists
-    if not arcpy.Exists(nodes_fc):
-        arcpy.AddError("\nThis output does not exist: \n" +
-                       "{0}\n".format(nodes_fc))
-        sys.exit("This output does not exist: \n" +
-                 "{0}\n".format(nodes_fc))     
-        
-    # Check if the topo output exists and delete if needed
-    if arcpy.Exists(topo_fc) and overwrite_data:
-        arcpy.Delete_management(topo_fc)
+    if a % 45 != 0 or a > 360:
+        return None
+    drow = -int(round(cos(radians(a))))
+    dcol = int(round(sin(radians(a))))
+    return drow, dcol
+
+def profile_array(z_array, drow, dcol, row_min, row_max, col_min, col_max):
+    """Rearranges the elevation array into raster line profiles in the
+    (drow, dcol) direction. Row i of the returned array holds the
+    elevations at position i along every raster line that crosses
+    the rows and cols between row_min/row_max and col_min/col_max.
+    Positions increase in the (drow, dcol) direction. Cells off the
+    array are -9999. Also returns a function that converts array
+    rows and cols to (position, line)."""
     
-    # Check if the block fc exists and delete or throw an error       
-    if arcpy.Exists(block_fc):
-        if overwrite_data:
-            arcpy.Delete_management(block_fc)
+    nrows, ncols = z_array.shape
+    
+    # flip the array so the direction is south, east, or south east
+    if drow < 0:
+        z_array = z_array[::-1]
+        row_min, row_max = nrows - 1 - row_max, nrows - 1 - row_min
+    if dcol < 0:
+        z_array = z_array[:, ::-1]
+        col_min, col_max = ncols - 1 - col_max, ncols - 1 - col_min
+    
+    if drow == 0:
+        profiles = np.ascontiguousarray(z_array[row_min:row_max + 1].T)
+        line_min = row_min
+    elif dcol == 0:
+        profiles = np.ascontiguousarray(z_array[:, col_min:col_max + 1])
+        line_min = col_min
+    else:
+        # diagonal lines are keyed by col - row
+        line_min = col_min - row_max
+        nlines = col_max - row_min - line_min + 1
+        profiles = np.full((nrows, nlines), -9999, dtype=z_array.dtype)
+        for i in range(nrows):
+            c0 = max(line_min + i, 0)
+            c1 = min(line_min + nlines + i, ncols)
+            if c0 < c1:
+                profiles[i, c0 - line_min - i:c1 - line_min - i] = z_array[i, c0:c1]
+    
+    def to_profile(rows, cols):
+        if drow < 0: rows = nrows - 1 - rows
+        if dcol < 0: cols = ncols - 1 - cols
+        if drow == 0:
+            return cols, rows - line_min
+        if dcol == 0:
+            return rows, cols - line_min
+        return rows, cols - rows - line_min
+    
+    return profiles, to_profile
+
+def hull_push(profiles, H, top, j, backward):
+    """Adds position j to the upper convex hull of every raster line
+    where j has data. H holds the hull positions of each line and 
+    top the number of them. The backward hulls are swept toward 
+    lower positions and are stored farthest first, the forward hulls
+    nearest first. Either way the newest vertex is H[line, top - 1]."""
+    
+    zj = profiles[j]
+    valid = np.flatnonzero(zj > -9998)
+    lines = valid[top[valid] >= 2]
+    while len(lines):
+        j1 = H[lines, top[lines] - 1]
+        j2 = H[lines, top[lines] - 2]
+        z1 = profiles[j1, lines]
+        z2 = profiles[j2, lines]
+        # j1 stays if it is above the line from j2 to j
+        if backward:
+            keep = (z1 - zj[lines]) * (j2 - j) > (z2 - zj[lines]) * (j1 - j)
+        else:
+            keep = (z1 - z2) * (j - j2) > (zj[lines] - z2) * (j1 - j2)
+        lines = lines[~keep]
+        top[lines] = top[lines] - 1
+        lines = lines[top[lines] >= 2]
+    H[valid, top[valid]] = j
+    top[valid] = top[valid] + 1
+
+def hull_tangent(profiles, H, top, i, lines, z, backward):
+    """Binary searches the hull of each raster line for the vertex 
+    with the steepest slope from an observer at position i with 
+    elevation z. Ties go to the nearest vertex. Returns the positions,
+    -1 where the hull is empty."""
+    
+    size = top[lines]
+    lo = np.zeros(len(lines), dtype=int)
+    hi = size - 1
+    last = H.shape[1] - 1
+    active = lo < hi
+    while active.any():
+        m = (lo + hi) // 2
+        # k1 is the nearer of the two vertices
+        if backward:
+            k1 = size - 1 - m
+            k2 = k1 - 1
         else:
-            arcpy.AddMessage("\nThis output already exists: \n" +
-                           "{0}\n".format(block_fc) + 
-                           "overwrite data = False. New data will be " +
-                           "appended to the existing feature class.")
-            print("This output already exists: \n" +
-                           "{0}\n".format(block_fc) + 
-                           "overwrite data = False. New data will be " +
-                           "appended to the existing feature class.")
-    
-    if overwrite_data: 
-        env.overwriteOutput = True
+            k1 = m
+            k2 = m + 1
+        j1 = H[lines, np.clip(k1, 0, last)]
+        j2 = H[lines, np.clip(k2, 0, last)]
+        farther = ((profiles[j1, lines] - z) * (j2 - i) <
+                   (profiles[j2, lines] - z) * (j1 - i))
+        lo = np.where(active & farther, m + 1, lo)
+        hi = np.where(active & ~farther, m, hi)
+        active = lo < hi
+    if backward:
+        k = size - 1 - lo
     else:
-        env.overwriteOutput = False    
+        k = lo
+    return np.where(size > 0, H[lines, np.clip(k, 0, last)], -1)
+
+def sweep_horizon(profiles, L, i_start, i_stop, q_pos, q_line, q_z):
+    """For every raster line (column of profiles) and every position i
+    from i_start to i_stop - 1 finds the position j within i + 1 to 
+    i + L with the steepest slope from i. This is always a vertex of 
+    the upper convex hull of the profile ahead of i, so the lines are
+    swept keeping that hull and each position is answered with a 
+    binary search for the tangent point. All the lines are swept 
+    together as arrays so each step is a few numpy calls. The profile
+    is split into chunks of length L. The search window of each 
+    position in a chunk is the rest of the chunk (swept backward) 
+    plus the start of the next chunk (swept forward). Ties go to the 
+    nearest position.
     
-    # Determine input point spatial units
-    proj = arcpy.Describe(nodes_fc).spatialReference
-    proj_ele = arcpy.Describe(z_raster).spatialReference
-
-    # Check to make sure the raster and input 
-    # points are in the same projection.
-    if proj.name != proj_ele.name:
-        arcpy.AddError("{0} and {1} do not have ".format(nodes_fc,z_raster)+
-                       "the same projection. Please reproject your data.")
-        sys.exit("Input points and elevation raster do not have the "+
-                 "same projection. Please reproject your data.")
-
-    # Get the units conversion factors
-    con_z_to_m = from_z_units_to_meters_con(z_units)    
-    con_to_m = to_meters_con(nodes_fc)
-    con_from_m = from_meters_con(nodes_fc)
-    searchDistance_max_m = searchDistance_max_km * 1000 # in meters
-    
-    # search distance in units of the fc
-    searchDistance_max = int(con_from_m * searchDistance_max_m)
-    
-    # convert block size from km to meters to units of the node fc
-    # in the future block size should be estimated based on availiable memory
-    # memorysize = datatypeinbytes*nobands*block_size^2
-    # block_size = int(sqrt(memorysize/datatypeinbytes*nobands))
-    if block_size in ["#", ""]:
-        block_size = int(con_from_m * 5000)
+    q_pos, q_line, and q_z are extra observers at a position and line
+    with an elevation other than the cell's. Returns an array of j
+    for every position and line and a second one for the extra 
+    observers, -1 where the whole search window is no data."""
+    
+    n, nlines = profiles.shape
+    all_lines = np.arange(nlines)
+    best = np.full((i_stop - i_start, nlines), -1, dtype=np.int32)
+    q_best = np.full(len(q_pos), -1, dtype=int)
+    
+    # the extra observers at each position
+    q_dict = defaultdict(list)
+    for q, i in enumerate(q_pos):
+        q_dict[i].append(q)
+    
+    # hull vertices of each line, there are never more than L
+    H = np.zeros((nlines, L + 1), dtype=int)
+    top = np.zeros(nlines, dtype=int)
+    
+    def observers(i):
+        q = np.array(q_dict.get(i, []), dtype=int)
+        lines = np.concatenate((all_lines, np.asarray(q_line, dtype=int)[q]))
+        z = np.concatenate((profiles[i], np.asarray(q_z, dtype=profiles.dtype)[q]))
+        return q, lines, z
+    
+    for k0 in range(i_start, i_stop, L):
+        k1 = min(k0 + L, n)
+        
+        # Backward sweep over the chunk
+        top[:] = 0
+        for i in range(k1 - 1, k0 - 1, -1):
+            if i < i_stop:
+                q, lines, z = observers(i)
+                j = hull_tangent(profiles, H, top, i, lines, z, True)
+                best[i - i_start] = j[:nlines]
+                q_best[q] = j[nlines:]
+            hull_push(profiles, H, top, i, True)
+        
+        # Forward sweep over the part of the search 
+        # window that is in the next chunk.
+        top[:] = 0
+        j_next = k1
+        for i in range(k0, min(k1, i_stop)):
+            j_end = min(i + L, n - 1)
+            while j_next <= j_end:
+                hull_push(profiles, H, top, j_next, False)
+                j_next = j_next + 1
+            if j_next == k1: continue
+            q, lines, z = observers(i)
+            j = hull_tangent(profiles, H, top, i, lines, z, False)
+            jb = np.concatenate((best[i - i_start], q_best[q]))
+            zj = profiles[np.maximum(j, 0), lines]
+            zb = profiles[np.maximum(jb, 0), lines]
+            better = (j >= 0) & ((jb < 0) | ((zj - z) * (jb - i) > (zb - z) * (j - i)))
+            jb = np.where(better, j, jb)
+            best[i - i_start] = jb[:nlines]
+            q_best[q] = jb[nlines:]
+    
+    return best, q_best
+
+def get_sweep_topo_angles(nodeDict, block_extent, nodes_in_block, z_raster,
+                          azimuths, azimuthdisdict, searchDistance_max,
+                          searchDistance_max_m, con_z_to_m):
+    """Sweep engine. For each azimuth the elevation array is read for
+    the block extended by the search distance in that direction. The
+    topographic angle position is found for every cell in the block
+    with sweep_horizon() and the nodes are sampled from the result.
+    The node elevation (Z_NODE) is the observer height, nodes that
+    are not at the elevation of their cell are looked up with their
+    own observer in the same sweep. Cost depends on the number of 
+    cells in the block, not the number of nodes. Azimuths that do 
+    not follow the raster grid are sampled with march_rays(). Returns
+    the topo samples in the same form as get_topo_angles()."""
+    
+    reader = open_raster(z_raster, raster_backend)
+    x_cellsize = float(reader.get_property("CELLSIZEX"))
+    y_cellsize = float(reader.get_property("CELLSIZEY"))
+    
+    topo_samples = []
+    for a in azimuths:
+        cellsize = azimuthdisdict[a]
+        
+        if grid_direction(a) is None:
+            # extend the block to the end of the topo lines
+            dx = searchDistance_max * sin(radians(a))
+            dy = searchDistance_max * cos(radians(a))
+            window = (min(block_extent[0], block_extent[0] + dx),
+                      min(block_extent[1], block_extent[1] + dy),
+                      max(block_extent[2], block_extent[2] + dx),
+                      max(block_extent[3], block_extent[3] + dy))
+            (z_array, block_x_min, block_y_max,
+             x_cellsize, y_cellsize) = read_block_array(window, z_raster, con_z_to_m)
+            block_samples = [[nodeID, nodeDict[nodeID]["STREAM_ID"], a,
+                              nodeDict[nodeID]["Z_NODE"],
+                              nodeDict[nodeID]["POINT_X"],
+                              nodeDict[nodeID]["POINT_Y"],
+                              None, None, 0, searchDistance_max]
+                             for nodeID in nodes_in_block]
+            topo_samples.extend(march_rays(z_array, block_x_min, block_y_max,
+                                           x_cellsize, y_cellsize, block_samples,
+                                           azimuthdisdict, con_to_m,
+                                           searchDistance_max_m))
+            del z_array
+            continue
+        
+        drow, dcol = grid_direction(a)
+        
+        # number of steps in the search distance
+        L = len(build_search_array(0, searchDistance_max, cellsize, use_skippy=False))
+        
+        # extend the block in the azimuth direction
+        dx = dcol * (L + 1) * x_cellsize
+        dy = -drow * (L + 1) * y_cellsize
+        window = (min(block_extent[0], block_extent[0] + dx),
+                  min(block_extent[1], block_extent[1] + dy),
+                  max(block_extent[2], block_extent[2] + dx),
+                  max(block_extent[3], block_extent[3] + dy))
+        
+        (z_array, block_x_min, block_y_max,
+         x_cellsize, y_cellsize) = read_block_array(window, z_raster, con_z_to_m)
+        nrows, ncols = z_array.shape
+        
+        rows = []
+        cols = []
+        for nodeID in nodes_in_block:
+            xy = coord_to_array(nodeDict[nodeID]["POINT_X"],
+                                nodeDict[nodeID]["POINT_Y"],
+                                block_x_min, block_y_max,
+                                x_cellsize, y_cellsize)
+            cols.append(min(max(xy[0], 0), ncols - 1))
+            rows.append(min(max(xy[1], 0), nrows - 1))
+        rows = np.array(rows)
+        cols = np.array(cols)
+        z_nodes = np.array([nodeDict[nodeID]["Z_NODE"] for nodeID in nodes_in_block],
+                           dtype=z_array.dtype)
+        
+        # every cell in the block
+        profiles, to_profile = profile_array(z_array, drow, dcol, rows.min(), rows.max(),
+                                             cols.min(), cols.max())
+        del z_array
+        pos, line = to_profile(rows, cols)
+        i_start = pos.min()
+        i_stop = pos.max() + 1
+        n = len(profiles)
+        
+        # nodes not at the elevation of their cell are extra observers
+        extra = np.flatnonzero(np.abs(profiles[pos, line] - z_nodes) >= 0.001)
+        
+        best, q_best = sweep_horizon(profiles, L, i_start, i_stop,
+                                     pos[extra], line[extra], z_nodes[extra])
+        j_nodes = best[pos - i_start, line].astype(int)
+        j_nodes[extra] = q_best
+        
+        # count of no data cells ahead of each node for NA_SAMPLES. 
+        # Samples past the end of the array count as off raster.
+        na_array = profiles < -9998
+        off_rastersamples = [na_array[i + 1:i + L + 1, ln].sum() + max(0, i + L - (n - 1))
+                             for i, ln in zip(pos, line)]
+        
+        for k, nodeID in enumerate(nodes_in_block):
+            i = pos[k]
+            j = j_nodes[k]
+            z_node = nodeDict[nodeID]["Z_NODE"]
+            if j < 0:
+                # The whole search window is no data
+                j = i + 1
+                topoAngle = -9999
+                z_topo = -9999
+                topoAngleDistance = cellsize
+            else:
+                z_topo = profiles[j, line[k]]
+                topoAngleDistance = (j - i) * cellsize
+                topoAngle = np.degrees(np.arctan((z_topo - z_node) /
+                                                 (topoAngleDistance * con_to_m)))
+            # elevation change between topo angle location and node elevation
+            z_change = z_topo - z_node
+            
+            node_x = nodeDict[nodeID]["POINT_X"]
+            node_y = nodeDict[nodeID]["POINT_Y"]
+            topoAngle_x = node_x + (j - i) * dcol * x_cellsize
+            topoAngle_y = node_y - (j - i) * drow * y_cellsize
+            topoAngleDistance_m = topoAngleDistance * con_to_m
+            
+            topo_samples.append([topoAngle_x, topoAngle_y,
+                                 topoAngle_x, topoAngle_y,
+                                 nodeDict[nodeID]["STREAM_ID"], nodeID, a,
+                                 topoAngle, z_topo,
+                                 z_node, z_change,
+                                 topoAngleDistance_m,
+                                 searchDistance_max_m,
+                                 off_rastersamples[k]])
+        del profiles, best
+        
+    return topo_samples
+
+def morton_key(col, row):
+    """Returns the Morton (Z order) key for a col and row by
+    interleaving their bits"""
+
+    key = 0
+    bit = 0
+    while col >> bit or row >> bit:
+        key = key | (((col >> bit) & 1) << (2 * bit)) | (((row >> bit) & 1) << (2 * bit + 1))
+        bit = bit + 1
+    return key
+
+def morton_sort(nodeDict, x_min, y_max, x_cellsize, y_cellsize):
+    """Returns a list of the nodeIDs sorted in Morton (Z order) of
+    the raster cell each node is in so nodes near each other in
+    space are near each other in the list"""
+
+    keys = []
+    for nodeID in nodeDict:
+        col = max(int((nodeDict[nodeID]["POINT_X"] - x_min) / x_cellsize), 0)
+        row = max(int((y_max - nodeDict[nodeID]["POINT_Y"]) / y_cellsize), 0)
+        keys.append((morton_key(col, row), nodeID))
+    keys.sort()
+    return [nodeID for key, nodeID in keys]
+
+def create_tile_cache(z_raster, con_z_to_m, tile_cache_mb, tile_size=512,
+                      backend=None):
+    """Returns a dictionary holding the raster properties and an
+    empty least recently used (LRU) cache of square elevation tiles.
+    The number of tiles kept is set so the cache uses about
+    tile_cache_mb megabytes. backend defaults to raster_backend."""
+
+    tile_cache = {}
+    tile_cache["z_raster"] = z_raster
+    tile_cache["backend"] = backend or raster_backend
+    tile_cache["reader"] = open_raster(z_raster, tile_cache["backend"])
+    tile_cache["con_z_to_m"] = con_z_to_m
+    tile_cache["tile_size"] = tile_size
+    reader = tile_cache["reader"]
+    tile_cache["x_min"] = float(reader.get_property("LEFT"))
+    tile_cache["y_max"] = float(reader.get_property("TOP"))
+    tile_cache["x_cellsize"] = float(reader.get_property("CELLSIZEX"))
+    tile_cache["y_cellsize"] = float(reader.get_property("CELLSIZEY"))
+    tile_cache["nrows"] = int(reader.get_property("ROWCOUNT"))
+    tile_cache["ncols"] = int(reader.get_property("COLUMNCOUNT"))
+    tile_cache["ntile_cols"] = int(ceil(tile_cache["ncols"] / tile_size))
+
+    # read one cell to get the array data type
+    y_min = tile_cache["y_max"] - tile_cache["nrows"] * tile_cache["y_cellsize"]
+    z_cell = reader.read_numpy(tile_cache["x_min"] + tile_cache["x_cellsize"] / 2,
+                               y_min + tile_cache["y_cellsize"] / 2,
+                               1, 1, -9999 / con_z_to_m) * con_z_to_m
+    tile_cache["dtype"] = z_cell.dtype
+
+    tile_nbytes = tile_size * tile_size * z_cell.dtype.itemsize
+    tile_cache["max_tiles"] = max(int(tile_cache_mb * 1024 * 1024 / tile_nbytes), 1)
+    tile_cache["tiles"] = OrderedDict()
+    tile_cache["reads"] = 0
+    tile_cache["cells"] = 0
+    return tile_cache
+
+def read_tile(tile_cache, tile_row, tile_col):
+    """Reads one tile of the elevation raster into a numpy array
+    in units of meters. Cells past the raster edge are -9999."""
+
+    ts = tile_cache["tile_size"]
+    row0 = tile_row * ts
+    col0 = tile_col * ts
+    nrows = min(ts, tile_cache["nrows"] - row0)
+    ncols = min(ts, tile_cache["ncols"] - col0)
+
+    # lower left cell center of the tile
+    x = tile_cache["x_min"] + (col0 + 0.5) * tile_cache["x_cellsize"]
+    y = tile_cache["y_max"] - (row0 + nrows - 0.5) * tile_cache["y_cellsize"]
+
+    try:
+        z_array = tile_cache["reader"].read_numpy(x, y, ncols, nrows,
+                                                  -9999 / tile_cache["con_z_to_m"])
+    except:
+        tbinfo = traceback.format_exc()
+        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the tile cache size"
+        sys.exit(pymsg)
+
+    tile = np.full((ts, ts), -9999, dtype=tile_cache["dtype"])
+    if tile_cache["con_z_to_m"] == 1:
+        tile[:nrows, :ncols] = z_array
+    else:
+        tile[:nrows, :ncols] = z_array * tile_cache["con_z_to_m"]
+    tile_cache["reads"] = tile_cache["reads"] + 1
+    return tile
+
+def get_tile(tile_cache, tile_row, tile_col):
+    """Returns the tile from the cache, reading it if needed. The
+    least recently used tile is removed when the cache is full."""
+
+    tiles = tile_cache["tiles"]
+    key = (tile_row, tile_col)
+    if key in tiles:
+        # move to the most recently used end
+        tile = tiles.pop(key)
+    else:
+        tile = read_tile(tile_cache, tile_row, tile_col)
+        while len(tiles) >= tile_cache["max_tiles"]:
+            tiles.popitem(last=False)
+    tiles[key] = tile
+    return tile
+
+def sample_tiles(tile_cache, rows, cols):
+    """Returns the elevations at the raster rows and cols. The
+    samples are grouped by tile so each tile is fetched once."""
+
+    ts = tile_cache["tile_size"]
+    z_topo_array = np.full(rows.shape, -9999, dtype=tile_cache["dtype"])
+
+    inside = ((rows >= 0) & (rows < tile_cache["nrows"]) &
+              (cols >= 0) & (cols < tile_cache["ncols"]))
+    rows_in = rows[inside]
+    cols_in = cols[inside]
+    z_in = np.empty(rows_in.shape, dtype=tile_cache["dtype"])
+    tile_cache["cells"] = tile_cache["cells"] + len(rows_in)
+
+    keys = (rows_in // ts) * tile_cache["ntile_cols"] + (cols_in // ts)
+    order = np.argsort(keys, kind="mergesort")
+    edges = np.flatnonzero(np.diff(keys[order])) + 1
+    for idx in np.split(order, edges):
+        if len(idx) == 0: continue
+        tile = get_tile(tile_cache, rows_in[idx[0]] // ts, cols_in[idx[0]] // ts)
+        z_in[idx] = tile[rows_in[idx] % ts, cols_in[idx] % ts]
+
+    z_topo_array[inside] = z_in
+    return z_topo_array
+
+def build_max_pyramid(tile_cache, cells=16):
+    """Returns a dictionary with the maximum and minimum elevation in
+    meters of each cells x cells square of the raster and of each 
+    coarser level made by merging 2 x 2 squares, up to the tile size.
+    The levels are a list of [cells, z_max, z_min] from finest to 
+    coarsest. The raster is read once in strips one tile high.
+    Squares with a cell past the raster edge or with no data have a
+    z_min of -9999."""
+
+    reader = tile_cache["reader"]
+    con_z_to_m = tile_cache["con_z_to_m"]
+    ts = tile_cache["tile_size"]
+    nrows = tile_cache["nrows"]
+    ncols = tile_cache["ncols"]
+    dtype = tile_cache["dtype"]
+    if dtype.kind == "f":
+        z_high = np.inf
     else:
-        block_size = int(con_from_m * block_size * 1000)    
+        z_high = np.iinfo(dtype).max
+
+    strip_rows = max(ts // cells, 1) * cells
+    ncols_pad = int(ceil(ncols / cells)) * cells
+    z_max = []
+    z_min = []
+    for row0 in range(0, nrows, strip_rows):
+        n = min(strip_rows, nrows - row0)
+        z_array = reader.read_window(row0, 0, n, ncols, -9999 / con_z_to_m)
+        strip = np.full((int(ceil(n / cells)) * cells, ncols_pad), -9999, dtype=dtype)
+        # same conversion as read_tile() so the values match the tiles
+        if con_z_to_m == 1:
+            strip[:n, :ncols] = z_array
+        else:
+            strip[:n, :ncols] = z_array * con_z_to_m
+        squares = strip.reshape(strip.shape[0] // cells, cells, ncols_pad // cells, cells)
+        z_max.append(squares.max(axis=(1, 3)))
+        # cells past the edge are not in the raster
+        strip[n:, :] = z_high
+        strip[:, ncols:] = z_high
+        z_min.append(squares.min(axis=(1, 3)))
+        tile_cache["cells"] = tile_cache["cells"] + n * ncols
+        del z_array, strip, squares
+
+    levels = [[cells, np.vstack(z_max), np.vstack(z_min)]]
+    while levels[-1][0] * 2 <= ts and max(levels[-1][1].shape) > 1:
+        cells, z_max, z_min = levels[-1]
+        nr = int(ceil(z_max.shape[0] / 2.0)) * 2
+        nc = int(ceil(z_max.shape[1] / 2.0)) * 2
+        z_max_pad = np.full((nr, nc), -9999, dtype=dtype)
+        z_min_pad = np.full((nr, nc), z_high, dtype=dtype)
+        z_max_pad[:z_max.shape[0], :z_max.shape[1]] = z_max
+        z_min_pad[:z_min.shape[0], :z_min.shape[1]] = z_min
+        levels.append([cells * 2,
+                       z_max_pad.reshape(nr // 2, 2, nc // 2, 2).max(axis=(1, 3)),
+                       z_min_pad.reshape(nr // 2, 2, nc // 2, 2).min(axis=(1, 3))])
+
+    return {"levels": levels, "nrows": nrows, "ncols": ncols, "dtype": dtype}
+
+def get_max_pyramid(tile_cache, pyramid_dir=None, cells=16):
+    """Returns the max elevation pyramid of the tile cache raster
+    (see build_max_pyramid). If pyramid_dir is a folder the pyramid 
+    is saved there and read by later runs on the same raster. 
+    Pyramids made from an older version of the raster are deleted."""
+
+    if pyramid_dir in ["#", "", None]:
+        return build_max_pyramid(tile_cache, cells)
+
+    if not os.path.exists(pyramid_dir):
+        os.makedirs(pyramid_dir)
+
+    z_raster = tile_cache["z_raster"]
+    base = os.path.splitext(os.path.basename(z_raster))[0]
+    path_hash = md5(os.path.normcase(os.path.abspath(z_raster)).encode("utf-8")).hexdigest()[:8]
+    prefix = "{0}_{1}_maxpyr{2}_z{3:g}_".format(base, path_hash, cells,
+                                               tile_cache["con_z_to_m"]).replace(".", "_")
+    fingerprint = raster_fingerprint(z_raster, tile_cache["backend"])
+    pyramid_file = os.path.join(pyramid_dir, prefix + fingerprint[:12] + ".npz")
+
+    for name in os.listdir(pyramid_dir):
+        if name.startswith(prefix) and os.path.join(pyramid_dir, name) != pyramid_file:
+            os.remove(os.path.join(pyramid_dir, name))
+
+    if os.path.exists(pyramid_file):
+        with np.load(pyramid_file) as data:
+            levels = [[int(data["cells"][k]), data["max{0}".format(k)],
+                       data["min{0}".format(k)]] for k in range(len(data["cells"]))]
+        return {"levels": levels, "nrows": tile_cache["nrows"],
+                "ncols": tile_cache["ncols"], "dtype": tile_cache["dtype"]}
+
+    z_pyramid = build_max_pyramid(tile_cache, cells)
+    arrays = {"cells": np.array([level[0] for level in z_pyramid["levels"]])}
+    for k, (c, z_max, z_min) in enumerate(z_pyramid["levels"]):
+        arrays["max{0}".format(k)] = z_max
+        arrays["min{0}".format(k)] = z_min
+
+    # write to a temp file and rename so a crash leaves no partial file
+    temp_file = pyramid_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.rename(temp_file, pyramid_file)
+    return z_pyramid
+
+def bounded_samples(z_pyramid, sample_z, rows, cols, valid, z_nodes, distance_array_m):
+    """Returns the elevations at the raster rows and cols of the 
+    topo lines and a mask of the samples that were not read. The 
+    pyramid squares are checked from coarsest to finest. A sample 
+    is not read when the slope to the highest cell of its square is
+    less than the slope to a sample already read on the same topo 
+    line, so it can never be the maximum topo angle. The first sample
+    read on each line is the one with the steepest coarse bound. 
+    Samples in squares with no data cells are always read so the 
+    off raster counts do not change. Samples not read are -9999."""
+
+    dtype = z_pyramid["dtype"]
+    z_topo_array = np.full(rows.shape, -9999, dtype=dtype)
+    skipped = np.zeros(rows.shape, dtype=bool)
+
+    inside = (valid & (rows >= 0) & (rows < z_pyramid["nrows"]) &
+              (cols >= 0) & (cols < z_pyramid["ncols"]))
+    line, step = np.nonzero(inside)
+    if len(line) == 0:
+        return z_topo_array, skipped
+    r = rows[line, step]
+    c = cols[line, step]
+    z_node = np.array(z_nodes, dtype=dtype)[line]
+    d = distance_array_m[line, step]
+
+    # Slopes are compared in place of the angles using the same
+    # arithmetic as march_rays(). The small margin keeps samples 
+    # whose angle could round to a tie with the sample read.
+    slope_read = None
+    for cells, z_max, z_min in reversed(z_pyramid["levels"]):
+        slope_max = (z_max[r // cells, c // cells] - z_node) / d
+        if slope_read is None:
+            order = np.lexsort((-slope_max, line))
+            first = order[np.append(True, line[order][1:] != line[order][:-1])]
+            z_first = sample_z(r[first], c[first])
+            slope_first = (z_first - z_node[first]) / d[first]
+            slope_first[z_first < -9998] = -np.inf
+            slope_read = np.full(rows.shape[0], -np.inf)
+            slope_read[line[first]] = slope_first
+            slope_read = slope_read - (np.abs(slope_read) * 1e-9 + 1e-12)
+        keep = ((slope_max >= slope_read[line]) |
+                (z_min[r // cells, c // cells] < -9998))
+        skipped[line[~keep], step[~keep]] = True
+        line, step, r, c, z_node, d = [v[keep] for v in (line, step, r, c, z_node, d)]
+
+    z_topo_array[line, step] = sample_z(r, c)
+    return z_topo_array, skipped
+
+def get_stream_topo_angles(nodeDict, nodes_in_batch, tile_cache, azimuths,
+                           azimuthdisdict, searchDistance_max,
+                           searchDistance_max_m, skippy_max_error=0,
+                           z_pyramid=None):
+    """Calculates the topo angles for every topo line of the nodes
+    in the batch. Each topo line is sampled over its full length
+    with the elevations read from the tile cache so the nodes are
+    finished in one pass. z_pyramid is the optional max elevation 
+    pyramid used to skip samples. Returns the topo samples in the 
+    same form as get_topo_angles()."""
+
+    node_samples = []
+    for nodeID in nodes_in_batch:
+        for a in azimuths:
+            node_samples.append([nodeID, nodeDict[nodeID]["STREAM_ID"], a,
+                                 nodeDict[nodeID]["Z_NODE"],
+                                 nodeDict[nodeID]["POINT_X"],
+                                 nodeDict[nodeID]["POINT_Y"],
+                                 None, None, 0, searchDistance_max])
+
+    return march_rays(None, tile_cache["x_min"], tile_cache["y_max"],
+                      tile_cache["x_cellsize"], tile_cache["y_cellsize"],
+                      node_samples, azimuthdisdict, con_to_m,
+                      searchDistance_max_m, skippy_max_error=skippy_max_error,
+                      sample_z=lambda rows, cols: sample_tiles(tile_cache, rows, cols),
+                      z_pyramid=z_pyramid)
+
+def pyramid_benchmark(n_nodes=200, cellsize=2.0, searchDistance_max=2000,
+                      tile_size=128, tile_cache_mb=1, seed=1):
+    """Runs the "stream" engine on synthetic ridged terrain with and
+    without the max elevation pyramid. Checks the topo angles, 
+    distances, elevations, and off raster counts are the same and 
+    prints the elevation samples and tiles read. The pyramid build
+    reads every cell once and is counted separately because it is
+    saved in horizon_cache_dir. Returns a list of
+    [samples read, tiles read] without and with the pyramid."""
+
+    azimuths = [45,90,135,180,225,270,315,365]
+    azimuthdisdict = dict((a, azimuth_cellsize(a, cellsize, cellsize)) for a in azimuths)
+
+    # The nodes are in a square in the middle with room for the 
+    # longest topo line on all sides, except the last node is near
+    # the edge so some topo lines run off the raster
+    margin = int(ceil(searchDistance_max / cellsize)) + 2
+    ncells = 2 * margin + 100
+    z_array = ridged_terrain(ncells, ncells, cellsize, seed)
+    block_y_max = ncells * cellsize
+    register_array("pyramid_benchmark", z_array, 0, block_y_max, cellsize)
+
+    rng = np.random.RandomState(seed)
+    node_samples = []
+    for nodeID in range(n_nodes):
+        row = rng.randint(margin, ncells - margin)
+        col = rng.randint(margin, ncells - margin)
+        if nodeID == n_nodes - 1:
+            row = 10
+        node_x = (col + 0.5) * cellsize
+        node_y = block_y_max - (row + 0.5) * cellsize
+        for a in azimuths:
+            node_samples.append([nodeID, 0, a, z_array[row, col],
+                                 node_x, node_y, None, None,
+                                 0, searchDistance_max])
+
+    def run(use_pyramid):
+        tile_cache = create_tile_cache("pyramid_benchmark", 1.0, tile_cache_mb,
+                                       tile_size, "numpy")
+        z_pyramid = None
+        if use_pyramid:
+            z_pyramid = build_max_pyramid(tile_cache)
+            print("Pyramid build: {0} cells".format(tile_cache["cells"]))
+            tile_cache["cells"] = 0
+        topo_samples = march_rays(None, 0, block_y_max, cellsize, cellsize,
+                                  node_samples, azimuthdisdict, 1.0,
+                                  searchDistance_max,
+                                  sample_z=lambda rows, cols: sample_tiles(tile_cache, rows, cols),
+                                  z_pyramid=z_pyramid)
+        return tile_cache["cells"], tile_cache["reads"], topo_samples
+
+    cells_all, reads_all, samples_all = run(False)
+    cells_pyr, reads_pyr, samples_pyr = run(True)
+
+    for field in [7, 8, 11, 13]:
+        assert [s[field] for s in samples_all] == [s[field] for s in samples_pyr], \
+            "The max elevation pyramid changed the topo samples"
+    assert cells_pyr < cells_all, "The max elevation pyramid did not skip any samples"
+
+    print("{0} topo lines, the same results with and without the pyramid".format(len(node_samples)))
+    print("Without pyramid: {0} samples read, {1} tiles read".format(cells_all, reads_all))
+    print("With pyramid: {0} samples read ({1:.1f}%), {2} tiles read".format(
+        cells_pyr, 100.0 * cells_pyr / cells_all, reads_pyr))
+    return [[cells_all, reads_all], [cells_pyr, reads_pyr]]
+
+def engine_benchmark(n_nodes=60, cellsize=6.0, searchDistance_max_km=0.5,
+                     block_size_km=0.3, seed=1):
+    """Runs the rays, sweep, and stream engines on synthetic ridged
+    terrain with the coordinates and elevations in feet. Checks the
+    topo angle (TOPOANGLE), the distance to it (TOPODIS), the search
+    distance (SEARCHDIS), and the off raster count (NA_SAMPLES) are
+    the same from every engine and prints the run times. The engines
+    read the terrain with the "numpy" raster backend. Returns a 
+    dictionary of the seconds for each engine."""
+
+    # The engine functions use the module unit conversion and backend
+    global con_to_m, raster_backend
+    con_to_m = 0.3048
+    con_z_to_m = 0.3048
+    raster_backend = "numpy"
+    searchDistance_max_m = searchDistance_max_km * 1000
+    searchDistance_max = int(searchDistance_max_m / con_to_m)
+    block_size = int(block_size_km * 1000 / con_to_m)
+
+    azimuths = [45,90,135,180,225,270,315,365]
+    azimuthdisdict = dict((a, azimuth_cellsize(a, cellsize, cellsize)) for a in azimuths)
+
+    # The nodes are in a square in the middle. Topo lines that reach
+    # the raster edge or the no data band have off raster samples.
+    margin = int(ceil(searchDistance_max / cellsize)) // 2
+    ncells = 2 * margin + 100
+    z_array = ridged_terrain(ncells, ncells, cellsize * con_to_m, seed) / con_to_m
+    z_array[margin // 2:margin // 2 + 5, :] = -9999
+    block_y_max = ncells * cellsize
+    register_array("engine_benchmark", z_array, 0, block_y_max, cellsize, nodata=-9999)
+
+    rng = np.random.RandomState(seed)
+    nodeDict = nested_dict()
+    for nodeID in range(n_nodes):
+        row = rng.randint(margin, ncells - margin)
+        col = rng.randint(margin, ncells - margin)
+        nodeDict[nodeID]["STREAM_ID"] = 0
+        nodeDict[nodeID]["POINT_X"] = (col + 0.5) * cellsize
+        nodeDict[nodeID]["POINT_Y"] = block_y_max - (row + 0.5) * cellsize
+        nodeDict[nodeID]["Z_NODE"] = float(z_array[row, col]) * con_z_to_m
+    nodeIDs = list(range(n_nodes))
 
-    # Get the elevation raster cell size in units of the raster
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
+    results = {}
+    seconds = {}
+
+    # rays keeps the largest topo angle from the blocks of each
+    # line and sums the off raster samples, the same as main()
+    t0 = time.time()
+    blockDict = create_blocks(nodeDict, block_size, azimuths, searchDistance_max)
+    results["rays"] = {}
+    for blockID in sorted(blockDict.keys()):
+        for sample in get_topo_angles(nodeDict, blockDict[blockID]["extent"],
+                                      sorted(blockDict[blockID]["samples"]),
+                                      "engine_benchmark", azimuthdisdict,
+                                      searchDistance_max_m, con_z_to_m):
+            key = (sample[5], sample[6])
+            if key not in results["rays"]:
+                results["rays"][key] = sample
+            elif results["rays"][key][7] < sample[7]:
+                sample[13] = sample[13] + results["rays"][key][13]
+                results["rays"][key] = sample
+            else:
+                results["rays"][key][13] = results["rays"][key][13] + sample[13]
+    seconds["rays"] = time.time() - t0
+
+    t0 = time.time()
+    results["sweep"] = {}
+    for block_extent, nodes_in_block in create_node_blocks(nodeDict, block_size):
+        for sample in get_sweep_topo_angles(nodeDict, block_extent, sorted(nodes_in_block),
+                                            "engine_benchmark", azimuths, azimuthdisdict,
+                                            searchDistance_max, searchDistance_max_m,
+                                            con_z_to_m):
+            results["sweep"][(sample[5], sample[6])] = sample
+    seconds["sweep"] = time.time() - t0
+
+    t0 = time.time()
+    tile_cache = create_tile_cache("engine_benchmark", con_z_to_m, 64)
+    results["stream"] = {}
+    for sample in get_stream_topo_angles(nodeDict, nodeIDs, tile_cache, azimuths,
+                                         azimuthdisdict, searchDistance_max,
+                                         searchDistance_max_m):
+        results["stream"][(sample[5], sample[6])] = sample
+    seconds["stream"] = time.time() - t0
+
+    keys = sorted(results["rays"].keys())
+    assert len(keys) == n_nodes * len(azimuths), "The rays engine missed topo lines"
+    for engine in ["sweep", "stream"]:
+        assert sorted(results[engine].keys()) == keys, \
+            "The {0} engine missed topo lines".format(engine)
+        for field, name, tolerance in [(7, "TOPOANGLE", 1e-4), (11, "TOPODIS", 1e-6),
+                                       (12, "SEARCHDIS", 1e-6), (13, "NA_SAMPLES", 0)]:
+            rays = np.array([results["rays"][key][field] for key in keys], dtype=float)
+            other = np.array([results[engine][key][field] for key in keys], dtype=float)
+            assert np.abs(rays - other).max() <= tolerance, \
+                "{0} from the {1} engine is not the same as rays".format(name, engine)
+
+    print("{0} topo lines, the same results from every engine".format(len(keys)))
+    for engine in ["rays", "sweep", "stream"]:
+        print("{0}: {1:.2f} seconds".format(engine, seconds[engine]))
+    return seconds
+
+def snap_nodes_to_cells(nodeDict, z_raster):
+    """Moves each node's x/y to the center of the raster cell it is
+    in and returns a dictionary of the raster cell index
+    (row * number of cols + col) for each nodeID"""
+
+    reader = open_raster(z_raster, raster_backend)
+    x_min = float(reader.get_property("LEFT"))
+    y_max = float(reader.get_property("TOP"))
+    x_cellsize = float(reader.get_property("CELLSIZEX"))
+    y_cellsize = float(reader.get_property("CELLSIZEY"))
+    ncols = int(reader.get_property("COLUMNCOUNT"))
+
+    nodeCells = {}
+    for nodeID in nodeDict:
+        col = int(floor((nodeDict[nodeID]["POINT_X"] - x_min) / x_cellsize))
+        row = int(floor((y_max - nodeDict[nodeID]["POINT_Y"]) / y_cellsize))
+        nodeDict[nodeID]["POINT_X"] = x_min + (col + 0.5) * x_cellsize
+        nodeDict[nodeID]["POINT_Y"] = y_max - (row + 0.5) * y_cellsize
+        nodeCells[nodeID] = row * ncols + col
+    return nodeCells
+
+def get_horizon_cache_file(horizon_cache_dir, z_raster, fingerprint, a,
+                           searchDistance_max, skippy_max_error, topo_engine,
+                           con_z_to_m):
+    """Returns the path to the horizon cache file for the elevation
+    raster, azimuth, search distance, skippy max error, topo engine,
+    and z unit conversion. Rasters with the same name in different
+    folders get different files. Cache files made from an older 
+    version of the raster are deleted."""
+
+    if not os.path.exists(horizon_cache_dir):
+        os.makedirs(horizon_cache_dir)
+
+    base = os.path.splitext(os.path.basename(z_raster))[0]
+    path_hash = md5(os.path.normcase(os.path.abspath(z_raster)).encode("utf-8")).hexdigest()[:8]
+    prefix = "{0}_{1}_hz{2:g}_d{3}_s{4:g}_{5}_z{6:g}_".format(base, path_hash, a,
+                                                             searchDistance_max,
+                                                             skippy_max_error,
+                                                             topo_engine,
+                                                             con_z_to_m).replace(".", "_")
+    cache_file = os.path.join(horizon_cache_dir, prefix + fingerprint[:12] + ".npz")
+
+    for name in os.listdir(horizon_cache_dir):
+        if name.startswith(prefix) and os.path.join(horizon_cache_dir, name) != cache_file:
+            os.remove(os.path.join(horizon_cache_dir, name))
+
+    return cache_file
+
+def read_horizon_cache(cache_file):
+    """Returns a dictionary of the horizon cache arrays sorted by
+    raster cell index, or None if there is no cache file"""
+
+    if not os.path.exists(cache_file):
+        return None
+
+    with np.load(cache_file) as data:
+        horizon = dict((k, data[k]) for k in data.files)
+    return horizon
+
+def write_horizon_cache(cache_file, new_samples):
+    """Adds the new horizon samples to the cache file. Each sample
+    is [cell, z_node, topoAngle, z_topo, topoAngleDistance_m,
+    off_rastersamples]. A new sample replaces any cached sample for
+    the same cell."""
+
+    fields = ["cell", "z_node", "angle", "z_topo", "distance_m", "na"]
+
+    new_array = np.array(new_samples, dtype=float)
+    horizon = dict((k, new_array[:, i]) for i, k in enumerate(fields))
+    horizon["cell"] = horizon["cell"].astype(np.int64)
+
+    old = read_horizon_cache(cache_file)
+    if old is not None:
+        for k in fields:
+            horizon[k] = np.concatenate((old[k], horizon[k]))
+
+    # keep the last sample for each cell, sorted by cell
+    order = np.argsort(horizon["cell"], kind="mergesort")
+    cells = horizon["cell"][order]
+    keep = order[np.append(cells[1:] != cells[:-1], True)]
+    for k in fields:
+        horizon[k] = horizon[k][keep]
+
+    # write to a temp file and rename so a crash keeps the old cache
+    temp_file = cache_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(f, **horizon)
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    os.rename(temp_file, cache_file)
+
+def add_horizon_samples(horizon_new, topo_samples, nodeCells):
+    """Adds the finished topo samples to the lists of new horizon
+    samples for each azimuth"""
+
+    for sample in topo_samples:
+        horizon_new[sample[6]].append((nodeCells[sample[5]], sample[9],
+                                       sample[7], sample[8], sample[11],
+                                       sample[13]))
+
+def get_cached_topo_samples(nodeDict, nodeCells, horizonDict, azimuths,
+                            searchDistance_max_m, con_to_m):
+    """Looks up each node's raster cell in the horizon cache. Returns
+    a dictionary of the topo samples, in the same form as
+    get_topo_angles(), for the nodes found for every azimuth. The
+    node elevation has to match the cached one."""
+
+    nodeIDs = nodeDict.keys()
+    cells = np.array([nodeCells[nodeID] for nodeID in nodeIDs], dtype=np.int64)
+    z_nodes = np.array([nodeDict[nodeID]["Z_NODE"] for nodeID in nodeIDs], dtype=float)
+
+    found = np.ones(len(nodeIDs), dtype=bool)
+    index = {}
+    for a in azimuths:
+        horizon = horizonDict[a]
+        if horizon is None or len(horizon["cell"]) == 0:
+            return {}
+        i = np.searchsorted(horizon["cell"], cells).clip(0, len(horizon["cell"]) - 1)
+        found = (found & (horizon["cell"][i] == cells) &
+                 (np.abs(horizon["z_node"][i] - z_nodes) < 0.001))
+        index[a] = i
+
+    cachedDict = {}
+    for n in np.flatnonzero(found):
+        nodeID = nodeIDs[n]
+        node_x = nodeDict[nodeID]["POINT_X"]
+        node_y = nodeDict[nodeID]["POINT_Y"]
+        z_node = nodeDict[nodeID]["Z_NODE"]
+        cachedDict[nodeID] = []
+        for a in azimuths:
+            horizon = horizonDict[a]
+            i = index[a][n]
+            topoAngleDistance = horizon["distance_m"][i] / con_to_m
+            topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
+            topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
+            cachedDict[nodeID].append([topoAngle_x, topoAngle_y,
+                                       topoAngle_x, topoAngle_y,
+                                       nodeDict[nodeID]["STREAM_ID"], nodeID, a,
+                                       horizon["angle"][i], horizon["z_topo"][i],
+                                       z_node, horizon["z_topo"][i] - z_node,
+                                       horizon["distance_m"][i],
+                                       searchDistance_max_m,
+                                       int(horizon["na"][i])])
+    return cachedDict
+
+def write_checkpoint(checkpoint_file, config, last_block, nodeIDs, nodeDict, addFields):
+    """Saves the index of the last completed block and the topo sample
+    at the maximum topo angle for each azimuth of the unfinished nodes
+    to a compressed numpy .npz file. The samples are one float array
+    with a row per node and azimuth. The STREAM_ID is left out because
+    it is read from the nodes fc on resume. The file is written to a 
+    temporary file and then renamed so a crash while writing keeps 
+    the previous checkpoint."""
     
-    if topo_directions == 2: # All directions
-        azimuths = [45,90,135,180,225,270,315,365]
-        last_azimuth = 45
-    else:        
-        azimuths = [270,180,90]
-        last_azimuth = 90
+    samples = []
+    for nodeID in nodeIDs:
+        for field in addFields:
+            if field + "_list" in nodeDict[nodeID]:
+                sample = nodeDict[nodeID][field + "_list"]
+                samples.append(sample[:4] + sample[5:])
+    
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(f, config=np.array(json.dumps(config, sort_keys=True)),
+                            last_block=np.array(last_block),
+                            nodeIDs=np.array(nodeIDs),
+                            samples=np.array(samples, dtype=float).reshape(-1, 13))
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    os.rename(temp_file, checkpoint_file)
 
-    azimuthdict = {45:"TOPO_NE",90:"TOPO_E",135:"TOPO_SE",
-                   180:"TOPO_S",225:"TOPO_SW",270:"TOPO_W",
-                   315:"TOPO_NW",365:"TOPO_N"}
+def read_checkpoint(checkpoint_file, config):
+    """Reads the checkpoint file and checks it was made with the 
+    same inputs as this run"""
+    
+    if not os.path.exists(checkpoint_file):
+        arcpy.AddError("\nThe checkpoint file does not exist: \n" +
+                       "{0}\n".format(checkpoint_file))
+        sys.exit("The checkpoint file does not exist: \n" +
+                 "{0}\n".format(checkpoint_file))
+    
+    with np.load(checkpoint_file) as data:
+        checkpoint = {"config": json.loads(str(data["config"])),
+                      "last_block": int(data["last_block"]),
+                      "nodeIDs": data["nodeIDs"].tolist(),
+                      "samples": data["samples"].tolist()}
+    
+    for k in config:
+        if checkpoint["config"].get(k) != config[k]:
+            arcpy.AddError("The checkpoint was made with a different " +
+                           "{0}. Cannot resume.".format(k))
+            sys.exit("The checkpoint was made with a different " +
+                     "{0}. Cannot resume.".format(k))
+    
+    return checkpoint
+
+def block_array_nbytes(block_extent, x_cellsize, y_cellsize):
+    """Returns the largest number of bytes the elevation array
+    read by read_block_array() can use for the block extent."""
+
+    ncols = int(ceil((block_extent[2] - block_extent[0]) / x_cellsize)) + 2
+    nrows = int(ceil((block_extent[3] - block_extent[1]) / y_cellsize)) + 2
+    return ncols * nrows * np.dtype(np.float64).itemsize
+
+def init_topo_worker(shared_z):
+    """Pool initializer. Keeps the shared elevation buffer in the
+    worker process."""
+
+    global worker_z
+    worker_z = shared_z
+
+def topo_worker(args):
+    """Calculates the topo angles for a chunk of the block's topo
+    lines in a worker process. The elevation array is a view of
+    the shared buffer so it is never copied into the worker."""
+
+    (shape, dtype, block_x_min, block_y_max,
+     x_cellsize, y_cellsize, block_samples, azimuthdisdict,
+     con_to_m, searchDistance_max_m, skippy_max_error) = args
+
+    z_array = np.frombuffer(worker_z, dtype=dtype,
+                            count=shape[0] * shape[1]).reshape(shape)
+
+    return march_rays(z_array, block_x_min, block_y_max,
+                      x_cellsize, y_cellsize, block_samples,
+                      azimuthdisdict, con_to_m, searchDistance_max_m,
+                      skippy_max_error=skippy_max_error)
+
+def get_topo_angles_parallel(pool, shared_z, processes, block_extent,
+                             block_samples, z_raster, azimuthdisdict,
+                             searchDistance_max_m, con_z_to_m,
+                             skippy_max_error=0):
+    """Same as get_topo_angles() but the topo lines are split across
+    the worker processes in the pool. The block's elevation array is
+    read once and copied into the shared buffer the workers read from.
+    The results come back to this process, which is the only one that
+    writes to the feature classes."""
+
+    (z_array, block_x_min, block_y_max,
+     x_cellsize, y_cellsize) = read_block_array(block_extent, z_raster, con_z_to_m)
+
+    # Blocks with no data are sampled too so their off raster
+    # samples are counted
+    shared_array = np.frombuffer(shared_z, dtype=z_array.dtype,
+                                 count=z_array.size).reshape(z_array.shape)
+    shared_array[:] = z_array
+
+    # a few chunks per process to even out the work
+    chunksize = int(ceil(len(block_samples) / (processes * 4)))
+    args = [(z_array.shape, z_array.dtype.str,
+             block_x_min, block_y_max, x_cellsize, y_cellsize,
+             block_samples[i:i + chunksize], azimuthdisdict,
+             con_to_m, searchDistance_max_m, skippy_max_error)
+            for i in range(0, len(block_samples), chunksize)]
+
+    topo_samples = []
+    for chunk_samples in pool.map(topo_worker, args):
+        topo_samples.extend(chunk_samples)
+
+    return topo_samples
+
+def main():
+    """Runs Step 4 with the inputs in the Start Fill in Data block"""
+    
+    # inputs that are changed here and the unit conversion
+    # used by the engine functions
+    global block_size, checkpoint_interval, processes, topo_engine, con_to_m
+    
+    #enable garbage collection
+    gc.enable()
+
+    if benchmark_skippy:
+        skippy_benchmark()
+        sys.exit()
+
+    if benchmark_pyramid:
+        pyramid_benchmark()
+        sys.exit()
+
+    if benchmark_engines:
+        engine_benchmark()
+        sys.exit()
+
+    try:
+        print("Step 4: Measure Topographic Angles") 
+    
+        #keeping track of time
+        startTime= time.time()
+    
+        # Check if the node fc exists
+        if not arcpy.Exists(nodes_fc):
+            arcpy.AddError("\nThis output does not exist: \n" +
+                           "{0}\n".format(nodes_fc))
+            sys.exit("This output does not exist: \n" +
+                     "{0}\n".format(nodes_fc))     
         
-    # build a dictionary of the cell size in azimuth directions
-    disXY = (hypot(x_cellsize,y_cellsize))
-    disX = (x_cellsize)
-    disY = (y_cellsize)
+        # Check if the topo output exists and delete if needed
+        if arcpy.Exists(topo_fc) and overwrite_data and not resume:
+            arcpy.Delete_management(topo_fc)
     
-    azimuthdisdict = {45:disXY,90:disX,135:disXY,180:disY,225:disXY,270:disX,315:disXY,365:disY}
-    del(disX,disXY,disY)
+        # Check if the block fc exists and delete or throw an error       
+        if arcpy.Exists(block_fc):
+            if overwrite_data:
+                arcpy.Delete_management(block_fc)
+            else:
+                arcpy.AddMessage("\nThis output already exists: \n" +
+                               "{0}\n".format(block_fc) + 
+                               "overwrite data = False. New data will be " +
+                               "appended to the existing feature class.")
+                print("This output already exists: \n" +
+                               "{0}\n".format(block_fc) + 
+                               "overwrite data = False. New data will be " +
+                               "appended to the existing feature class.")
     
-    # Build the topo field names
-    addFields = [azimuthdict[a] for a in azimuths]    
+        if overwrite_data: 
+            env.overwriteOutput = True
+        else:
+            env.overwriteOutput = False    
     
-    # Get a list of existing fields
-    existingFields = []
-    for f in arcpy.ListFields(nodes_fc):
-        existingFields.append(f.name)     
+        # Determine input point spatial units
+        proj = arcpy.Describe(nodes_fc).spatialReference
+        proj_ele = arcpy.Describe(z_raster).spatialReference
 
-    # Check to see if the field exists and add it if not
-    for f in addFields:
-        if (f in existingFields) is False:
-            arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
-                                      "", "NULLABLE", "NON_REQUIRED")
+        # Check to make sure the raster and input 
+        # points are in the same projection.
+        if proj.name != proj_ele.name:
+            arcpy.AddError("{0} and {1} do not have ".format(nodes_fc,z_raster)+
+                           "the same projection. Please reproject your data.")
+            sys.exit("Input points and elevation raster do not have the "+
+                     "same projection. Please reproject your data.")
+
+        # Get the units conversion factors
+        con_z_to_m = from_z_units_to_meters_con(z_units)    
+        con_to_m = to_meters_con(nodes_fc)
+        con_from_m = from_meters_con(nodes_fc)
+        searchDistance_max_m = searchDistance_max_km * 1000 # in meters
+    
+        # search distance in units of the fc
+        searchDistance_max = int(con_from_m * searchDistance_max_m)
+    
+        # convert block size from km to meters to units of the node fc
+        # in the future block size should be estimated based on availiable memory
+        # memorysize = datatypeinbytes*nobands*block_size^2
+        # block_size = int(sqrt(memorysize/datatypeinbytes*nobands))
+        if block_size in ["#", ""]:
+            block_size = int(con_from_m * 5000)
+        else:
+            block_size = int(con_from_m * block_size * 1000)    
+
+        # Get the elevation raster cell size in units of the raster
+        reader = open_raster(z_raster, raster_backend)
+        x_cellsize = float(reader.get_property("CELLSIZEX"))
+        y_cellsize = float(reader.get_property("CELLSIZEY"))
+    
+        azimuths = get_azimuths(topo_directions)
+    
+        # The sky view factor needs directions all the way around.
+        # It is not added to the 8 direction (2) output.
+        calc_svf = (isinstance(topo_directions, (list, tuple)) or
+                    int(topo_directions) > 2)
+    
+        azimuthdict = dict((a, topo_field_name(a)) for a in azimuths)
+        
+        if len(set(azimuthdict.values())) < len(azimuths):
+            arcpy.AddError("Two or more azimuths have the same topo field "+
+                           "name. Use azimuths at least 0.01 degrees apart.")
+            sys.exit("Two or more azimuths have the same topo field "+
+                     "name. Use azimuths at least 0.01 degrees apart.")
+        
+        # build a dictionary of the cell size in azimuth directions
+        azimuthdisdict = dict((a, azimuth_cellsize(a, x_cellsize, y_cellsize)) for a in azimuths)
+    
+        if topo_engine in ["#", "", None]: topo_engine = "rays"
+    
+        # The sweep engine follows rows, columns, and diagonals
+        if topo_engine == "sweep" and x_cellsize != y_cellsize:
+            arcpy.AddError("The sweep engine requires square raster cells.")
+            sys.exit("The sweep engine requires square raster cells.")
+    
+        # Build the topo field names
+        addFields = [azimuthdict[a] for a in azimuths]    
+    
+        # Fields written to the nodes fc
+        if calc_svf:
+            nodeFields = addFields + ["TOPO_SVF"]
+        else:
+            nodeFields = addFields
+    
+        # Get a list of existing fields
+        existingFields = []
+        for f in arcpy.ListFields(nodes_fc):
+            existingFields.append(f.name)     
+
+        # Check to see if the field exists and add it if not
+        for f in nodeFields:
+            if (f in existingFields) is False:
+                arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
+                                          "", "NULLABLE", "NON_REQUIRED")
+        
+        use_checkpoints = checkpoint_file not in ["#", "", None]
+        checkpoint_interval = int(checkpoint_interval)
         
-    # Read the feature class data into a nested dictionary
-    nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
-    
-    # Build the blockDict
-    blockDict = create_blocks(nodeDict, block_size, last_azimuth,
-                              searchDistance_max)    
-
-    # Itterate through each block
-    total_samples = 0
-    blockIDs = blockDict.keys()
-    blockIDs.sort()
-
-    for p, blockID in enumerate(blockIDs):
-        block_extent = blockDict[blockID]["extent"]
-        block_samples = blockDict[blockID]["samples"]
-        block_samples.sort()
-        
-        print("Processing block {0} of {1}".format(p + 1, len(blockIDs)))
-        
-        # calculate coordinates along the 
-        # portion of the topo line in the block, 
-        # convert raster to array, sample the raster
-        # calculate the topo angles and other info
-        topo_samples = get_topo_angles(nodeDict, block_extent , block_samples,
-                                   z_raster, azimuthdisdict,
-                                   searchDistance_max, con_z_to_m)
-        if topo_samples:
-            # Update the nodeDict
-            for sample in topo_samples:
-                nodeID = sample[5]
-                a = sample[6]
-                topoAngle = sample[7]
+        # Blocks after the checkpoint may have written topo fc rows 
+        # before the crash, so on resume the rows of the nodes being 
+        # written are always deleted first.
+        topo_overwrite = overwrite_data and not resume
+        
+        # Inputs that have to match to resume from a checkpoint
+        config = {"nodes_fc": nodes_fc, "z_raster": z_raster,
+                  "azimuths": azimuths, "searchDistance_max": searchDistance_max,
+                  "block_size": block_size, "topo_engine": topo_engine,
+                  "skippy_max_error": skippy_max_error}
+        
+        # Read the feature class data into a nested dictionary
+        if resume:
+            checkpoint = read_checkpoint(checkpoint_file, config)
+            
+            # Keep the same nodes as the checkpointed run because 
+            # nodes finished before the checkpoint may already have data
+            nodeDict = read_nodes_fc(nodes_fc, True, addFields)
+            for nodeID in set(nodeDict.keys()).difference(checkpoint["nodeIDs"]):
+                del nodeDict[nodeID]
+            for sample in checkpoint["samples"]:
+                nodeID = int(sample[4])
+                sample = sample[:4] + [nodeDict[nodeID]["STREAM_ID"], nodeID] + sample[5:]
+                sample[13] = int(sample[13])
+                nodeDict[nodeID][azimuthdict[sample[6]]] = sample[7]
+                nodeDict[nodeID][azimuthdict[sample[6]] + "_list"] = sample
+            last_block = checkpoint["last_block"]
+            del checkpoint
+            print("Resuming after block {0}".format(last_block + 1))
+        else:
+            nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
+            last_block = -1
+        
+        use_horizon_cache = horizon_cache_dir not in ["#", "", None]
+        if use_horizon_cache:
+            # Topo lines start at the raster cell centers so the 
+            # results can be used for any node in the same cell
+            nodeCells = snap_nodes_to_cells(nodeDict, z_raster)
+            fingerprint = raster_fingerprint(z_raster, raster_backend)
+            horizon_files = {}
+            horizon_new = defaultdict(list)
+            for a in azimuths:
+                horizon_files[a] = get_horizon_cache_file(horizon_cache_dir, z_raster,
+                                                          fingerprint, a, searchDistance_max,
+                                                          skippy_max_error, topo_engine,
+                                                          con_z_to_m)
+            
+            # The nodes of a resumed run were all missing from the cache
+            if not resume:
+                horizonDict = dict((a, read_horizon_cache(horizon_files[a])) for a in azimuths)
+                cachedDict = get_cached_topo_samples(nodeDict, nodeCells, horizonDict,
+                                                     azimuths, searchDistance_max_m,
+                                                     con_to_m)
+                del horizonDict
+                print("{0} of {1} nodes found in the horizon cache".format(len(cachedDict),
+                                                                          len(nodeDict)))
+                if cachedDict:
+                    cached_nodes = cachedDict.keys()
+                    topo_list = []
+                    for nodeID in cached_nodes:
+                        for sample in cachedDict[nodeID]:
+                            nodeDict[nodeID][azimuthdict[sample[6]]] = sample[7]
+                        if calc_svf:
+                            nodeDict[nodeID]["TOPO_SVF"] = sky_view_factor([nodeDict[nodeID][f] for f in addFields], azimuths)
+                        topo_list.extend(cachedDict[nodeID])
+                    
+                    update_nodes_fc(nodeDict, nodes_fc, nodeFields, cached_nodes)
+                    update_topo_fc(topo_list, topo_fc, nodes_fc,
+                                   cached_nodes, topo_overwrite, proj)
+                    
+                    # Only the nodes not in the cache are processed
+                    for nodeID in cached_nodes:
+                        del nodeDict[nodeID]
+                    del topo_list
+                del cachedDict
+        
+        nodeIDs = nodeDict.keys()
+    
+        if not nodeIDs:
+            print("All nodes were found in the horizon cache")
+        
+        elif topo_engine == "sweep":
+            # Process blocks of nodes. Each node is finished in one block.
+            node_blocks = create_node_blocks(nodeDict, block_size)
+        
+            for p, (block_extent, nodes_in_block) in enumerate(node_blocks):
+                if p <= last_block: continue
+                nodes_in_block.sort()
+                print("Processing block {0} of {1}".format(p + 1, len(node_blocks)))
+            
+                topo_samples = get_sweep_topo_angles(nodeDict, block_extent,
+                                                     nodes_in_block, z_raster,
+                                                     azimuths, azimuthdisdict,
+                                                     searchDistance_max,
+                                                     searchDistance_max_m,
+                                                     con_z_to_m)
+                for sample in topo_samples:
+                    nodeDict[sample[5]][azimuthdict[sample[6]]] = sample[7]
+            
+                if calc_svf:
+                    for nodeID in nodes_in_block:
+                        nodeDict[nodeID]["TOPO_SVF"] = sky_view_factor([nodeDict[nodeID][f] for f in addFields], azimuths)
+            
+                # Write the topo data to the TTools point feature class
+                update_nodes_fc(nodeDict, nodes_fc, nodeFields, nodes_in_block)
+            
+                # Build/add to the output topo feature class
+                update_topo_fc(topo_samples, topo_fc, nodes_fc,
+                               nodes_in_block, topo_overwrite, proj)
+                
+                if use_horizon_cache:
+                    add_horizon_samples(horizon_new, topo_samples, nodeCells)
+            
+                del topo_samples
+                gc.collect()
+                
+                # Nodes are finished in each block so there is
+                # no node data to save
+                if use_checkpoints and (p + 1) % checkpoint_interval == 0:
+                    write_checkpoint(checkpoint_file, config, p, nodeIDs,
+                                     nodeDict, [])
+            
+        elif topo_engine == "stream":
+            tile_cache = create_tile_cache(z_raster, con_z_to_m, tile_cache_mb)
+            z_pyramid = None
+            if use_max_pyramid:
+                print("Building the max elevation pyramid")
+                z_pyramid = get_max_pyramid(tile_cache, horizon_cache_dir)
+            
+            # Nodes are processed in Morton (Z) order so nearby 
+            # nodes reuse the cached tiles. Nodes are written in 
+            # batches because each cursor pass reads the whole fc.
+            nodes_sorted = morton_sort(nodeDict, tile_cache["x_min"], tile_cache["y_max"],
+                                       tile_cache["x_cellsize"], tile_cache["y_cellsize"])
+            batch_size = 1000
+            node_batches = [nodes_sorted[i:i + batch_size] for i in
+                            range(0, len(nodes_sorted), batch_size)]
+            
+            for p, nodes_in_batch in enumerate(node_batches):
+                if p <= last_block: continue
+                print("Processing node batch {0} of {1}".format(p + 1, len(node_batches)))
+                
+                topo_samples = get_stream_topo_angles(nodeDict, nodes_in_batch,
+                                                      tile_cache, azimuths,
+                                                      azimuthdisdict,
+                                                      searchDistance_max,
+                                                      searchDistance_max_m,
+                                                      skippy_max_error, z_pyramid)
+                for sample in topo_samples:
+                    nodeDict[sample[5]][azimuthdict[sample[6]]] = sample[7]
+                
+                if calc_svf:
+                    for nodeID in nodes_in_batch:
+                        nodeDict[nodeID]["TOPO_SVF"] = sky_view_factor([nodeDict[nodeID][f] for f in addFields], azimuths)
+                
+                # Write the topo data to the TTools point feature class
+                update_nodes_fc(nodeDict, nodes_fc, nodeFields, nodes_in_batch)
+                
+                # Build/add to the output topo feature class
+                update_topo_fc(topo_samples, topo_fc, nodes_fc,
+                               nodes_in_batch, topo_overwrite, proj)
+                
+                if use_horizon_cache:
+                    add_horizon_samples(horizon_new, topo_samples, nodeCells)
                 
-                # Create a key to hold the topo list info for this block
-                topo_key = azimuthdict[a] + "_list"
+                # delete the finished node data
+                for nodeID in nodes_in_batch:
+                    for field in nodeFields:
+                        nodeDict[nodeID].pop(field, None)
                 
-                if azimuthdict[a] in nodeDict[nodeID]:
-                    if nodeDict[nodeID][azimuthdict[a]] < topoAngle:
-                        nodeDict[nodeID][azimuthdict[a]] = topoAngle
-                        nodeDict[nodeID][topo_key] = sample
+                del topo_samples
+                gc.collect()
+                
+                if use_checkpoints and (p + 1) % checkpoint_interval == 0:
+                    write_checkpoint(checkpoint_file, config, p, nodeIDs,
+                                     nodeDict, [])
+            
+            print("{0} elevation tiles read".format(tile_cache["reads"]))
+            
+        else:
+            # Build the blockDict
+            blockDict = create_blocks(nodeDict, block_size, azimuths,
+                                      searchDistance_max)    
+
+            # Itterate through each block
+            total_samples = 0
+            blockIDs = blockDict.keys()
+            blockIDs.sort()
+            
+            if processes in ["#", ""]:
+                processes = cpu_count()
+            else:
+                processes = int(processes)
+            
+            pool = None
+            if processes > 1:
+                # One shared buffer big enough for the largest block
+                max_nbytes = max([block_array_nbytes(blockDict[blockID]["extent"],
+                                                     x_cellsize, y_cellsize)
+                                  for blockID in blockIDs])
+                shared_z = RawArray(ctypes.c_byte, max_nbytes)
+                pool = Pool(processes, init_topo_worker, (shared_z,))
+
+            try:
+                for p, blockID in enumerate(blockIDs):
+                    if p <= last_block: continue
+                    block_extent = blockDict[blockID]["extent"]
+                    block_samples = blockDict[blockID]["samples"]
+                    block_samples.sort()
+        
+                    print("Processing block {0} of {1}".format(p + 1, len(blockIDs)))
+        
+                    # calculate coordinates along the 
+                    # portion of the topo line in the block, 
+                    # convert raster to array, sample the raster
+                    # calculate the topo angles and other info
+                    if processes > 1:
+                        topo_samples = get_topo_angles_parallel(pool, shared_z, processes,
+                                                                block_extent, block_samples,
+                                                                z_raster, azimuthdisdict,
+                                                                searchDistance_max_m,
+                                                                con_z_to_m, skippy_max_error)
+                    else:
+                        topo_samples = get_topo_angles(nodeDict, block_extent , block_samples,
+                                                   z_raster, azimuthdisdict,
+                                                   searchDistance_max_m, con_z_to_m,
+                                                   skippy_max_error)
+                    if topo_samples:
+                        # Update the nodeDict
+                        for sample in topo_samples:
+                            nodeID = sample[5]
+                            a = sample[6]
+                            topoAngle = sample[7]
+                
+                            # Create a key to hold the topo list info for this block
+                            topo_key = azimuthdict[a] + "_list"
+                
+                            # The off raster samples are summed over the blocks
+                            if azimuthdict[a] in nodeDict[nodeID]:
+                                old_sample = nodeDict[nodeID][topo_key]
+                                if nodeDict[nodeID][azimuthdict[a]] < topoAngle:
+                                    sample[13] = sample[13] + old_sample[13]
+                                    nodeDict[nodeID][azimuthdict[a]] = topoAngle
+                                    nodeDict[nodeID][topo_key] = sample
+                                else:
+                                    old_sample[13] = old_sample[13] + sample[13]
                         
-                else:
-                    nodeDict[nodeID][azimuthdict[a]] = topoAngle
-                    nodeDict[nodeID][topo_key] = sample
+                            else:
+                                nodeDict[nodeID][azimuthdict[a]] = topoAngle
+                                nodeDict[nodeID][topo_key] = sample
                     
-            del topo_samples
+                        del topo_samples
         
-        # Check if any nodes can be updated in the node and topo fc
-        if blockDict[blockID]["nodes_to_update"]:
-            nodes_to_update = blockDict[blockID]["nodes_to_update"]
+                    # Check if any nodes can be updated in the node and topo fc
+                    if blockDict[blockID]["nodes_to_update"]:
+                        nodes_to_update = blockDict[blockID]["nodes_to_update"]
             
-            # Write the topo data to the TTools point feature class
-            update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_update)
+                        if calc_svf:
+                            for nodeID in nodes_to_update:
+                                nodeDict[nodeID]["TOPO_SVF"] = sky_view_factor([nodeDict[nodeID][f] for f in addFields], azimuths)
+                
+                        # Write the topo data to the TTools point feature class
+                        update_nodes_fc(nodeDict, nodes_fc, nodeFields, nodes_to_update)
+            
+                        # Build/add to the output topo feature class
+                        topo_list = []
+                        for nodeID in nodes_to_update:
+                            for field in addFields:
+                                topo_key = field + "_list"
+                                topo_list.append(nodeDict[nodeID][topo_key])
+                                # delete some data
+                                nodeDict[nodeID].pop(field, None)
+                                nodeDict[nodeID].pop(topo_key, None)
+                            nodeDict[nodeID].pop("TOPO_SVF", None)
+                        update_topo_fc(topo_list, topo_fc, nodes_fc,
+                                       nodes_to_update, topo_overwrite, proj)
+                    
+                        if use_horizon_cache:
+                            add_horizon_samples(horizon_new, topo_list, nodeCells)
             
-            # Build/add to the output topo feature class
-            topo_list = []
-            for nodeID in nodes_to_update:
-                for field in addFields:
-                    topo_key = field + "_list"
-                    topo_list.append(nodeDict[nodeID][topo_key])
-                    # delete some data
-                    nodeDict[nodeID].pop(field, None)
-                    nodeDict[nodeID].pop(topo_key, None)
-                    nodeDict[nodeID].pop("updated", None)
-            update_topo_fc(topo_list, topo_fc, nodes_fc,
-                           nodes_to_update, overwrite_data, proj)
+                        del topo_list
+                        gc.collect()
+                
+                    if use_checkpoints and (p + 1) % checkpoint_interval == 0:
+                        write_checkpoint(checkpoint_file, config, p, nodeIDs,
+                                         nodeDict, addFields)
             
-            del topo_list
-            gc.collect()
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            finally:
+                # stop the workers if a block fails
+                if pool is not None:
+                    pool.terminate()
+    
+        # Save the new results to the horizon cache
+        if use_horizon_cache:
+            for a in azimuths:
+                if horizon_new[a]:
+                    write_horizon_cache(horizon_files[a], horizon_new[a])
+            del horizon_new
+    
+        # The run is complete so the checkpoint is not needed
+        if use_checkpoints and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
     
-    endTime = time.time()
-    elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
-    mspernode = timedelta(seconds=(endTime - startTime) / len(nodeDict.keys())).microseconds
-    print("Process Complete in {0} minutes. {1} microseconds per node".format(elapsedmin, mspernode))
-    #arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per node" % (elapsedmin, mspernode))
+        endTime = time.time()
+        elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
+        mspernode = timedelta(seconds=(endTime - startTime) / max(len(nodeIDs), 1)).microseconds
+        print("Process Complete in {0} minutes. {1} microseconds per node".format(elapsedmin, mspernode))
+        #arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per node" % (elapsedmin, mspernode))
 
-# For arctool errors
-except arcpy.ExecuteError:
-    msgs = arcpy.GetMessages(2)
-    #arcpy.AddError(msgs)
-    print(msgs)
+    # For arctool errors
+    except arcpy.ExecuteError:
+        msgs = arcpy.GetMessages(2)
+        #arcpy.AddError(msgs)
+        print(msgs)
+
+    # For other errors
+    except:
+        tbinfo = traceback.format_exc()
 
-# For other errors
-except:
-    tbinfo = traceback.format_exc()
+        pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
+        msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
 
-    pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
-    msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
+        #arcpy.AddError(pymsg)
+        #arcpy.AddError(msgs)
 
-    #arcpy.AddError(pymsg)
-    #arcpy.AddError(msgs)
+        print(pymsg)
+        print(msgs)
 
-    print(pymsg)
-    print(msgs)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -43,18 +43,37 @@
 # 13: Path/name of output sample point file (lc_point_fc)
 # 14: OPTIONAL - km distance to process within each array (block_size)
 # 15: True/False flag if existing data can be over written (overwrite_data)
+# 16: OPTIONAL - Path/name of a long format output table (lc_table). 
+#      When used the landcover data is written to this table with one 
+#      row per sample and raster type (NODE_ID, TRANSECT, SAMPLE, TYPE, 
+#      VALUE) instead of to the nodes_fc fields. Use a geodatabase or 
+#      GeoPackage table. A dbf table is sorted in memory when it is
+#      read back with read_lc_table_wide().
+# 17: OPTIONAL - True/False flag to only resample the rasters that 
+#      changed since the last run (incremental). The raster 
+#      fingerprints are saved in a table named lc_point_fc + "_rasters"
+#      in the same workspace (a .dbf table for a shapefile).
+#      Changes to the nodes, z or landcover units, lc_table use, or
+#      sample settings resample all the rasters.
+# 18: OPTIONAL - raster reader backend. Default is "arcpy". Can also 
+#      read the rasters with 1. "arcpy", 2. "gdal", 3. "numpy" arrays 
+#      added with raster_io.register_array(), or 4. "memmap" for 
+#      uncompressed GeoTIFF, ENVI, or ESRI .flt rasters (raster_backend)
+# 19: OPTIONAL - vector backend for the nodes_fc, lc_point_fc, and 
+#      lc_table. Default is "arcpy". Can also use 1. "arcpy", 2. "ogr" 
+#      for GeoPackage layers, or 3. "memory" tables added with 
+#      vector_io.register_table() (vector_backend)
 
 # OUTPUTS
 # 0. point feature class (edit nodes_fc) - added fields with 
 #     Landcover and elevation data for each azimuth direction at each node
 # 1. point feature class (new) - point at each x/y sample and 
 #     the sample raster values
+# 2. OPTIONAL table (new) - long format landcover data. Use 
+#     read_lc_table_wide() to get the node field layout for export.
 
 # Future Updates
 # -Change the node dict so the node is the primary key
-# -Build the block list based on the nodes and then build point list iteratively
-# instead of building them into one huge list. The huge list results
-# in a memory error for large areas
 # -Include stream sample in transect count (True/False)
 # -Eliminate arcpy and use gdal for reading/writing feature class data
 
@@ -71,9 +90,13 @@ import gc
 import time
 import traceback
 from datetime import timedelta
+from hashlib import md5
 from math import radians, sin, cos, ceil, sqrt
 from collections import defaultdict, OrderedDict
+from itertools import groupby
 import numpy
+from raster_io import open_raster, raster_fingerprint
+from vector_io import open_table, create_table, table_exists, delete_table
 import arcpy
 from arcpy import env
 
@@ -98,6 +121,10 @@ z_units = "Meters"
 lc_point_fc = r"D:\Projects\TTools_9\JohnsonCreek.gdb\LC_samplepoint_two"
 block_size = "#" # OPTIONAL defualt to 5
 overwrite_data = True
+lc_table = "#" # OPTIONAL long format output table instead of node fields
+incremental = False # OPTIONAL only resample rasters that changed
+raster_backend = "arcpy" # OPTIONAL "arcpy", "gdal", "numpy", or "memmap"
+vector_backend = "arcpy" # OPTIONAL "arcpy", "ogr", or "memory"
 # End Fill in Data
 # ----------------------------------------------------------------------
 
@@ -111,8 +138,10 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
     nodeDict = nested_dict()
     incursorFields = ["NODE_ID", "STREAM_ID", "STREAM_KM", "SHAPE@X","SHAPE@Y"]
 
+    nodes_table = open_table(nodes_fc, vector_backend)
+
     # Get a list of existing fields
-    existingFields = [f.name for f in arcpy.ListFields(nodes_fc)] 
+    existingFields = nodes_table.list_fields()
 
     # Check to see if the last field exists if yes add it. 
     # Grabs last field becuase often the first field, emergent, is zero
@@ -121,24 +150,21 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
     else:
         overwrite_data = True
 
-    # Determine input point spatial units
-    proj = arcpy.Describe(nodes_fc).spatialReference
-
-    with arcpy.da.SearchCursor(nodes_fc, incursorFields,"",proj) as Inrows:
-        if overwrite_data:
-            for row in Inrows:
+    columns = nodes_table.read_columns(incursorFields)
+    if overwrite_data:
+        for row in zip(*columns.values()):
+            nodeDict[row[0]]["STREAM_ID"] = row[1] 
+            nodeDict[row[0]]["STREAM_KM"] = row[2] 
+            nodeDict[row[0]]["POINT_X"] = row[3]
+            nodeDict[row[0]]["POINT_Y"] = row[4]
+    else:
+        for row in zip(*columns.values()):
+            # Is the data null or zero, if yes grab it.
+            if row[5] is None or row[5] == 0 or row[5] < -9998:
                 nodeDict[row[0]]["STREAM_ID"] = row[1] 
                 nodeDict[row[0]]["STREAM_KM"] = row[2] 
                 nodeDict[row[0]]["POINT_X"] = row[3]
                 nodeDict[row[0]]["POINT_Y"] = row[4]
-        else:
-            for row in Inrows:
-                # Is the data null or zero, if yes grab it.
-                if row[5] is None or row[5] == 0 or row[5] < -9998:
-                    nodeDict[row[0]]["STREAM_ID"] = row[1] 
-                    nodeDict[row[0]]["STREAM_KM"] = row[2] 
-                    nodeDict[row[0]]["POINT_X"] = row[3]
-                    nodeDict[row[0]]["POINT_Y"] = row[4]
     
     if len(nodeDict) == 0:
         sys.exit("The fields checked in the input point feature class " +
@@ -146,10 +172,13 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
               
     return nodeDict
 
-def update_lc_point_fc(lc_point_list, type, lc_point_fc, nodes_fc,
-                       nodes_in_block, overwrite_data, proj):
+def update_lc_point_fc(lc_points, n, streamIDs, keys, type, lc_point_fc,
+                       nodes_fc, nodes_in_block, overwrite_data,
+                       chunk_size=10000):
     """Creates/updates the output landcover sample point feature
-    class using the data from the landcover point list"""
+    class using the first n samples in the landcover point buffers.
+    streamIDs has one value per node and keys one per template 
+    sample. Rows are written chunk_size samples at a time."""
     #print("Exporting data to land cover sample feature class")
     
     cursorfields = ["POINT_X","POINT_Y"] +["STREAM_ID","NODE_ID", "SAMPLE_ID", 
@@ -157,16 +186,8 @@ def update_lc_point_fc(lc_point_list, type, lc_point_fc, nodes_fc,
                                            "SAMPLE", "KEY"] + type    
     
     # Check if the output exists and create if not
-    if not arcpy.Exists(lc_point_fc):
-        arcpy.CreateFeatureclass_management(os.path.dirname(lc_point_fc),
-                                            os.path.basename(lc_point_fc),
-                                            "POINT","","DISABLED","DISABLED",proj)
-        
-        # Determine Stream ID field properties
-        sid_type = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].type
-        sid_precision = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].precision
-        sid_scale = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].scale
-        sid_length = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].length
+    if not table_exists(lc_point_fc, vector_backend):
+        nodes_table = open_table(nodes_fc, vector_backend)
         
         typeDict = {"POINT_X": "DOUBLE", 
                     "POINT_Y": "DOUBLE", 
@@ -180,30 +201,145 @@ def update_lc_point_fc(lc_point_list, type, lc_point_fc, nodes_fc,
         for t in type:
             typeDict[t] = "DOUBLE"
     
-        # Add attribute fields
-        for f in cursorfields:
-            if f == "STREAM_ID":
-                arcpy.AddField_management(lc_point_fc, f, sid_type,
-                                          sid_precision, sid_scale, sid_length,
-                                          "", "NULLABLE", "NON_REQUIRED")
-            else:
-                arcpy.AddField_management(lc_point_fc, f, typeDict[f], "",
-                                          "", "", "", "NULLABLE", "NON_REQUIRED")                 
+        # Stream ID field properties are the same as the nodes_fc
+        fields = [nodes_table.field_info(f) if f == "STREAM_ID" else (f, typeDict[f])
+                  for f in cursorfields]
+        lc_point_table = create_table(lc_point_fc, fields, "POINT",
+                                      nodes_table.spatial_reference,
+                                      vector_backend)
+    else:
+        lc_point_table = open_table(lc_point_fc, vector_backend)
     
     if not overwrite_data:
-        # Build a query to retreive existing rows from the nodes 
-        # that need updating
-        whereclause = """{0} IN ({1})""".format("NODE_ID", ','.join(str(i) for i in nodes_in_block))        
-        
-        # delete those rows
-        with arcpy.da.UpdateCursor(lc_point_fc,["NODE_ID"], whereclause) as cursor:  
-            for row in cursor:
-                cursor.deleteRow()     
+        # delete the existing rows from the nodes that need updating
+        lc_point_table.delete_rows({"NODE_ID": nodes_in_block})
+
+    zonesPerNode = len(keys)
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        sample_index = numpy.arange(i, j)
+        x = lc_points["POINT_X"][i:j].tolist()
+        y = lc_points["POINT_Y"][i:j].tolist()
+        columns = OrderedDict([("SHAPE@X", x), ("SHAPE@Y", y),
+                               ("POINT_X", x), ("POINT_Y", y)])
+        columns["STREAM_ID"] = [streamIDs[k] for k in (sample_index // zonesPerNode).tolist()]
+        for f in ["NODE_ID", "SAMPLE_ID", "TRANS_AZIMUTH", "TRANSECT", "SAMPLE"]:
+            columns[f] = lc_points[f][i:j].tolist()
+        columns["KEY"] = [keys[k] for k in (sample_index % zonesPerNode).tolist()]
+        for t in type:
+            columns[t] = lc_points[t][i:j].tolist()
+        lc_point_table.write_columns(columns)
+
+def read_lc_table_nodes(lc_table):
+    """Returns a set of the node IDs that have data in the long
+    format landcover table"""
+
+    return set(open_table(lc_table, vector_backend).read_columns(["NODE_ID"])["NODE_ID"])
+
+def update_lc_table(lc_points, n, type, sampleID_for_code, lc_table,
+                    nodes_in_block, overwrite_data, chunk_size=10000):
+    """Creates/appends to the long format landcover table using the
+    first n samples in the landcover point buffers. There is one row
+    for each sample and raster type with the NODE_ID, TRANSECT,
+    SAMPLE, TYPE, and VALUE. Existing rows of the nodes are replaced
+    for the raster types being written. Rows are inserted chunk_size
+    samples at a time."""
+
+    # Check if the output exists and create if not
+    if not table_exists(lc_table, vector_backend):
+        fields = [("NODE_ID", "LONG"),
+                  ("TRANSECT", "SHORT"),
+                  ("SAMPLE", "SHORT"),
+                  ("TYPE", "TEXT"),
+                  ("VALUE", "DOUBLE")]
+        table = create_table(lc_table, fields, backend=vector_backend)
+    else:
+        table = open_table(lc_table, vector_backend)
+
+    if not overwrite_data:
+        # delete the existing rows from the nodes that need updating
+        table.delete_rows(OrderedDict([("NODE_ID", nodes_in_block),
+                                       ("TYPE", type)]))
+
+    for t in type:
+        if sampleID_for_code and t == "LC":
+            values = lc_points["SAMPLE_ID"]
+        else:
+            values = lc_points[t]
+        for i in range(0, n, chunk_size):
+            j = min(i + chunk_size, n)
+            columns = OrderedDict((f, lc_points[f][i:j].tolist()) for f in
+                                  ["NODE_ID", "TRANSECT", "SAMPLE"])
+            columns["TYPE"] = [t] * (j - i)
+            columns["VALUE"] = values[i:j].tolist()
+            table.write_columns(columns)
+
+def read_lc_table_wide(lc_table, nodeIDs=None):
+    """Generator that pivots the long format landcover table back to
+    the wide node layout one node at a time. Yields the node ID and a
+    dictionary of the values keyed by the node field names
+    (e.g. LC_T1_S1). Use this when exporting to Heat Source so the
+    wide fields never have to be stored in the nodes fc."""
+
+    where = None
+    if nodeIDs is not None:
+        where = {"NODE_ID": nodeIDs}
+
+    # rows are read in node order so only one node is held at a
+    # time. A dbf table read with arcpy is sorted in memory first.
+    rows = open_table(lc_table, vector_backend).iter_rows(["NODE_ID", "TYPE", "TRANSECT",
+                                                           "SAMPLE", "VALUE"],
+                                                          where, ["NODE_ID"])
+    for nodeID, node_rows in groupby(rows, key=lambda row: row[0]):
+        values = {}
+        for row in node_rows:
+            values["{0}_T{1}_S{2}".format(row[1], row[2], row[3])] = row[4]
+        yield nodeID, values
+
+def read_fingerprints(fingerprint_table):
+    """Returns a dictionary of the raster fingerprints saved by the
+    last run keyed by raster type. The sample settings are saved
+    under the CONFIG key."""
+
+    fingerprints = {}
+    if table_exists(fingerprint_table, vector_backend):
+        columns = open_table(fingerprint_table, vector_backend).read_columns(["TYPE", "FINGERPRINT"])
+        fingerprints = dict(zip(columns["TYPE"], columns["FINGERPRINT"]))
+    return fingerprints
+
+def nodes_fingerprint(nodes_fc):
+    """Returns a fingerprint of the nodes in the input point feature
+    class made from the row count, the set of NODE_IDs, and the 
+    extent of the node coordinates"""
+
+    columns = open_table(nodes_fc, vector_backend).read_columns(["NODE_ID", "SHAPE@X", "SHAPE@Y"])
+    nodeIDs = ",".join(str(nodeID) for nodeID in sorted(columns["NODE_ID"]))
+    x = columns["SHAPE@X"]
+    y = columns["SHAPE@Y"]
+    extent = "{0!r},{1!r},{2!r},{3!r}".format(float(min(x or [0])), float(min(y or [0])),
+                                              float(max(x or [0])), float(max(y or [0])))
+    text = "{0},{1},{2}".format(len(columns["NODE_ID"]), nodeIDs, extent)
+    return md5(text.encode("utf-8")).hexdigest()[:16]
+
+def write_fingerprints(fingerprint_table, fingerprints):
+    """Replaces the rows in the fingerprint table with the raster
+    fingerprints used for this run"""
+
+    delete_table(fingerprint_table, vector_backend)
+    table = create_table(fingerprint_table, [("TYPE", "TEXT"), ("FINGERPRINT", "TEXT")],
+                         backend=vector_backend)
+    table.write_columns(OrderedDict([("TYPE", fingerprints.keys()),
+                                     ("FINGERPRINT", fingerprints.values())]))
 
-    with arcpy.da.InsertCursor(lc_point_fc, ["SHAPE@X","SHAPE@Y"] +
-                               cursorfields) as cursor:
-        for row in lc_point_list:
-            cursor.insertRow(row)
+def update_lc_point_values(lc_points, n, type, lc_point_fc, nodes_in_block):
+    """Updates only the raster type fields of the existing landcover
+    sample points using the first n samples in the landcover point
+    buffers. The points are matched by SAMPLE_ID."""
+
+    columns = OrderedDict([("SAMPLE_ID", lc_points["SAMPLE_ID"][:n].tolist())])
+    for t in type:
+        columns[t] = lc_points[t][:n].tolist()
+    open_table(lc_point_fc, vector_backend).update_columns("SAMPLE_ID", columns)
 
 def setup_lcdata_headers(transsample_count, trans_count,
                           canopy_data_type, stream_sample):
@@ -257,48 +393,74 @@ def coord_to_array(easting, northing, block_x_min, block_y_max, x_cellsize, y_ce
     xy.append(int((northing - block_y_max) / y_cellsize * -1))  # row, y 
     return xy
 
-def create_lc_point_list(nodeDict, nodes_in_block, dirs, zones, transsample_distance):
-    """This builds a unique long form list of information for all the
-    landcover samples in the block. This list is used to
-    create/update the output feature class."""
+def create_lc_point_template(dirs, zones, transsample_distance):
+    """Returns a dictionary of arrays with the x/y offset from the 
+    node, azimuth, transect, and sample number for each landcover 
+    sample of one node. These are the same for every node. The first
+    sample is the emergent/stream sample at the node. Also holds 
+    the list of sample keys (e.g. T1_S1)."""
     
-    lc_point_list = []
     numDirs = len(dirs)
     numZones = len(zones)
-    zonesPerNode = (numDirs * numZones) + 1  
-
-    for nodeID in nodes_in_block:
-        origin_x = nodeDict[nodeID]["POINT_X"]
-        origin_y = nodeDict[nodeID]["POINT_Y"]
-        streamID = nodeDict[nodeID]["STREAM_ID"]
-        #sampleID = '{0}{1}{2}'.format(nodeID, '000', '00')
-        sampleID = nodeID * zonesPerNode
-        
-        # This is the emergent/stream sample
-        lc_point_list.append([origin_x, origin_y, origin_x, origin_y,
-                              streamID, nodeID, sampleID,
-                              0, 0, 0, "T0_S0"])
     
-        for d, dir in enumerate(dirs):
-            for zone in zones:
-                # Calculate the x and y coordinate of the 
-                # landcover sample location
-                pt_x = (zone * transsample_distance * con_from_m *
-                        sin(radians(dir))) + origin_x
-                pt_y = (zone * transsample_distance * con_from_m *
-                        cos(radians(dir))) + origin_y
-                
-                key = 'T{0}_S{1}'.format(d+1, zone)
-                tran_num = '{:{}{}}'.format(d+1, 0, 3)
-                samp_num = '{:{}{}}'.format(zone, 0, 2)
-                sampleID = (nodeID * zonesPerNode) + (d * numZones) + zone
-        
-                # Add to the list          
-                lc_point_list.append([pt_x, pt_y, pt_x, pt_y,
-                                      streamID, nodeID, sampleID,
-                                      dir, d+1, zone, key])    
-     
-    return lc_point_list
+    # transect index and zone of each sample along the transects
+    d = numpy.repeat(numpy.arange(numDirs), numZones)
+    zone = numpy.tile(numpy.array(zones), numDirs)
+    azimuth = numpy.array(dirs, dtype=float)[d]
+    distance = zone * transsample_distance * con_from_m
+    
+    template = {}
+    template["OFFSET_X"] = numpy.append(0, distance * numpy.sin(numpy.radians(azimuth)))
+    template["OFFSET_Y"] = numpy.append(0, distance * numpy.cos(numpy.radians(azimuth)))
+    template["TRANS_AZIMUTH"] = numpy.append(0, azimuth)
+    template["TRANSECT"] = numpy.append(0, d + 1)
+    template["SAMPLE"] = numpy.append(0, zone)
+    template["KEY"] = ["T0_S0"] + ["T{0}_S{1}".format(t, z) for t, z in
+                                   zip(template["TRANSECT"][1:], template["SAMPLE"][1:])]
+    return template
+
+def create_lc_point_buffers(nsamples, types):
+    """Returns a dictionary of empty numpy arrays, one for each
+    landcover sample attribute and raster type, big enough to hold
+    nsamples. The buffers are reused for every block so memory use
+    depends only on the block size."""
+    
+    lc_points = {}
+    for f in ["POINT_X", "POINT_Y", "TRANS_AZIMUTH"] + types:
+        lc_points[f] = numpy.empty(nsamples, dtype=numpy.float64)
+    for f in ["NODE_ID", "SAMPLE_ID"]:
+        lc_points[f] = numpy.empty(nsamples, dtype=numpy.int64)
+    for f in ["TRANSECT", "SAMPLE"]:
+        lc_points[f] = numpy.empty(nsamples, dtype=numpy.int16)
+    return lc_points
+
+def create_lc_point_list(nodeDict, nodes_in_block, template, lc_points):
+    """Fills the landcover point buffers with the x/y coordinates and
+    related information for all the landcover samples in the block
+    and returns the number of samples. The template offsets are 
+    added to the node coordinates so there are no per sample python
+    objects. The samples of each node are together and in the same
+    order as the template."""
+    
+    zonesPerNode = len(template["KEY"])
+    n = len(nodes_in_block) * zonesPerNode
+    nodeIDs = numpy.array(nodes_in_block)
+    origin_x = numpy.array([nodeDict[nodeID]["POINT_X"] for nodeID in nodes_in_block])
+    origin_y = numpy.array([nodeDict[nodeID]["POINT_Y"] for nodeID in nodes_in_block])
+    
+    # (node x sample) views of the buffers
+    def view(f):
+        return lc_points[f][:n].reshape(len(nodes_in_block), zonesPerNode)
+    
+    numpy.add(origin_x[:, numpy.newaxis], template["OFFSET_X"], out=view("POINT_X"))
+    numpy.add(origin_y[:, numpy.newaxis], template["OFFSET_Y"], out=view("POINT_Y"))
+    view("NODE_ID")[:] = nodeIDs[:, numpy.newaxis]
+    numpy.add(nodeIDs[:, numpy.newaxis] * zonesPerNode,
+              numpy.arange(zonesPerNode), out=view("SAMPLE_ID"))
+    for f in ["TRANS_AZIMUTH", "TRANSECT", "SAMPLE"]:
+        view(f)[:] = template[f]
+    
+    return n
 
 def create_block_list(nodes, block_size):
     """Returns two lists, one containting the coordinate extent
@@ -368,92 +530,148 @@ def create_block_list(nodes, block_size):
     
     return block_extents, block_nodes
     
-def sample_raster(block, lc_point_list, raster, con):
-    
+def get_raster_info(raster):
+    """Returns a dictionary of the raster cell size and
+    coordinate extent"""
+
+    rasterinfo = {}
+    reader = open_raster(raster, raster_backend)
+    for prop in ["CELLSIZEX", "CELLSIZEY", "LEFT", "BOTTOM", "RIGHT", "TOP"]:
+        rasterinfo[prop] = float(reader.get_property(prop))
+
+    # Rasters with the same key have cells that line up
+    rasterinfo["GRID"] = (rasterinfo["CELLSIZEX"], rasterinfo["CELLSIZEY"],
+                          round(rasterinfo["LEFT"] % rasterinfo["CELLSIZEX"], 6),
+                          round(rasterinfo["TOP"] % rasterinfo["CELLSIZEY"], 6))
+    return rasterinfo
+
+def get_block_window(block, rasterinfo):
+    """Returns the block extent adjusted to the raster cell corners
+    and the number of rows and cols"""
+
+    x_cellsize = rasterinfo["CELLSIZEX"]
+    y_cellsize = rasterinfo["CELLSIZEY"]
+
+    # Calculate the X and Y offset from the upper left node
+    # coordinates bounding box
+    x_minoffset = (block[0] - rasterinfo["LEFT"])%x_cellsize
+    y_minoffset = (block[1] - rasterinfo["BOTTOM"])%y_cellsize
+    x_maxoffset = (rasterinfo["RIGHT"] - block[2])%x_cellsize
+    y_maxoffset = (rasterinfo["TOP"] - block[3])%y_cellsize
+
+    # adjust so the coordinates are at the raster cell corners
+    block_x_min = block[0] - x_minoffset
+    block_y_min = block[1] - y_minoffset
+    block_x_max = block[2] + x_maxoffset
+    block_y_max = block[3] + y_maxoffset
+
+    # calculate the number or cols/ros from the lower left
+    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
+    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
+
+    return block_x_min, block_y_min, block_y_max, ncols, nrows
+
+def read_block_array(raster, block_x_min, block_y_min, ncols, nrows,
+                     x_cellsize, y_cellsize, con):
+    """Reads the raster within the block into a numpy array and
+    converts the values to meters if needed"""
+
     if con is not None:
         nodata_to_value = -9999 / con
     else:
         nodata_to_value = -9999
-        
-    # localize the block extent values
-    block_x_min = block[0]
-    block_y_min = block[1]
-    block_x_max = block[2]
-    block_y_max = block[3]
-    
-    x_cellsize = float(arcpy.GetRasterProperties_management(raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(raster, "CELLSIZEY").getOutput(0)) 
-
-    # Get the coordinates extent of the input raster
-    raster_x_min = float(arcpy.GetRasterProperties_management(raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(raster, "TOP").getOutput(0))
-      
-    # Calculate the X and Y offset from the upper left node 
-    # coordinates bounding box    
-    x_minoffset = (block_x_min - raster_x_min)%x_cellsize
-    y_minoffset = (block_y_min - raster_y_min)%y_cellsize
-    x_maxoffset = (raster_x_max - block_x_max)%x_cellsize 
-    y_maxoffset = (raster_y_max - block_y_max)%y_cellsize
-    
-    # adjust so the coordinates are at the raster cell corners
-    block_x_min = block_x_min - x_minoffset 
-    block_y_min = block_y_min - y_minoffset
-    block_x_max = block_x_max + x_maxoffset
-    block_y_max = block_y_max + y_maxoffset
-    
+
     # Get the lower left cell center coordinate. This is for ESRI's
-    # RastertoNumpyArray function which defaults to the adjacent 
+    # RastertoNumpyArray function which defaults to the adjacent
     # lower left cell
     block_x_min_center = block_x_min + (x_cellsize / 2)
-    block_y_min_center = block_y_min + (y_cellsize / 2)    
-    
-    # calculate the number or cols/ros from the lower left
-    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
-    
+    block_y_min_center = block_y_min + (y_cellsize / 2)
+
     # Construct the array. Note returned array is (row, col) so (y, x)
     try:
-        raster_array = arcpy.RasterToNumPyArray(raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                                ncols, nrows, nodata_to_value)
+        raster_array = open_raster(raster, raster_backend).read_numpy(block_x_min_center, block_y_min_center,
+                                                                      ncols, nrows, nodata_to_value)
     except:
         tbinfo = traceback.format_exc()
-        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"       
-        sys.exit(pymsg)    
-    
-    # convert array values to meters if needed
-    if con is not None:
+        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
+        sys.exit(pymsg)
+
+    # convert array values to meters if needed. A factor of 1 is
+    # skipped so a memmap window is not copied.
+    if con is not None and con != 1:
         raster_array = raster_array * con
-    
-    lc_point_list_new = []
-    if raster_array.max() > -9999:
-        # There is at least one pixel of data
-        for point in lc_point_list:
-            xy = coord_to_array(point[0], point[1], block_x_min, block_y_max, x_cellsize, y_cellsize)
-            point.append(raster_array[xy[1], xy[0]])
-            lc_point_list_new.append(point)
-    else:
-        # No data, add -9999
-        for point in lc_point_list:
-            point.append(-9999)
-            lc_point_list_new.append(point)
-    return lc_point_list_new            
+
+    return raster_array
+
+def sample_rasters(block, pt_x, pt_y, rasterDict, rasterInfo, conDict):
+    """Samples all the rasters at the x/y coordinates. Rasters with
+    cells that line up share one set of array row/col indices and
+    rasters with the same data type are stacked into one array so
+    they are sampled with one gather. Returns a dictionary of the
+    sample value arrays for each raster type."""
+
+    sampleDict = {}
+
+    # group the rasters that have the same grid
+    gridDict = OrderedDict()
+    for type, raster in rasterDict.iteritems():
+        if raster is None:
+            sampleDict[type] = numpy.full(len(pt_x), -9999)
+        else:
+            gridDict.setdefault(rasterInfo[raster]["GRID"], []).append(type)
+
+    for types in gridDict.values():
+        rasterinfo = rasterInfo[rasterDict[types[0]]]
+        x_cellsize = rasterinfo["CELLSIZEX"]
+        y_cellsize = rasterinfo["CELLSIZEY"]
+        (block_x_min, block_y_min, block_y_max,
+         ncols, nrows) = get_block_window(block, rasterinfo)
+
+        # convert the coordinates to the col and row of the array
+        cols = ((pt_x - block_x_min) / x_cellsize).astype(int)
+        rows = ((pt_y - block_y_max) / y_cellsize * -1).astype(int)
+
+        # read the arrays and stack those with the same data type
+        stackDict = OrderedDict()
+        for type in types:
+            raster_array = read_block_array(rasterDict[type], block_x_min,
+                                            block_y_min, ncols, nrows,
+                                            x_cellsize, y_cellsize,
+                                            conDict[type])
+            if raster_array.max() > -9999:
+                stackDict.setdefault(raster_array.dtype.str, []).append((type, raster_array))
+            else:
+                # No data, add -9999
+                sampleDict[type] = numpy.full(len(pt_x), -9999)
+            del raster_array
+
+        for stack_list in stackDict.values():
+            if len(stack_list) == 1:
+                # sampled from its own array so it is not copied
+                type, raster_array = stack_list.pop()
+                sampleDict[type] = raster_array[rows, cols]
+                del raster_array
+                continue
+            stack_types = [type for type, raster_array in stack_list]
+            stack = numpy.array([raster_array for type, raster_array in stack_list])
+            del stack_list[:]
+            samples = stack[:, rows, cols]
+            del stack
+            for s, type in enumerate(stack_types):
+                sampleDict[type] = samples[s]
+        gc.collect()
+
+    return sampleDict
 
 def update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_query):
     """Updates the input point feature class with data from the
     nodes dictionary"""
     #print("Updating input point feature class")
     
-    # Build a query to retreive just the nodes that needs updating
-    whereclause = """{0} IN ({1})""".format("NODE_ID", ','.join(str(i) for i in nodes_to_query))
-
-    with arcpy.da.UpdateCursor(nodes_fc,["NODE_ID"] + addFields, whereclause) as cursor:  
-        for row in cursor:
-            for f, field in enumerate(addFields):
-                nodeID =row[0]
-                row[f+1] = nodeDict[nodeID][field]
-                cursor.updateRow(row)
+    columns = OrderedDict([("NODE_ID", nodes_to_query)])
+    for field in addFields:
+        columns[field] = [nodeDict[nodeID][field] for nodeID in nodes_to_query]
+    open_table(nodes_fc, vector_backend).update_columns("NODE_ID", columns)
 
 def from_meters_con(inFeature):
     """Returns the conversion factor to get from meters to the
@@ -495,15 +713,14 @@ try:
     startTime= time.time()
     
     # Check if the node fc exists
-    if not arcpy.Exists(nodes_fc):
+    if not table_exists(nodes_fc, vector_backend):
         arcpy.AddError("\nThis output does not exist: \n" +
                        "{0}\n".format(nodes_fc))
         sys.exit("This output does not exist: \n" +
                  "{0}\n".format(nodes_fc))
     
-    # Check if the lc point fc exists and delete if needed
-    if arcpy.Exists(lc_point_fc) and overwrite_data:
-        arcpy.Delete_management(lc_point_fc)
+    # Write to the long format table instead of the node fields
+    use_lc_table = lc_table not in ["#", ""]
     
     
     # Determine input spatial units and set unit conversion factors
@@ -592,6 +809,65 @@ try:
 
 
     
+    # Unit conversion factor and properties for each raster
+    conDict = {}
+    rasterInfo = {}
+    for type, raster in rasterDict.iteritems():
+        if raster == z_raster:
+            conDict[type] = con_z_to_m
+        elif raster == lc_raster:
+            conDict[type] = con_lc_to_m
+        else:
+            conDict[type] = None
+        if raster is not None and raster not in rasterInfo:
+            rasterInfo[raster] = get_raster_info(raster)
+    
+    # Fingerprint each raster, the nodes, and the sample settings. If
+    # only some rasters changed since the last run just those are 
+    # resampled. Any change to the nodes or settings resamples all.
+    # The table is next to lc_point_fc. A shapefile gets a dbf table.
+    base, ext = os.path.splitext(os.path.basename(lc_point_fc))
+    if ext.lower() == ".shp":
+        ext = ".dbf"
+    fingerprint_table = os.path.join(os.path.dirname(lc_point_fc), base + "_rasters" + ext)
+    fingerprints = OrderedDict()
+    fingerprints["CONFIG"] = "{0},{1},{2},{3},{4},{5!r},{6!r},{7},{8}".format(
+        trans_count, transsample_count, transsample_distance, heatsource8,
+        sampleID_for_code, con_lc_to_m, con_z_to_m, use_lc_table,
+        nodes_fingerprint(nodes_fc))
+    for type, raster in rasterDict.iteritems():
+        if raster is None:
+            fingerprints[type] = "None"
+        else:
+            fingerprints[type] = raster_fingerprint(raster, raster_backend)
+    
+    update_only = False
+    runDict = rasterDict
+    if incremental and table_exists(lc_point_fc, vector_backend):
+        old_fingerprints = read_fingerprints(fingerprint_table)
+        if sorted(old_fingerprints.keys()) == sorted(fingerprints.keys()) and \
+           old_fingerprints["CONFIG"] == fingerprints["CONFIG"]:
+            runDict = OrderedDict((type, raster) for type, raster in rasterDict.iteritems()
+                                  if old_fingerprints[type] != fingerprints[type])
+            if len(runDict) == 0:
+                sys.exit("None of the rasters changed since the last run. " +
+                         "There is nothing to process. Exiting")
+            update_only = True
+            print("Resampling {0}".format(", ".join(runDict.keys())))
+        else:
+            # The nodes, unit conversions, or sample settings changed
+            # so the old samples can not be reused
+            overwrite_data = True
+            print("The nodes or sample settings changed since the last run. " +
+                  "Resampling all the rasters")
+    
+    # Check if the lc point fc exists and delete if needed
+    if overwrite_data and not update_only:
+        delete_table(lc_point_fc, vector_backend)
+    
+    if use_lc_table and overwrite_data and not update_only:
+        delete_table(lc_table, vector_backend)
+    
     # flag indicating the model should use the heat source 8 methods 
     # (same as 8 directions but no north)
     if heatsource8:
@@ -602,6 +878,10 @@ try:
 
     zones = range(1,int(transsample_count+1))
     
+    # sample offsets from the node, the same for every node
+    template = create_lc_point_template(dirs, zones, transsample_distance)
+    zonesPerNode = len(template["KEY"])
+    
     # TODO
     stream_sample = True
     # This is a future function that may replace the emergent methods.
@@ -618,23 +898,34 @@ try:
     
     addFields = lcheaders + otherheaders
     
-    # Get a list of existing fields
-    existingFields = [f.name for f in arcpy.ListFields(nodes_fc)] 
-        
-    # Check to see if the field exists and add it if not
-    for f in lcheaders:
-        if (f in existingFields) is False:
-            arcpy.AddField_management(nodes_fc, f, "TEXT", "", "", "",
-                                      "", "NULLABLE", "NON_REQUIRED")    
-
-    # Check to see if the field exists and add it if not
-    for f in otherheaders:
-        if (f in existingFields) is False:
-            arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
-                                      "", "NULLABLE", "NON_REQUIRED")    
+    # the node fields of the raster types being sampled
+    runFields = [f for f in addFields if f.split("_")[0] in runDict.keys()]
     
-    # read the node data into the node dictionary
-    nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
+    if update_only:
+        # all the nodes are resampled for the changed rasters
+        nodeDict = read_nodes_fc(nodes_fc, True, addFields)
+    elif use_lc_table:
+        # read all the nodes and skip those already in the table
+        nodeDict = read_nodes_fc(nodes_fc, True, addFields)
+        if not overwrite_data and table_exists(lc_table, vector_backend):
+            for nodeID in read_lc_table_nodes(lc_table):
+                nodeDict.pop(nodeID, None)
+            if len(nodeDict) == 0:
+                sys.exit("All the nodes have data in the landcover " +
+                         "table. There is nothing to process. Exiting")
+    else:
+        # Get a list of existing fields
+        nodes_table = open_table(nodes_fc, vector_backend)
+        existingFields = nodes_table.list_fields()
+            
+        # Check to see if the field exists and add it if not
+        nodes_table.add_fields([(f, "TEXT") for f in lcheaders
+                                if (f in existingFields) is False])
+        nodes_table.add_fields([(f, "DOUBLE") for f in otherheaders
+                                if (f in existingFields) is False])
+        
+        # read the node data into the node dictionary
+        nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
     
     # Get a list of the nodes, sort them
     nodes = nodeDict.keys()
@@ -643,6 +934,10 @@ try:
     # Build the block list
     block_extents, block_nodes = create_block_list(nodes, block_size)
     
+    # columnar buffers for the landcover samples of the largest block
+    lc_points = create_lc_point_buffers(max([len(b) for b in block_nodes]) * zonesPerNode,
+                                        rasterDict.keys())
+    
     # Itterate through each block, calculate sample coordinates,
     # convert raster to array, sample the raster
     total_samples = 0
@@ -651,46 +946,58 @@ try:
         nodes_in_block.sort()
         print("Processing block {0} of {1}".format(p + 1, len(block_extents)))
         
-        # build the landcover sample list
-        lc_point_list = create_lc_point_list(nodeDict, nodes_in_block,
-                                            dirs, zones, transsample_distance)
+        # build the landcover samples
+        n = create_lc_point_list(nodeDict, nodes_in_block, template, lc_points)
         
-        for t, (type, raster) in enumerate(rasterDict.iteritems()):
-            if raster is None:
-                for i in range(0, len(lc_point_list)):
-                    lc_point_list[i].append(-9999)
-            else: 
-                if raster == z_raster:
-                    con = con_z_to_m
-                elif raster == lc_raster:
-                    con = con_lc_to_m
-                else:
-                    con = None  
-            
-                lc_point_list = sample_raster(block, lc_point_list, raster, con)
+        # sample the rasters
+        sampleDict = sample_rasters(block, lc_points["POINT_X"][:n],
+                                    lc_points["POINT_Y"][:n], runDict,
+                                    rasterInfo, conDict)
         
-            # Update the node dict
-            if (sampleID_for_code and type == "LC"):
-                for row in lc_point_list :
-                    key = "{0}_{1}".format(type, row[10])
-                    nodeDict[row[5]][key] = row[6]
-            
-            else:
-                for row in lc_point_list :
-                    key = "{0}_{1}".format(type, row[10])
-                    nodeDict[row[5]][key] = row[11 + t]
+        for type in runDict.keys():
+            lc_points[type][:n] = sampleDict[type]
         
-        # Write the landcover data to the TTools point feature class 
-        update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_in_block)
+        if use_lc_table:
+            # Write the landcover data to the long format table
+            update_lc_table(lc_points, n, runDict.keys(), sampleID_for_code,
+                            lc_table, nodes_in_block,
+                            overwrite_data and not update_only)
+        else:
+            for type in runDict.keys():
+                # Update the node dict
+                if (sampleID_for_code and type == "LC"):
+                    values = lc_points["SAMPLE_ID"][:n]
+                else:
+                    values = sampleDict[type]
+                
+                # one row of values per node in the template order
+                values = values.reshape(len(nodes_in_block), zonesPerNode).tolist()
+                keys = ["{0}_{1}".format(type, key) for key in template["KEY"]]
+                for i, nodeID in enumerate(nodes_in_block):
+                    for key, value in zip(keys, values[i]):
+                        nodeDict[nodeID][key] = value
+            
+            # Write the landcover data to the TTools point feature class 
+            update_nodes_fc(nodeDict, nodes_fc, runFields, nodes_in_block)
         
-        # Build the output point feature class using the data         
-        update_lc_point_fc(lc_point_list, rasterDict.keys(), lc_point_fc,
-                           nodes_fc, nodes_in_block, overwrite_data, proj)
+        if update_only:
+            # Update the changed raster fields of the sample points
+            update_lc_point_values(lc_points, n, runDict.keys(),
+                                   lc_point_fc, nodes_in_block)
+        else:
+            # Build the output point feature class using the data         
+            streamIDs = [nodeDict[nodeID]["STREAM_ID"] for nodeID in nodes_in_block]
+            update_lc_point_fc(lc_points, n, streamIDs, template["KEY"],
+                               rasterDict.keys(), lc_point_fc, nodes_fc,
+                               nodes_in_block, overwrite_data)
     
-        total_samples = total_samples + len(lc_point_list)
-        del lc_point_list
+        total_samples = total_samples + n
+        del sampleDict
         gc.collect()
     
+    # Save the raster fingerprints for the next run
+    write_fingerprints(fingerprint_table, fingerprints)
+    
     endTime = time.time()
     
     elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
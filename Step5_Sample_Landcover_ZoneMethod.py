@@ -22,6 +22,25 @@
 # 4: input The distance between transverse samples (transsample_distance)
 # 5: output polygon file name/path (zones_fc)
 # 6: output table file name/path (outtable_final)
+# 7: OPTIONAL - zone statistics engine (zone_engine)
+#     1. "zonal" ZonalStatisticsAsTable for each node, 2. "array" numpy zone stats by block
+# 8: OPTIONAL - km distance to process within each array (block_size)
+# 9: OPTIONAL - True/False flag to weight cells by the fraction of the
+#     cell in the zone, "array" engine only (zone_coverage)
+# 10: OPTIONAL - list of zone statistics, "array" engine only (zone_stats)
+#     any of "COUNT", "MEAN", "STD", "MIN", "MAX", "MEDIAN", or a
+#     percentile as "P10", "P90", etc. Defaults to ["MEAN", "STD"]
+# 11: OPTIONAL - number of processes to use (processes). The node
+#     blocks are split across the processes. "#" uses all cores.
+#     Default is 1. "array" engine only.
+# 12: OPTIONAL - raster reader backend, "array" engine only. Default 
+#     is "arcpy". Can also read the rasters with 1. "arcpy", 2. "gdal", 3. "numpy" arrays 
+#     added with raster_io.register_array(), or 4. "memmap" for 
+#     uncompressed GeoTIFF, ENVI, or ESRI .flt rasters (raster_backend)
+# 13: OPTIONAL - vector backend for reading and updating the nodes_fc 
+#     and updating the zones_fc attributes. Default is "arcpy". Can also 
+#     use 1. "arcpy", 2. "ogr" for GeoPackage layers, or 3. "memory" 
+#     tables added with vector_io.register_table() (vector_backend)
 
 # Import system modules
 from __future__ import division
@@ -32,8 +51,12 @@ import gc
 import time
 import traceback
 from datetime import timedelta
-from math import radians, sin, cos, ceil
+from math import ceil
 from collections import defaultdict, OrderedDict
+from multiprocessing import Pool, cpu_count
+import numpy
+from raster_io import open_raster
+from vector_io import open_table, table_exists
 import arcpy
 from arcpy import env
 
@@ -63,6 +86,13 @@ oh_raster = "#" # OPTIONAL This is the overhang raster
 z_raster = r"D:\Projects\TTools_9\JohnsonCreek.gdb\jc_be_m_mosaic"
 z_units = "Meters"
 zones_fc = r"D:\Projects\TTools_9\JohnsonCreek.gdb\LC_zones_two"
+zone_engine = "zonal" # OPTIONAL "zonal" or "array"
+block_size = "#" # OPTIONAL defualt to 5
+zone_coverage = False # OPTIONAL weight cells by the fraction in the zone
+zone_stats = "#" # OPTIONAL list of zone statistics, defualt to ["MEAN", "STD"]
+processes = 1 # OPTIONAL number of processes, "#" uses all cores
+raster_backend = "arcpy" # OPTIONAL "arcpy", "gdal", "numpy", or "memmap"
+vector_backend = "arcpy" # OPTIONAL "arcpy", "ogr", or "memory"
 overwrite_data = True
 # End Fill in Data
 # ----------------------------------------------------------------------
@@ -79,8 +109,10 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
     nodeDict = nested_dict()
     incursorFields = ["NODE_ID", "STREAM_ID", "STREAM_KM", "SHAPE@X","SHAPE@Y"]
 
+    nodes_table = open_table(nodes_fc, vector_backend)
+
     # Get a list of existing fields
-    existingFields = [f.name for f in arcpy.ListFields(nodes_fc)] 
+    existingFields = nodes_table.list_fields()
 
     # Check to see if the last field exists if yes add it. 
     # Grabs last field becuase often the first field, emergent, is zero
@@ -89,28 +121,25 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
     else:
         overwrite_data = True
 
-    # Determine input point spatial units
-    proj = arcpy.Describe(nodes_fc).spatialReference
-
-    with arcpy.da.SearchCursor(nodes_fc, incursorFields,"",proj) as Inrows:
-        if overwrite_data:
-            for row in Inrows:
+    columns = nodes_table.read_columns(incursorFields)
+    if overwrite_data:
+        for row in zip(*columns.values()):
+            # NodeID should always be int.
+            nodeID = int(row[0])
+            nodeDict[nodeID]["STREAM_ID"] = row[1] 
+            nodeDict[nodeID]["STREAM_KM"] = row[2] 
+            nodeDict[nodeID]["POINT_X"] = row[3]
+            nodeDict[nodeID]["POINT_Y"] = row[4]
+    else:
+        for row in zip(*columns.values()):
+            # Is the data null or zero, if yes grab it.
+            if row[5] is None or row[5] == 0 or row[5] < -9998:
                 # NodeID should always be int.
-                nodeID = int(row[0])
+                nodeID = int(row[0])                    
                 nodeDict[nodeID]["STREAM_ID"] = row[1] 
                 nodeDict[nodeID]["STREAM_KM"] = row[2] 
                 nodeDict[nodeID]["POINT_X"] = row[3]
                 nodeDict[nodeID]["POINT_Y"] = row[4]
-        else:
-            for row in Inrows:
-                # Is the data null or zero, if yes grab it.
-                if row[5] is None or row[5] == 0 or row[5] < -9998:
-                    # NodeID should always be int.
-                    nodeID = int(row[0])                    
-                    nodeDict[nodeID]["STREAM_ID"] = row[1] 
-                    nodeDict[nodeID]["STREAM_KM"] = row[2] 
-                    nodeDict[nodeID]["POINT_X"] = row[3]
-                    nodeDict[nodeID]["POINT_Y"] = row[4]
     
     if len(nodeDict) == 0:
         sys.exit("The fields checked in the input point feature class " +
@@ -137,6 +166,432 @@ def sample_raster(zones_fc, node, raster, con):
                 
     return data  
 
+def create_block_list(nodes, block_size):
+    """Returns two lists, one containting the coordinate extent
+    for each block that will be itterativly extracted to an array
+    and the other containing node IDs within each block extent."""
+    
+    print("Calculating block extents")    
+    x_coord_list = [nodeDict[nodeID]["POINT_X"] for nodeID in nodes]
+    y_coord_list = [nodeDict[nodeID]["POINT_Y"] for nodeID in nodes]
+    
+    # calculate the buffer distance (in raster spatial units) to add to 
+    # the base bounding box when extracting to an array. The buffer is 
+    # equal to the sample distance + 1 to make sure the block includes 
+    # all the landcover samples for each node.
+    buffer = int((transsample_count + 1) * transsample_distance * con_from_m)
+    
+    # calculate bounding box extent for samples
+    x_min = min(x_coord_list)
+    x_max = max(x_coord_list)
+    y_min = min(y_coord_list) 
+    y_max = max(y_coord_list)
+    
+    x_width = int(x_max - x_min + 1)
+    y_width = int(y_max - y_min + 1)
+    
+    block_extents = []
+    block_nodes = []
+      
+    # Build data blocks
+    for x in range(0, x_width, block_size):
+        for y in range(0, y_width, block_size):
+
+            # Lower left coordinate of block (in map units)
+            block0_x_min = min([x_min + x, x_max])
+            block0_y_min = min([y_min + y, y_max])
+            # Upper right coordinate of block (in map units)
+            block0_x_max = min([block0_x_min + block_size, x_max])
+            block0_y_max = min([block0_y_min + block_size, y_max])
+            
+            block_x_min = block0_x_max
+            block_x_max = block0_x_min
+            block_y_min = block0_y_max
+            block_y_max = block0_y_min
+            
+            nodes_in_block = []
+            for nodeID in nodes:
+                node_x = nodeDict[nodeID]["POINT_X"]
+                node_y = nodeDict[nodeID]["POINT_Y"]
+                if (block0_x_min <= node_x <= block0_x_max and
+                    block0_y_min <= node_y <= block0_y_max):
+                    
+                    nodes_in_block.append(nodeID)
+                    
+                    # Minimize the size of the block0 by the true 
+                    # extent of the nodes in the block
+                    if block_x_min > node_x: block_x_min = node_x
+                    if block_x_max < node_x: block_x_max = node_x
+                    if block_y_min > node_y: block_y_min = node_y
+                    if block_y_max < node_y: block_y_max = node_y
+            
+            if nodes_in_block:
+                # add the block extent for processing
+                # order 0 left,      1 bottom,    2 right,     3 top
+                block_extents.append((block_x_min - buffer, block_y_min - buffer,
+                                      block_x_max + buffer, block_y_max + buffer))           
+                block_nodes.append(nodes_in_block)
+    
+    return block_extents, block_nodes
+
+def get_raster_info(raster):
+    """Returns a dictionary of the raster cell size and
+    coordinate extent"""
+
+    rasterinfo = {}
+    reader = open_raster(raster, raster_backend)
+    for prop in ["CELLSIZEX", "CELLSIZEY", "LEFT", "BOTTOM", "RIGHT", "TOP"]:
+        rasterinfo[prop] = float(reader.get_property(prop))
+
+    # Rasters with the same key have cells that line up
+    rasterinfo["GRID"] = (rasterinfo["CELLSIZEX"], rasterinfo["CELLSIZEY"],
+                          round(rasterinfo["LEFT"] % rasterinfo["CELLSIZEX"], 6),
+                          round(rasterinfo["TOP"] % rasterinfo["CELLSIZEY"], 6))
+    return rasterinfo
+
+def get_block_window(block, rasterinfo):
+    """Returns the block extent adjusted to the raster cell corners
+    and the number of rows and cols"""
+
+    x_cellsize = rasterinfo["CELLSIZEX"]
+    y_cellsize = rasterinfo["CELLSIZEY"]
+
+    # Calculate the X and Y offset from the upper left node
+    # coordinates bounding box
+    x_minoffset = (block[0] - rasterinfo["LEFT"])%x_cellsize
+    y_minoffset = (block[1] - rasterinfo["BOTTOM"])%y_cellsize
+    x_maxoffset = (rasterinfo["RIGHT"] - block[2])%x_cellsize
+    y_maxoffset = (rasterinfo["TOP"] - block[3])%y_cellsize
+
+    # adjust so the coordinates are at the raster cell corners
+    block_x_min = block[0] - x_minoffset
+    block_y_min = block[1] - y_minoffset
+    block_x_max = block[2] + x_maxoffset
+    block_y_max = block[3] + y_maxoffset
+
+    # calculate the number or cols/ros from the lower left
+    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
+    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
+
+    return block_x_min, block_y_min, block_y_max, ncols, nrows
+
+def read_block_array(raster, block_x_min, block_y_min, ncols, nrows,
+                     x_cellsize, y_cellsize, con):
+    """Reads the raster within the block into a numpy array and
+    converts the values to meters if needed"""
+
+    if con is not None:
+        nodata_to_value = -9999 / con
+    else:
+        nodata_to_value = -9999
+
+    # Get the lower left cell center coordinate. This is for ESRI's
+    # RastertoNumpyArray function which defaults to the adjacent
+    # lower left cell
+    block_x_min_center = block_x_min + (x_cellsize / 2)
+    block_y_min_center = block_y_min + (y_cellsize / 2)
+
+    # Construct the array. Note returned array is (row, col) so (y, x)
+    try:
+        raster_array = open_raster(raster, raster_backend).read_numpy(block_x_min_center, block_y_min_center,
+                                                                      ncols, nrows, nodata_to_value)
+    except:
+        tbinfo = traceback.format_exc()
+        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
+        # raised instead of sys.exit so a worker process passes
+        # the error back to the main process
+        raise RuntimeError(pymsg)
+
+    # convert array values to meters if needed. A factor of 1 is
+    # skipped so a memmap window is not copied.
+    if con is not None and con != 1:
+        raster_array = raster_array * con
+
+    return raster_array
+
+def zone_label(dx, dy, dirs, angleIncr, numZones, zone_distance):
+    """Returns the sample number within the node (1 = T1_S1, the
+    same order as the sample IDs) of the zone each dx/dy offset from
+    the node is in, or -1 if it is not in any zone. Zones are the pie
+    wedges centered on each transect azimuth."""
+
+    distance = numpy.hypot(dx, dy)
+    azimuth = numpy.degrees(numpy.arctan2(dx, dy)) % 360
+
+    # transect and zone index
+    d = (((azimuth - (dirs[0] - angleIncr / 2)) % 360) // angleIncr).astype(int)
+    z = (distance // zone_distance).astype(int)
+
+    labels = 1 + (d * numZones) + z
+    labels[(d >= len(dirs)) | (z >= numZones)] = -1
+    return labels
+
+def get_zone_labels(node_x, node_y, block_x_min, block_y_max, x_cellsize,
+                    y_cellsize, nrows, ncols, dirs, angleIncr, numZones,
+                    zone_distance):
+    """Returns the flat array index, zone label, and weight of every
+    raster cell within the zone radius of each node. All are
+    (node x cell) arrays. A cell is in the zone its center is in and
+    the weight is 1."""
+
+    radius = numZones * zone_distance
+
+    # cell offsets of a window around the node cell
+    hcols = int(ceil(radius / x_cellsize)) + 1
+    hrows = int(ceil(radius / y_cellsize)) + 1
+    off_rows, off_cols = numpy.mgrid[-hrows:hrows + 1, -hcols:hcols + 1]
+    off_rows = off_rows.ravel()
+    off_cols = off_cols.ravel()
+
+    node_cols = numpy.floor((node_x - block_x_min) / x_cellsize).astype(int)
+    node_rows = numpy.floor((block_y_max - node_y) / y_cellsize).astype(int)
+    cols = node_cols[:, numpy.newaxis] + off_cols
+    rows = node_rows[:, numpy.newaxis] + off_rows
+
+    # offset from the node to each cell center
+    dx = block_x_min + (cols + 0.5) * x_cellsize - node_x[:, numpy.newaxis]
+    dy = block_y_max - (rows + 0.5) * y_cellsize - node_y[:, numpy.newaxis]
+
+    labels = zone_label(dx, dy, dirs, angleIncr, numZones, zone_distance)
+    labels[(rows < 0) | (rows >= nrows) | (cols < 0) | (cols >= ncols)] = -1
+    index = rows.clip(0, nrows - 1) * ncols + cols.clip(0, ncols - 1)
+
+    return index, labels, numpy.ones(labels.shape)
+
+# zone masks by (dirs, numZones, zone_distance, cellsize, sub-pixel offset)
+zone_mask_dict = {}
+
+def get_zone_mask(dirs, angleIncr, numZones, zone_distance, x_cellsize,
+                  y_cellsize, qx, qy, quantize=8, subsamples=8):
+    """Returns the zone mask for a node at quantized sub-pixel offset
+    qx, qy within its raster cell. The zones have the same shape for
+    every node so the mask only depends on where the node is in the
+    cell. The offset is rounded to 1/quantize of a cell. The mask
+    holds the row/col offset from the node cell, the zone label, and
+    the fraction of the cell in the zone for every cell and zone that
+    overlap. The fraction is estimated from subsamples x subsamples
+    points in each cell. Masks are kept for reuse."""
+
+    key = (tuple(dirs), angleIncr, numZones, zone_distance,
+           x_cellsize, y_cellsize, qx, qy, quantize, subsamples)
+    if key in zone_mask_dict:
+        return zone_mask_dict[key]
+
+    radius = numZones * zone_distance
+    hcols = int(ceil(radius / x_cellsize)) + 1
+    hrows = int(ceil(radius / y_cellsize)) + 1
+    off_rows, off_cols = numpy.mgrid[-hrows:hrows + 1, -hcols:hcols + 1]
+    off_rows = off_rows.ravel()
+    off_cols = off_cols.ravel()
+
+    # node position in the cell, in cells from the upper left corner
+    fx = (qx + 0.5) / quantize
+    fy = (qy + 0.5) / quantize
+    sub = (numpy.arange(subsamples) + 0.5) / subsamples
+    sub_y, sub_x = [s.ravel() for s in numpy.meshgrid(sub, sub, indexing="ij")]
+
+    dx = (off_cols[:, numpy.newaxis] + sub_x - fx) * x_cellsize
+    dy = (fy - off_rows[:, numpy.newaxis] - sub_y) * y_cellsize
+    labels = zone_label(dx, dy, dirs, angleIncr, numZones, zone_distance)
+
+    # count the subsamples of each cell in each zone
+    zonesPerNode = (len(dirs) * numZones) + 1
+    cell = numpy.repeat(numpy.arange(len(off_rows)), subsamples * subsamples)
+    inzone = labels.ravel() >= 0
+    pairs = cell[inzone] * zonesPerNode + labels.ravel()[inzone]
+    pairs, counts = numpy.unique(pairs, return_counts=True)
+
+    mask = {"ROW": off_rows[pairs // zonesPerNode],
+            "COL": off_cols[pairs // zonesPerNode],
+            "LABEL": pairs % zonesPerNode,
+            "WEIGHT": counts / (subsamples * subsamples)}
+    zone_mask_dict[key] = mask
+    return mask
+
+def get_zone_coverage(node_x, node_y, block_x_min, block_y_max, x_cellsize,
+                      y_cellsize, nrows, ncols, dirs, angleIncr, numZones,
+                      zone_distance, quantize=8):
+    """Same as get_zone_labels() but the cells are weighted by the
+    fraction of the cell in each zone, taken from the zone masks.
+    A cell can be in more than one zone of the node."""
+
+    fx = (node_x - block_x_min) / x_cellsize
+    fy = (block_y_max - node_y) / y_cellsize
+    node_cols = numpy.floor(fx).astype(int)
+    node_rows = numpy.floor(fy).astype(int)
+    qx = numpy.minimum(((fx - node_cols) * quantize).astype(int), quantize - 1)
+    qy = numpy.minimum(((fy - node_rows) * quantize).astype(int), quantize - 1)
+
+    masks = [get_zone_mask(dirs, angleIncr, numZones, zone_distance,
+                           x_cellsize, y_cellsize, qx[n], qy[n], quantize)
+             for n in range(len(node_x))]
+    length = max([len(mask["LABEL"]) for mask in masks])
+
+    # padded to the longest mask with weight 0
+    index = numpy.zeros((len(node_x), length), dtype=int)
+    labels = numpy.full((len(node_x), length), -1, dtype=int)
+    weights = numpy.zeros((len(node_x), length))
+    for n, mask in enumerate(masks):
+        m = len(mask["LABEL"])
+        rows = node_rows[n] + mask["ROW"]
+        cols = node_cols[n] + mask["COL"]
+        inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+        index[n, :m] = rows.clip(0, nrows - 1) * ncols + cols.clip(0, ncols - 1)
+        labels[n, :m] = numpy.where(inside, mask["LABEL"], -1)
+        weights[n, :m] = mask["WEIGHT"]
+
+    return index, labels, weights
+
+def zone_statistics(zone, values, weights, nzones, stats):
+    """Calculates the statistics for each zone in one pass over the
+    cell values. zone is the zone label of each value, 0 to nzones-1,
+    and weights is the weight of each value. Supported statistics
+    are COUNT (sum of the weights), MEAN, STD (population standard
+    deviation), MIN, MAX, MEDIAN, and percentiles as P10, P90, etc.
+    The percentiles are the first value where the cumulative weight of
+    the sorted values reaches the percentile, so the MEDIAN of an even
+    number of values is the lower of the middle two. Returns a
+    dictionary of the statistic arrays. Zones with no data are -9999
+    except COUNT which is 0."""
+
+    statDict = {}
+
+    count = numpy.bincount(zone, weights, minlength=nzones)
+    has_data = count > 0
+    if "COUNT" in stats:
+        statDict["COUNT"] = count
+
+    mean = numpy.full(nzones, -9999.0)
+    mean[has_data] = numpy.bincount(zone, weights * values,
+                                    minlength=nzones)[has_data] / count[has_data]
+    if "MEAN" in stats:
+        statDict["MEAN"] = mean
+
+    if "STD" in stats:
+        # the deviations are from the zone mean so it is numerically
+        # stable without a second pass over the raster
+        dev = values - mean[zone]
+        std = numpy.full(nzones, -9999.0)
+        std[has_data] = numpy.sqrt(numpy.bincount(zone, weights * dev * dev,
+                                                  minlength=nzones)[has_data] / count[has_data])
+        statDict["STD"] = std
+
+    order_stats = [s for s in stats if s in ["MIN", "MAX", "MEDIAN"] or s.startswith("P")]
+    if order_stats and len(zone) > 0:
+        # sort by zone then value
+        order = numpy.lexsort((values, zone))
+        zone_s = zone[order]
+        values_s = values[order]
+        cum_weights = numpy.cumsum(weights[order])
+
+        starts = numpy.flatnonzero(numpy.r_[True, zone_s[1:] != zone_s[:-1]])
+        ends = numpy.r_[starts[1:], len(zone_s)] - 1
+        zones_in = zone_s[starts]
+        weights_before = cum_weights[starts] - weights[order][starts]
+
+        for s in order_stats:
+            stat = numpy.full(nzones, -9999.0)
+            if s == "MIN":
+                stat[zones_in] = values_s[starts]
+            elif s == "MAX":
+                stat[zones_in] = values_s[ends]
+            else:
+                if s == "MEDIAN":
+                    percent = 50.0
+                else:
+                    percent = float(s[1:])
+                target = weights_before + (percent / 100) * count[zones_in]
+                k = numpy.searchsorted(cum_weights, target - 1e-9 * count[zones_in])
+                stat[zones_in] = values_s[k.clip(starts, ends)]
+            statDict[s] = stat
+    else:
+        for s in order_stats:
+            statDict[s] = numpy.full(nzones, -9999.0)
+
+    return statDict
+
+def sample_zone_stats(block, nodeDict, nodes_in_block, rasterDict, rasterInfo,
+                      conDict, dirs, angleIncr, numZones, zone_distance,
+                      zone_coverage=False, stats=["MEAN", "STD"],
+                      max_cells=4000000):
+    """Calculates the statistics of the raster cells in every zone
+    of every node in the block. The rasters are read once for the
+    block. Cells are labeled by zone with array math and all the
+    statistics are calculated together by zone_statistics() so there
+    is no per node geoprocessing. When zone_coverage is True the cells
+    are weighted by the fraction of the cell in the zone. Returns a
+    dictionary for each raster type holding a (node x sample) array
+    for each statistic in the order of the sample IDs."""
+
+    zonesPerNode = (len(dirs) * numZones) + 1
+    nnodes = len(nodes_in_block)
+    node_x = numpy.array([nodeDict[nodeID]["POINT_X"] for nodeID in nodes_in_block])
+    node_y = numpy.array([nodeDict[nodeID]["POINT_Y"] for nodeID in nodes_in_block])
+
+    if zone_coverage:
+        get_cells = get_zone_coverage
+    else:
+        get_cells = get_zone_labels
+
+    # group the rasters that have the same grid
+    gridDict = OrderedDict()
+    for type, raster in rasterDict.iteritems():
+        gridDict.setdefault(rasterInfo[raster]["GRID"], []).append(type)
+
+    statDict = {}
+    for types in gridDict.values():
+        rasterinfo = rasterInfo[rasterDict[types[0]]]
+        x_cellsize = rasterinfo["CELLSIZEX"]
+        y_cellsize = rasterinfo["CELLSIZEY"]
+        (block_x_min, block_y_min, block_y_max,
+         ncols, nrows) = get_block_window(block, rasterinfo)
+
+        arrays = [read_block_array(rasterDict[type], block_x_min,
+                                   block_y_min, ncols, nrows,
+                                   x_cellsize, y_cellsize,
+                                   conDict[type]).ravel() for type in types]
+
+        for type in types:
+            statDict[type] = dict((s, numpy.zeros((nnodes, zonesPerNode))) for s in stats)
+
+        # nodes are done in chunks to limit the (node x cell) arrays.
+        # All the cells of a zone are in the same chunk.
+        window = (2 * int(ceil(numZones * zone_distance / x_cellsize)) + 3) * \
+                 (2 * int(ceil(numZones * zone_distance / y_cellsize)) + 3)
+        chunk = max(int(max_cells / window), 1)
+        for i in range(0, nnodes, chunk):
+            j = min(i + chunk, nnodes)
+            index, labels, weights = get_cells(node_x[i:j], node_y[i:j],
+                                               block_x_min, block_y_max,
+                                               x_cellsize, y_cellsize,
+                                               nrows, ncols, dirs, angleIncr,
+                                               numZones, zone_distance)
+
+            # label of the zone over all the nodes in the chunk
+            labels = numpy.where(labels >= 0, labels +
+                                 numpy.arange(j - i)[:, numpy.newaxis] * zonesPerNode, -1)
+
+            for t, raster_array in enumerate(arrays):
+                values = raster_array[index]
+                valid = (labels >= 0) & (values > -9999)
+                chunkDict = zone_statistics(labels[valid],
+                                            values[valid].astype(numpy.float64),
+                                            weights[valid],
+                                            (j - i) * zonesPerNode, stats)
+                for s in stats:
+                    statDict[types[t]][s][i:j] = chunkDict[s].reshape(j - i, zonesPerNode)
+            del index, labels, weights
+
+        del arrays
+
+    return statDict
+
+def zone_worker(args):
+    """Calculates the zone statistics for one block of nodes in a
+    worker process and returns them to the writer"""
+
+    return sample_zone_stats(*args)
+
 def setup_lcdata_headers(transsample_count, trans_count,
                           canopy_data_type, stream_sample):
     """Generates a list of the landcover data file
@@ -185,15 +640,11 @@ def setup_lcdata_headers(transsample_count, trans_count,
 def update_zones_fc(zonesDict, type, zones_fc):
     """Updates the zone feature class with data from the dictionary"""
     
-    # Build a query to retreive just the samples that needs updating
-    whereclause = """{0} IN ({1})""".format("SAMPLE_ID", ','.join(str(i) for i in zonesDict.keys()))
-
-    with arcpy.da.UpdateCursor(zones_fc,["SAMPLE_ID"] + type, whereclause) as cursor:  
-        for row in cursor:
-            for f, field in enumerate(type):
-                sampleID = row[0]
-                row[f+1] = zonesDict[sampleID][f]
-                cursor.updateRow(row)
+    sampleIDs = zonesDict.keys()
+    columns = OrderedDict([("SAMPLE_ID", sampleIDs)])
+    for f, field in enumerate(type):
+        columns[field] = [zonesDict[sampleID][f] for sampleID in sampleIDs]
+    open_table(zones_fc, vector_backend).update_columns("SAMPLE_ID", columns)
 
 def from_meters_con(inFeature):
     """Returns the conversion factor to get from meters to the
@@ -225,14 +676,68 @@ def from_z_units_to_meters_con(zUnits):
     
     return con_z_to_m
 
+def create_zone_rings(dirs, zones, angleIncr, transsample_distance):
+    """Returns the vertex x/y offsets from the node for the polygon
+    ring of every zone as a (sample x vertex x 2) array in the order
+    of the sample IDs, and the number of vertices in each ring. The
+    first zone of each transect is a triangle shape with 6 vertices,
+    the others have 9. Short rings are padded with the last vertex."""
+
+    angleIncr_sub = angleIncr / 3.0
+    numZones = len(zones)
+
+    rings = numpy.zeros(((len(dirs) * numZones) + 1, 9, 2))
+    nverts = numpy.zeros((len(dirs) * numZones) + 1, dtype=int)
+
+    for d, dir in enumerate(dirs):
+        # angles of the 4 vertices along the wedge arc
+        angles = numpy.radians(dir - (angleIncr / 2) + numpy.arange(4) * angleIncr_sub)
+        unit = numpy.column_stack((numpy.sin(angles), numpy.cos(angles)))
+
+        for z, zone in enumerate(zones):
+            botDis = (z + 0) * transsample_distance
+            topDis = (z + 1) * transsample_distance
+
+            # top start to end then bottom end back to start
+            if zone == 1:
+                ring = numpy.vstack((unit[:1] * botDis, unit * topDis,
+                                     unit[-1:] * botDis))
+            else:
+                ring = numpy.vstack((unit[:1] * botDis, unit * topDis,
+                                     unit[::-1] * botDis))
+
+            s = (d * numZones) + zone
+            nverts[s] = len(ring)
+            rings[s, :len(ring)] = ring
+            rings[s, len(ring):] = ring[-1]
+
+    return rings, nverts
+
 def make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones, type,
-                  transsample_distance, heatsource8, proj):
+                  transsample_distance, heatsource8, proj,
+                  stats=["MEAN", "STD"], chunk_size=1000):
     """This builds the zones feature class and returns a dictionary of
     of the samples IDs as the key and a list of the node ID and LC key
     for the values"""
-    
-    print("Making zones fc. May take awhile for big datasets")
-           
+
+    print("Making zones fc")
+
+    # Add the statistic fields
+    stat_fields = ["{0}_{1}".format(t, s) for t in type for s in stats]
+
+    typeDict = {"NODE_ID": "LONG",
+                "SAMPLE_ID": "LONG",
+                "TRANS_AZIMUTH": "DOUBLE",
+                "TRANSECT": "SHORT",
+                "ZONE": "SHORT",
+                "KEY": "TEXT",}
+
+    for t in stat_fields:
+        typeDict[t] = "DOUBLE"
+
+    addFields = ["NODE_ID", "SAMPLE_ID", "TRANS_AZIMUTH",
+                 "TRANSECT", "ZONE", "KEY"] + stat_fields
+
     # Check if the output exists and create if not
     if not arcpy.Exists(zones_fc):
         arcpy.CreateFeatureclass_management(os.path.dirname(zones_fc),
@@ -244,28 +749,12 @@ def make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones, type,
         sid_precision = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].precision
         sid_scale = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].scale
         sid_length = arcpy.ListFields(nodes_fc,"STREAM_ID")[0].length
-        
-        typeDict = {"NODE_ID": "LONG",
-                    "SAMPLE_ID": "LONG",
-                    "TRANS_AZIMUTH": "DOUBLE",
-                    "TRANSECT": "SHORT",
-                    "ZONE": "SHORT",
-                    "KEY": "TEXT",}
-        
-        # Add MEAN and STD fields
-        stat_fields = ["{0}_{1}".format(t, s) for t in type for s in ["MEAN", "STD"]]
-        
-        for t in stat_fields:
-            typeDict[t] = "DOUBLE"
 
         # Add attribute fields
         # STREAM_ID
         arcpy.AddField_management(zones_fc, "STREAM_ID", sid_type,
                                   sid_precision, sid_scale, sid_length,
                                   "", "NULLABLE", "NON_REQUIRED")
-        
-        addFields = ["NODE_ID", "SAMPLE_ID", "TRANS_AZIMUTH",
-                        "TRANSECT", "ZONE", "KEY"] + stat_fields
 
         for f in addFields:
             arcpy.AddField_management(zones_fc, f, typeDict[f], "", "", "",
@@ -273,10 +762,7 @@ def make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones, type,
     else:        
         # Check to see if all the stat attribute fields are there
         field_names = [f.name for f in arcpy.ListFields(zones_fc)]
-        
-        # Add MEAN and STD fields
-        stat_fields = ["{0}_{1}".format(t, s) for t in type for s in ["MEAN", "STD"]]
-        
+
         for f in stat_fields:
             if f not in field_names:
                 arcpy.AddField_management(zones_fc, f, typeDict[f], "", "", "",
@@ -299,281 +785,338 @@ def make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones, type,
         angleIncr = 45.0
     else:
         angleIncr = 360.0 / numDirs
-        
-    angleIncr_sub = angleIncr / 3.0
 
-    polyArray = arcpy.Array()
-    pntObj = arcpy.Point()
-    
+    # vertex offsets of every zone, the same for each node
+    rings, nverts = create_zone_rings(dirs, zones, angleIncr,
+                                      transsample_distance * con_from_m)
+
+    # attributes of each zone in the order of the sample IDs
+    zone_attributes = [None]
+    for d, dir in enumerate(dirs):
+        for zone in zones:
+            zone_attributes.append([dir, d + 1, zone,
+                                    'T{0}_S{1}'.format(d + 1, zone)])
+    no_data = [-9999 for t in stat_fields]
+
     sampleDict = {}
-    
+
     with arcpy.da.InsertCursor(zones_fc, ["SHAPE@", "STREAM_ID"] +
-                               addFields) as cursor:    
-        for nodeID in nodes:
-            #print("making zone fc: {0:.0f}% complete".format((nodeID+1)/len(nodes) *100))
-            origin_x = nodeDict[nodeID]["POINT_X"]
-            origin_y = nodeDict[nodeID]["POINT_Y"]
-            streamID = nodeDict[nodeID]["STREAM_ID"]
-            
-            sampleID = (nodeID * zonesPerNode)
-            sampleDict[sampleID] = [nodeID, "T0_S0"]
-        
-            for d, dir in enumerate(dirs):
-                angleStart = dir - (angleIncr / 2)
-                angle = angleStart
-                
-                for z, zone in enumerate(zones):
-                    # each sample zone
-                    
-                    key = 'T{0}_S{1}'.format(d+1, zone)
-                    tran_num = '{:{}{}}'.format(d+1, 0, 3)
-                    samp_num = '{:{}{}}'.format(zone, 0, 2)
-                    sampleID = (nodeID * zonesPerNode) + (d * numZones) + zone
-                    
+                               addFields) as cursor:
+        for i in range(0, len(nodes), chunk_size):
+            chunk = nodes[i:i + chunk_size]
+            origin = numpy.array([[nodeDict[nodeID]["POINT_X"],
+                                   nodeDict[nodeID]["POINT_Y"]] for nodeID in chunk])
+
+            # (node x sample x vertex x 2) vertex coordinates
+            vertices = (origin[:, numpy.newaxis, numpy.newaxis, :] + rings).tolist()
+
+            for n, nodeID in enumerate(chunk):
+                streamID = nodeDict[nodeID]["STREAM_ID"]
+                sampleID = (nodeID * zonesPerNode)
+                sampleDict[sampleID] = [nodeID, "T0_S0"]
+
+                for s in range(1, zonesPerNode):
+                    sampleID = (nodeID * zonesPerNode) + s
+                    dir, tran_num, zone, key = zone_attributes[s]
                     sampleDict[sampleID] = [nodeID, key]
-                
-                    botDis = (z + 0) * transsample_distance * con_from_m
-                    topDis = (z + 1) * transsample_distance * con_from_m
-                    
-                    #iterate through each vertex X/Y to complete the polygon
-                    if zone == 1: # First veg zone that is a triangle shape
-                        for vertex in range(6):
-                            if vertex in [0]: #bottom start angle
-                                pntObj.X = (botDis * sin(radians(angleStart))) + origin_x
-                                pntObj.Y = (botDis * cos(radians(angleStart))) + origin_y
-                            if vertex in [1]: #top start angle
-                                pntObj.X = (topDis * sin(radians(angleStart))) + origin_x
-                                pntObj.Y = (topDis * cos(radians(angleStart))) + origin_y
-                            if vertex in [2,3,4]: # top 2-5
-                                angle = angle + angleIncr_sub
-                                pntObj.X = (topDis * sin(radians(angle))) + origin_x
-                                pntObj.Y = (topDis * cos(radians(angle))) + origin_y
-                            if vertex in [5]: #bottom end angle
-                                pntObj.X = (botDis * cos(radians(angle))) + origin_x
-                                pntObj.Y = (botDis * cos(radians(angle))) + origin_y
-                                angle = angle - (angleIncr_sub * 3)
-                            polyArray.add(pntObj)
-                    if zone > 1:
-                        for vertex in range(9):
-                            if vertex in [0]: #bottom start angle
-                                pntObj.X = (botDis * sin(radians(angleStart))) + origin_x
-                                pntObj.Y = (botDis * cos(radians(angleStart))) + origin_y
-                            if vertex in [1]: #top start angle
-                                pntObj.X = (topDis * sin(radians(angleStart))) + origin_x
-                                pntObj.Y = (topDis * cos(radians(angleStart))) + origin_y
-                            if vertex in [2,3,4]: # top 2-5
-                                angle = angle + angleIncr_sub
-                                pntObj.X = (topDis * sin(radians(angle))) + origin_x
-                                pntObj.Y = (topDis * cos(radians(angle))) + origin_y
-                            if vertex in [5]: #bottom end angle
-                                pntObj.X = (botDis * sin(radians(angle))) + origin_x
-                                pntObj.Y = (botDis * cos(radians(angle))) + origin_y
-                            if vertex in [6,7,8]: # bottom 7-10
-                                angle =  angle - angleIncr_sub
-                                pntObj.X = (botDis * sin(radians(angle))) + origin_x
-                                pntObj.Y = (botDis * cos(radians(angle))) + origin_y
-                            polyArray.add(pntObj)
-                    del vertex        
-                    
-                    this_zone = [arcpy.Polygon(polyArray), streamID, nodeID,
-                                 sampleID, dir, d+1, zone, key]
-                    
-                    this_zone = this_zone + [-9999 for t in stat_fields]
-                    cursor.insertRow(this_zone) 
-                    
-                    polyArray.removeAll()
+
+                    polyArray = arcpy.Array([arcpy.Point(x, y) for x, y in
+                                             vertices[n][s][:nverts[s]]])
+
+                    cursor.insertRow([arcpy.Polygon(polyArray), streamID, nodeID,
+                                      sampleID, dir, tran_num, zone, key] + no_data)
+            del vertices
     return sampleDict
                     
-def update_nodes_fc(nodeDict, nodes_fc, addFields, node_to_query):
+def update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_query):
     """Updates the input point feature class with data from the
     nodes dictionary"""
     
-    # Build a query to retreive just the nodes that needs updating
-    whereclause = """{0} IN ({1})""".format("NODE_ID", node_to_query)
-
-    with arcpy.da.UpdateCursor(nodes_fc,["NODE_ID"] + addFields, whereclause) as cursor:  
-        for row in cursor:
-            nodeID = int(row[0])
-            for f, field in enumerate(addFields):
-                row[f+1] = nodeDict[nodeID][field]
-                cursor.updateRow(row)
+    columns = OrderedDict([("NODE_ID", nodes_to_query)])
+    for field in addFields:
+        columns[field] = [nodeDict[nodeID][field] for nodeID in nodes_to_query]
+    open_table(nodes_fc, vector_backend).update_columns("NODE_ID", columns)
                 
-try:
-    print("Step 5: Sample Landcover - Star Pattern, Zone Method")
+if __name__ == "__main__":
+    try:
+        print("Step 5: Sample Landcover - Star Pattern, Zone Method")
     
-    #keeping track of time
-    startTime= time.time()
+        #keeping track of time
+        startTime= time.time()
     
-    # Check if the node fc exists
-    if not arcpy.Exists(nodes_fc):
-        arcpy.AddError("\nThis output does not exist: \n" +
-                       "{0}\n".format(nodes_fc))
-        sys.exit("This output does not exist: \n" +
-                 "{0}\n".format(nodes_fc))
+        # Check if the node fc exists
+        if not table_exists(nodes_fc, vector_backend):
+            arcpy.AddError("\nThis output does not exist: \n" +
+                           "{0}\n".format(nodes_fc))
+            sys.exit("This output does not exist: \n" +
+                     "{0}\n".format(nodes_fc))
     
-    # Check if the zone fc exists and delete if needed
-    if arcpy.Exists(zones_fc) and overwrite_data:
-        arcpy.Delete_management(zones_fc)
+        if zone_stats in ["#", ""]:
+            zone_stats = ["MEAN", "STD"]
+
+        # Check the zone statistics
+        for s in zone_stats:
+            if not (s in ["COUNT", "MEAN", "STD", "MIN", "MAX", "MEDIAN"] or
+                    (s[:1] == "P" and s[1:].replace(".", "", 1).isdigit() and
+                     0 <= float(s[1:]) <= 100)):
+                arcpy.AddError("{0} is not a supported zone statistic".format(s))
+                sys.exit("{0} is not a supported zone statistic".format(s))
+
+        if zone_engine != "array" and zone_stats != ["MEAN", "STD"]:
+            arcpy.AddError("Only MEAN and STD zone statistics can be used "+
+                           "with the zonal engine. Use the array engine.")
+            sys.exit("Only MEAN and STD zone statistics can be used "+
+                     "with the zonal engine. Use the array engine.")
+
+        # Check if the zone fc exists and delete if needed
+        if arcpy.Exists(zones_fc) and overwrite_data:
+            arcpy.Delete_management(zones_fc)
     
     
-    # Determine input spatial units and set unit conversion factors
-    proj = arcpy.Describe(nodes_fc).SpatialReference
-    proj_ele = arcpy.Describe(z_raster).spatialReference
-    proj_lc = arcpy.Describe(lc_raster).spatialReference
+        # Determine input spatial units and set unit conversion factors
+        proj = arcpy.Describe(nodes_fc).SpatialReference
+        proj_ele = arcpy.Describe(z_raster).spatialReference
+        proj_lc = arcpy.Describe(lc_raster).spatialReference
     
-    con_from_m = from_meters_con(nodes_fc)
-    con_lc_to_m = from_z_units_to_meters_con(lc_units)
-    con_z_to_m = from_z_units_to_meters_con(z_units)
+        con_from_m = from_meters_con(nodes_fc)
+        con_lc_to_m = from_z_units_to_meters_con(lc_units)
+        con_z_to_m = from_z_units_to_meters_con(z_units)
         
-    # Check to make sure the raster and input 
-    # points are in the same projection.
-    if proj.name != proj_ele.name:
-        arcpy.AddError("{0} and {1} do not ".format(nodes_fc,z_raster)+
-                       "have the same projection."+
-                       "Please reproject your data.")
-        sys.exit("Input points and elevation raster do not have the "+
-                 "same projection. Please reproject your data.")    
-    
-    if proj_lc.name != proj_ele.name:
-        arcpy.AddError("{0} and {1} do not ".format(proj_lc,z_raster)+
-                       "have the same projection."+
-                       "Please reproject your data.")
-        sys.exit("The landcover and elevation rasters do not have the "+
-                 "same projection. Please reproject your data.")    
+        # Check to make sure the raster and input 
+        # points are in the same projection.
+        if proj.name != proj_ele.name:
+            arcpy.AddError("{0} and {1} do not ".format(nodes_fc,z_raster)+
+                           "have the same projection."+
+                           "Please reproject your data.")
+            sys.exit("Input points and elevation raster do not have the "+
+                     "same projection. Please reproject your data.")    
+    
+        if proj_lc.name != proj_ele.name:
+            arcpy.AddError("{0} and {1} do not ".format(proj_lc,z_raster)+
+                           "have the same projection."+
+                           "Please reproject your data.")
+            sys.exit("The landcover and elevation rasters do not have the "+
+                     "same projection. Please reproject your data.")    
        
-    # Setup the raster dictionary. It is ordered because
-    # key list needs to correspond to the order of the attribute fields
-    rasterDict = OrderedDict({"LC": lc_raster,
-                              "ELE": z_raster})
-    
-    if canopy_data_type == "LAI":  #Use LAI methods
-        if canopy_raster is not "#":
-            rasterDict["LAI"] = canopy_raster
+        # Setup the raster dictionary. It is ordered because
+        # key list needs to correspond to the order of the attribute fields
+        rasterDict = OrderedDict({"LC": lc_raster,
+                                  "ELE": z_raster})
+    
+        if canopy_data_type == "LAI":  #Use LAI methods
+            if canopy_raster is not "#":
+                rasterDict["LAI"] = canopy_raster
             
-        if k_raster is not "#":
-            rasterDict["k"] = k_raster
+            if k_raster is not "#":
+                rasterDict["k"] = k_raster
 
-        if oh_raster is not "#":
-            rasterDict["OH"] = oh_raster
+            if oh_raster is not "#":
+                rasterDict["OH"] = oh_raster
         
-    if canopy_data_type == "CanopyCover":  #Use Canopy Cover methods
-        if canopy_raster is not "#":
-            rasterDict["CAN"] = canopy_raster
+        if canopy_data_type == "CanopyCover":  #Use Canopy Cover methods
+            if canopy_raster is not "#":
+                rasterDict["CAN"] = canopy_raster
 
-        if oh_raster is not "#":
-            rasterDict["OH"] = oh_raster
+            if oh_raster is not "#":
+                rasterDict["OH"] = oh_raster
     
-    # There is no stream sample for zones
-    stream_sample = False
+        # There is no stream sample for zones
+        stream_sample = False
     
-    # flag indicating the model should use the heat source 8 methods 
-    # same as 8 directions but no north
-    if heatsource8:
-        dirs = [45,90,135,180,225,270,315]
-        trans_count = 7
-    else:        
-        dirs = [x * 360.0 / trans_count for x in range(1,trans_count+ 1)]
+        # flag indicating the model should use the heat source 8 methods 
+        # same as 8 directions but no north
+        if heatsource8:
+            dirs = [45,90,135,180,225,270,315]
+            trans_count = 7
+        else:        
+            dirs = [x * 360.0 / trans_count for x in range(1,trans_count+ 1)]
 
-    zones = range(1,int(transsample_count+1))
+        zones = range(1,int(transsample_count+1))
     
-    lcheaders, otherheaders = setup_lcdata_headers(transsample_count, trans_count,
-                                            canopy_data_type, stream_sample)
+        lcheaders, otherheaders = setup_lcdata_headers(transsample_count, trans_count,
+                                                canopy_data_type, stream_sample)
     
-    addFields = lcheaders + otherheaders
+        addFields = lcheaders + otherheaders
     
-    # Get a list of existing fields
-    # Check to see if all the type attribute fields are there
-    existingFields = [f.name for f in arcpy.ListFields(nodes_fc)]    
+        # Get a list of existing fields
+        # Check to see if all the type attribute fields are there
+        nodes_table = open_table(nodes_fc, vector_backend)
+        existingFields = nodes_table.list_fields()
         
-    # Check to see if the field exists and add it if not
-    for f in lcheaders:
-        if not (f in existingFields):
-            arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
-                                      "", "NULLABLE", "NON_REQUIRED")    
-
-    # Check to see if the field exists and add it if not
-    for f in otherheaders:
-        if not (f in existingFields):
-            arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
-                                      "", "NULLABLE", "NON_REQUIRED")   
-    
-    # read the node data into the node dictionary
-    nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
-    
-    # Get a list of the nodes, sort them
-    nodes = nodeDict.keys()
-    nodes.sort()
-    
-    # build the zone list
-    sampleDict = make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones,
-                               rasterDict.keys(), transsample_distance,
-                               heatsource8, proj)
-    
-    stat_fields = ["{0}_{1}".format(t, s) for t in rasterDict.keys() for s in ["MEAN", "STD"] ]
-    
-    for n, nodeID in enumerate(nodes):
-        print("Processing node {0} of {1}".format(n + 1, len(nodes)))
+        # Check to see if the field exists and add it if not
+        nodes_table.add_fields([(f, "DOUBLE") for f in lcheaders + otherheaders
+                                if not (f in existingFields)])
+    
+        # read the node data into the node dictionary
+        nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
+    
+        # Get a list of the nodes, sort them
+        nodes = nodeDict.keys()
+        nodes.sort()
+    
+        # build the zone list
+        sampleDict = make_zones_fc(nodeDict, zones_fc, nodes, dirs, zones,
+                                   rasterDict.keys(), transsample_distance,
+                                   heatsource8, proj, zone_stats)
+    
+        stat_fields = ["{0}_{1}".format(t, s) for t in rasterDict.keys() for s in zone_stats]
+    
+        if zone_engine == "array":
+            # convert block size from km to meters to units of the node fc
+            if block_size in ["#", ""]:
+                block_size = int(con_from_m * 5000)
+            else:
+                block_size = int(con_from_m * block_size * 1000)
+
+            numZones = len(zones)
+            zonesPerNode = (len(dirs) * numZones) + 1
+            if heatsource8:
+                angleIncr = 45.0
+            else:
+                angleIncr = 360.0 / len(dirs)
+            zone_distance = transsample_distance * con_from_m
+
+            # the MEAN is always needed for the node fc
+            stats = zone_stats + [s for s in ["MEAN"] if s not in zone_stats]
+
+            conDict = {}
+            rasterInfo = {}
+            for type, raster in rasterDict.iteritems():
+                if raster == z_raster:
+                    conDict[type] = con_z_to_m
+                elif raster == lc_raster:
+                    conDict[type] = con_lc_to_m
+                else:
+                    conDict[type] = None
+                if raster not in rasterInfo:
+                    rasterInfo[raster] = get_raster_info(raster)
+
+            block_extents, block_nodes = create_block_list(nodes, block_size)
+            for nodes_in_block in block_nodes:
+                nodes_in_block.sort()
+
+            # the arguments for sample_zone_stats() for each block. Only
+            # the node coordinates are sent to the worker processes.
+            block_args = ((block, dict((nodeID, {"POINT_X": nodeDict[nodeID]["POINT_X"],
+                                                 "POINT_Y": nodeDict[nodeID]["POINT_Y"]})
+                                       for nodeID in block_nodes[p]),
+                           block_nodes[p], rasterDict, rasterInfo, conDict, dirs,
+                           angleIncr, numZones, zone_distance, zone_coverage, stats)
+                          for p, block in enumerate(block_extents))
+
+            if processes in ["#", ""]:
+                processes = cpu_count()
+            else:
+                processes = int(processes)
+
+            pool = None
+            try:
+                if processes > 1:
+                    # the workers sample the blocks and this process is the
+                    # only one that writes to the feature classes
+                    pool = Pool(processes)
+                    block_stats = pool.imap(zone_worker, block_args)
+                else:
+                    block_stats = (zone_worker(args) for args in block_args)
+
+                for p, statDict in enumerate(block_stats):
+                    nodes_in_block = block_nodes[p]
+                    print("Processing block {0} of {1}".format(p + 1, len(block_extents)))
+
+                    sampleDict2 = defaultdict(list)
+                    for type in rasterDict.keys():
+                        mean = statDict[type]["MEAN"]
+                        for n, nodeID in enumerate(nodes_in_block):
+                            for s in range(1, zonesPerNode):
+                                sampleID = (nodeID * zonesPerNode) + s
+                                key = "{0}_{1}".format(type, sampleDict[sampleID][1])
+                                if sampleID_for_code and type == "LC":
+                                    nodeDict[nodeID][key] = sampleID
+                                else:
+                                    nodeDict[nodeID][key] = mean[n, s]
+                                for stat in zone_stats:
+                                    sampleDict2[sampleID].append(statDict[type][stat][n, s])
+                    del statDict
+
+                    # update zones fc with new sampled values
+                    update_zones_fc(sampleDict2, stat_fields, zones_fc)
+
+                    # Write the landcover data to the TTools point feature class
+                    update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_in_block)
+                    gc.collect()
+
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            finally:
+                # stop the workers if a block fails
+                if pool is not None:
+                    pool.terminate()
+
+        else:
+            for n, nodeID in enumerate(nodes):
+                print("Processing node {0} of {1}".format(n + 1, len(nodes)))
         
-        sampleDict2 = defaultdict(list)
+                sampleDict2 = defaultdict(list)
         
-        for type, raster in rasterDict.iteritems():
-            if raster == z_raster:
-                con = con_z_to_m
-            elif raster == lc_raster:
-                con = con_lc_to_m
-            else:
-                con = None  
+                for type, raster in rasterDict.iteritems():
+                    if raster == z_raster:
+                        con = con_z_to_m
+                    elif raster == lc_raster:
+                        con = con_lc_to_m
+                    else:
+                        con = None  
 
-            data_list = sample_raster(zones_fc, nodeID, raster, con) 
+                    data_list = sample_raster(zones_fc, nodeID, raster, con) 
             
-            # Update the node fc
-            if sampleID_for_code:
-                for row in data_list:
-                    key = "{0}_{1}".format(type, sampleDict[row[0]][1])
-                    nodeDict[nodeID][key] = row[0]
-                    sampleDict2[row[0]].append(row[1])
-                    sampleDict2[row[0]].append(row[2])
+                    # Update the node fc
+                    if sampleID_for_code:
+                        for row in data_list:
+                            key = "{0}_{1}".format(type, sampleDict[row[0]][1])
+                            nodeDict[nodeID][key] = row[0]
+                            sampleDict2[row[0]].append(row[1])
+                            sampleDict2[row[0]].append(row[2])
             
-            else:
-                for row in data_list:
-                    key = "{0}_{1}".format(type, sampleDict[row[0]][1])
-                    nodeDict[nodeID][key] = row[1]
-                    sampleDict2[row[0]].append(row[1])
-                    sampleDict2[row[0]].append(row[2])
+                    else:
+                        for row in data_list:
+                            key = "{0}_{1}".format(type, sampleDict[row[0]][1])
+                            nodeDict[nodeID][key] = row[1]
+                            sampleDict2[row[0]].append(row[1])
+                            sampleDict2[row[0]].append(row[2])
             
-        # update zones fc with new sampled values       
-        update_zones_fc(sampleDict2, stat_fields, zones_fc)
+                # update zones fc with new sampled values       
+                update_zones_fc(sampleDict2, stat_fields, zones_fc)
 
-        # Write the landcover data to the TTools point feature class 
-        update_nodes_fc(nodeDict, nodes_fc, addFields, nodeID)      
+                # Write the landcover data to the TTools point feature class 
+                update_nodes_fc(nodeDict, nodes_fc, addFields, [nodeID])      
     
     
-    endTime = time.time()
+        endTime = time.time()
     
-    gc.collect()
+        gc.collect()
 
-    total_samples = trans_count * transsample_count * len(nodes)
-    elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
-    mspersample = timedelta(seconds=(endTime - startTime) /
-                            total_samples).microseconds
-    print("Process Complete in {0} minutes. {1} microseconds per sample".format(elapsedmin, mspersample))
-    #arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per sample" % (elapsedmin, mspersample))
+        total_samples = trans_count * transsample_count * len(nodes)
+        elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
+        mspersample = timedelta(seconds=(endTime - startTime) /
+                                total_samples).microseconds
+        print("Process Complete in {0} minutes. {1} microseconds per sample".format(elapsedmin, mspersample))
+        #arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per sample" % (elapsedmin, mspersample))
 
-# For arctool errors
-except arcpy.ExecuteError:
-    msgs = arcpy.GetMessages(2)
-    #arcpy.AddError(msgs)
-    print(msgs)
+    # For arctool errors
+    except arcpy.ExecuteError:
+        msgs = arcpy.GetMessages(2)
+        #arcpy.AddError(msgs)
+        print(msgs)
 
-# For other errors
-except:
-    tbinfo = traceback.format_exc()
+    # For other errors
+    except:
+        tbinfo = traceback.format_exc()
 
-    pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
-    msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
+        pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
+        msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
 
-    #arcpy.AddError(pymsg)
-    #arcpy.AddError(msgs)
+        #arcpy.AddError(pymsg)
+        #arcpy.AddError(msgs)
 
-    print(pymsg)
-    print(msgs)
+        print(pymsg)
+        print(msgs)
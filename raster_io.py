@@ -0,0 +1,626 @@
+########################################################################
+# TTools
+# Raster readers
+# Ryan Michie
+
+# Raster access used by the TTools steps. Each reader has the same
+# interface so the sampling code does not depend on where the raster
+# comes from:
+#
+#   reader.get_property(name) - same names as arcpy's
+#       GetRasterProperties: "LEFT", "BOTTOM", "RIGHT", "TOP",
+#       "CELLSIZEX", "CELLSIZEY", "ROWCOUNT", "COLUMNCOUNT"
+#   reader.read_window(row, col, nrows, ncols, nodata_to_value) -
+#       numpy array of the window starting at the upper left row/col.
+#       Cells outside the raster or with no data are nodata_to_value.
+#   reader.read_numpy(x, y, ncols, nrows, nodata_to_value) - same
+#       arguments as arcpy's RasterToNumPyArray where x/y is in the
+#       lower left cell of the window
+#
+# raster_fingerprint(raster, backend) returns a hash that changes when
+# the raster changes. The steps use it to find out of date caches.
+#
+# Backends
+# "arcpy" - ArcGIS rasters through arcpy
+# "gdal" - any raster GDAL can read (GeoTIFF, ESRI grid, .flt, ...)
+# "numpy" - in memory numpy arrays added with register_array(). This
+#     is for running and benchmarking the sampling code without
+#     ArcGIS or raster files.
+# "memmap" - uncompressed GeoTIFF (striped or tiled, BigTIFF too),
+#     ENVI, or ESRI .flt rasters memory mapped with numpy.memmap.
+#     Windows inside the raster are views of the mapped file when no
+#     no data conversion is needed, so there is no copy and the OS
+#     page cache shares the cells between overlapping blocks, steps,
+#     and processes.
+
+# This script requires Python 2.6 or higher and numpy.
+
+########################################################################
+
+from __future__ import division, print_function
+import os
+import struct
+from hashlib import md5
+from math import floor, ceil
+import numpy
+
+# readers by (raster, backend)
+reader_dict = {}
+
+# arrays added with register_array() by name
+array_dict = {}
+
+def open_raster(raster, backend="arcpy"):
+    """Returns the reader for the raster. Readers are kept so the
+    raster is only opened once."""
+
+    key = (raster, backend)
+    if key not in reader_dict:
+        if backend == "arcpy":
+            reader_dict[key] = ArcpyRaster(raster)
+        elif backend == "gdal":
+            reader_dict[key] = GdalRaster(raster)
+        elif backend == "memmap":
+            reader_dict[key] = MemmapRaster(raster)
+        elif backend == "numpy":
+            if raster not in array_dict:
+                raise ValueError("{0} has not been added with register_array()".format(raster))
+            reader_dict[key] = array_dict[raster]
+        else:
+            raise ValueError("{0} is not a raster backend. Use arcpy, gdal, memmap, or numpy".format(backend))
+    return reader_dict[key]
+
+def register_array(name, array, x_min, y_max, x_cellsize, y_cellsize=None,
+                   nodata=None):
+    """Adds a numpy array as a raster that can be opened by name with
+    the numpy backend. x_min/y_max are the upper left corner."""
+
+    array_dict[name] = ArrayRaster(array, x_min, y_max, x_cellsize,
+                                   y_cellsize, nodata)
+    reader_dict.pop((name, "numpy"), None)
+    return array_dict[name]
+
+def raster_fingerprint(raster, backend="arcpy"):
+    """Returns a hex string that changes when the raster changes.
+    Built from the raster path, extent, cell size, and the size and
+    modification time of the raster files on disk. The cells are
+    never read from disk. For rasters that are not files (e.g. in a
+    geodatabase) the raster statistics are used, or the newest file
+    time in the geodatabase folder if there are no statistics.
+    Arrays added with register_array() are hashed in memory."""
+
+    reader = open_raster(raster, backend)
+    path = raster
+    if backend == "arcpy":
+        import arcpy
+        path = arcpy.Describe(raster).catalogPath
+
+    items = [path]
+    for prop in ["LEFT", "BOTTOM", "RIGHT", "TOP",
+                 "CELLSIZEX", "CELLSIZEY", "COLUMNCOUNT", "ROWCOUNT"]:
+        items.append(reader.get_property(prop))
+
+    if os.path.isfile(path):
+        items.append(os.path.getsize(path))
+        items.append(os.path.getmtime(path))
+        # checksum of the file header
+        with open(path, "rb") as f:
+            items.append(md5(f.read(65536)).hexdigest())
+    elif os.path.isdir(path):
+        # ESRI grid
+        for name in sorted(os.listdir(path)):
+            f = os.path.join(path, name)
+            items.append(name)
+            items.append(os.path.getsize(f))
+            items.append(os.path.getmtime(f))
+    elif backend == "numpy":
+        items.append(md5(numpy.ascontiguousarray(reader.array)).hexdigest())
+    else:
+        stats = []
+        if backend == "arcpy":
+            for prop in ["MINIMUM", "MAXIMUM", "MEAN", "STD"]:
+                try:
+                    stats.append(arcpy.GetRasterProperties_management(raster, prop).getOutput(0))
+                except:
+                    # statistics have not been calculated
+                    stats = []
+                    break
+        if stats:
+            items.extend(stats)
+        else:
+            # the folder on disk that holds the raster (e.g. the .gdb)
+            folder = os.path.dirname(path)
+            while folder and not os.path.isdir(folder) and os.path.dirname(folder) != folder:
+                folder = os.path.dirname(folder)
+            if os.path.isdir(folder):
+                items.append(max([os.path.getmtime(os.path.join(folder, name))
+                                  for name in os.listdir(folder)] +
+                                 [os.path.getmtime(folder)]))
+
+    return md5("|".join(str(i) for i in items).encode("utf-8")).hexdigest()
+
+def window_dtype(dtype, nodata_to_value):
+    """Returns the array data type that can hold the raster values
+    and nodata_to_value"""
+
+    if not numpy.issubdtype(dtype, numpy.integer) or nodata_to_value is None:
+        return dtype
+    if not float(nodata_to_value).is_integer():
+        return numpy.dtype(numpy.float64)
+    info = numpy.iinfo(dtype)
+    if info.min <= nodata_to_value <= info.max:
+        return dtype
+    # e.g. uint8 with -9999 is int16. uint64 with a
+    # negative value is float64.
+    return numpy.promote_types(dtype, numpy.min_scalar_type(int(nodata_to_value)))
+
+class RasterReader(object):
+    """Base class. Subclasses set the properties and implement
+    read_cells() which reads a window that is inside the raster."""
+
+    def __init__(self):
+        self.x_min = None
+        self.y_max = None
+        self.x_cellsize = None
+        self.y_cellsize = None
+        self.nrows = None
+        self.ncols = None
+        self.nodata = None
+        self.dtype = None
+
+    def get_property(self, name):
+        """Returns the raster property with the same names as arcpy's
+        GetRasterProperties_management"""
+
+        properties = {"LEFT": self.x_min,
+                      "TOP": self.y_max,
+                      "RIGHT": self.x_min + self.ncols * self.x_cellsize,
+                      "BOTTOM": self.y_max - self.nrows * self.y_cellsize,
+                      "CELLSIZEX": self.x_cellsize,
+                      "CELLSIZEY": self.y_cellsize,
+                      "ROWCOUNT": self.nrows,
+                      "COLUMNCOUNT": self.ncols}
+        return properties[name]
+
+    def read_cells(self, row, col, nrows, ncols):
+        raise NotImplementedError
+
+    def read_window(self, row, col, nrows, ncols, nodata_to_value=-9999):
+        """Returns the window of the raster as a (nrows, ncols) numpy
+        array. Cells outside the raster or with no data are
+        nodata_to_value."""
+
+        window = numpy.full((nrows, ncols), nodata_to_value,
+                            dtype=window_dtype(self.dtype, nodata_to_value))
+
+        # the part of the window inside the raster
+        row0 = max(row, 0)
+        col0 = max(col, 0)
+        row1 = min(row + nrows, self.nrows)
+        col1 = min(col + ncols, self.ncols)
+        if row0 >= row1 or col0 >= col1:
+            return window
+
+        cells = self.read_cells(row0, col0, row1 - row0, col1 - col0)
+        if self.nodata is not None and numpy.isnan(self.nodata):
+            cells = numpy.where(numpy.isnan(cells), nodata_to_value, cells)
+        elif self.nodata is not None:
+            cells = numpy.where(cells == self.nodata, nodata_to_value, cells)
+        window[row0 - row:row1 - row, col0 - col:col1 - col] = cells
+        return window
+
+    def read_numpy(self, x, y, ncols, nrows, nodata_to_value=-9999):
+        """Same as arcpy's RasterToNumPyArray. x/y is a coordinate in
+        the lower left cell of the window."""
+
+        col = int(floor((x - self.x_min) / self.x_cellsize))
+        row = int(floor((self.y_max - y) / self.y_cellsize)) - nrows + 1
+        return self.read_window(row, col, nrows, ncols, nodata_to_value)
+
+class ArrayRaster(RasterReader):
+    """Raster held in memory as a numpy array"""
+
+    def __init__(self, array, x_min, y_max, x_cellsize, y_cellsize=None,
+                 nodata=None):
+        RasterReader.__init__(self)
+        self.array = numpy.asarray(array)
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.x_cellsize = float(x_cellsize)
+        self.y_cellsize = float(y_cellsize or x_cellsize)
+        self.nrows, self.ncols = self.array.shape
+        self.nodata = nodata
+        self.dtype = self.array.dtype
+
+    def read_cells(self, row, col, nrows, ncols):
+        return self.array[row:row + nrows, col:col + ncols]
+
+class ArcpyRaster(RasterReader):
+    """ArcGIS raster read with arcpy"""
+
+    def __init__(self, raster):
+        import arcpy
+        RasterReader.__init__(self)
+        self.raster = raster
+        prop = lambda name: arcpy.GetRasterProperties_management(raster, name).getOutput(0)
+        self.x_min = float(prop("LEFT"))
+        self.y_max = float(prop("TOP"))
+        self.x_cellsize = float(prop("CELLSIZEX"))
+        self.y_cellsize = float(prop("CELLSIZEY"))
+        self.nrows = int(prop("ROWCOUNT"))
+        self.ncols = int(prop("COLUMNCOUNT"))
+
+    def read_numpy(self, x, y, ncols, nrows, nodata_to_value=-9999):
+        import arcpy
+        return arcpy.RasterToNumPyArray(self.raster, arcpy.Point(x, y),
+                                        ncols, nrows, nodata_to_value)
+
+    def read_window(self, row, col, nrows, ncols, nodata_to_value=-9999):
+        # center of the lower left cell
+        x = self.x_min + (col + 0.5) * self.x_cellsize
+        y = self.y_max - (row + nrows - 0.5) * self.y_cellsize
+        return self.read_numpy(x, y, ncols, nrows, nodata_to_value)
+
+class GdalRaster(RasterReader):
+    """Raster read with GDAL. Only the first band is read."""
+
+    def __init__(self, raster):
+        RasterReader.__init__(self)
+        self.raster = raster
+        self.dataset = None
+        band = self.get_band()
+        x_min, x_cellsize, x_rot, y_max, y_rot, y_cellsize = self.dataset.GetGeoTransform()
+        if x_rot != 0 or y_rot != 0:
+            raise ValueError("{0} is a rotated raster. Rotated rasters are not supported".format(raster))
+        self.x_min = x_min
+        self.y_max = y_max
+        self.x_cellsize = x_cellsize
+        self.y_cellsize = abs(y_cellsize)
+        self.nrows = self.dataset.RasterYSize
+        self.ncols = self.dataset.RasterXSize
+        self.nodata = band.GetNoDataValue()
+        self.dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+
+    def get_band(self):
+        if self.dataset is None:
+            from osgeo import gdal
+            self.dataset = gdal.Open(self.raster)
+            if self.dataset is None:
+                raise IOError("GDAL can not open {0}".format(self.raster))
+        return self.dataset.GetRasterBand(1)
+
+    def __getstate__(self):
+        # the GDAL dataset can not be sent to another process so it
+        # is opened again when first read
+        state = self.__dict__.copy()
+        state["dataset"] = None
+        return state
+
+    def read_cells(self, row, col, nrows, ncols):
+        return self.get_band().ReadAsArray(col, row, ncols, nrows)
+
+# TIFF tag numbers
+tiff_tags = {256: "ImageWidth", 257: "ImageLength", 258: "BitsPerSample",
+             259: "Compression", 273: "StripOffsets", 277: "SamplesPerPixel",
+             278: "RowsPerStrip", 279: "StripByteCounts",
+             284: "PlanarConfiguration", 322: "TileWidth", 323: "TileLength",
+             324: "TileOffsets", 325: "TileByteCounts", 339: "SampleFormat",
+             33550: "ModelPixelScale", 33922: "ModelTiepoint",
+             34264: "ModelTransformation", 34735: "GeoKeyDirectory",
+             42113: "GDAL_NODATA"}
+
+# struct format and size of the TIFF field types
+tiff_types = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4),
+              5: ("II", 8), 6: ("b", 1), 7: ("B", 1), 8: ("h", 2),
+              9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8),
+              16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8)}
+
+def read_tiff_tags(raster):
+    """Returns the byte order and a dictionary of the tags in the
+    first image of a TIFF or BigTIFF file. ASCII tags are strings and
+    the other tags are tuples."""
+
+    tags = {}
+    with open(raster, "rb") as f:
+        header = f.read(16)
+        if header[:2] == b"II":
+            byteorder = "<"
+        elif header[:2] == b"MM":
+            byteorder = ">"
+        else:
+            raise ValueError("{0} is not a TIFF file".format(raster))
+
+        version = struct.unpack(byteorder + "H", header[2:4])[0]
+        if version == 42:
+            ifd_offset = struct.unpack(byteorder + "I", header[4:8])[0]
+            count_format, value_format, value_size = "H", "I", 4
+        elif version == 43:
+            ifd_offset = struct.unpack(byteorder + "Q", header[8:16])[0]
+            count_format, value_format, value_size = "Q", "Q", 8
+        else:
+            raise ValueError("{0} is not a TIFF file".format(raster))
+
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_format)
+        nentries = struct.unpack(byteorder + count_format, f.read(count_size))[0]
+        entry_size = 4 + 2 * value_size
+        entries = f.read(nentries * entry_size)
+
+        for e in range(nentries):
+            entry = entries[e * entry_size:(e + 1) * entry_size]
+            tag, type = struct.unpack(byteorder + "HH", entry[:4])
+            if tag not in tiff_tags or type not in tiff_types:
+                continue
+            count = struct.unpack(byteorder + value_format, entry[4:4 + value_size])[0]
+            fmt, size = tiff_types[type]
+            if count * size <= value_size:
+                data = entry[4 + value_size:4 + value_size + count * size]
+            else:
+                f.seek(struct.unpack(byteorder + value_format, entry[4 + value_size:])[0])
+                data = f.read(count * size)
+
+            if type == 2:
+                tags[tiff_tags[tag]] = data.rstrip(b"\x00").decode("ascii")
+            else:
+                tags[tiff_tags[tag]] = struct.unpack(byteorder + fmt * count, data)
+
+    return byteorder, tags
+
+def read_header(header):
+    """Returns a dictionary of the key/value pairs in an ESRI .hdr or
+    ENVI .hdr file. Keys are lower case. ENVI values in {} can span
+    more than one line."""
+
+    items = {}
+    with open(header, "r") as f:
+        text = f.read()
+    if text.startswith("ENVI"):
+        text = text[4:]
+        while "=" in text:
+            key, text = text.split("=", 1)
+            text = text.lstrip()
+            if text.startswith("{"):
+                value, text = text[1:].split("}", 1)
+            else:
+                value, _, text = text.partition("\n")
+            items[" ".join(key.split()).lower()] = value.strip()
+    else:
+        for line in text.splitlines():
+            if line.strip():
+                key, value = line.split(None, 1)
+                items[key.lower()] = value.strip()
+    return items
+
+class MemmapRaster(RasterReader):
+    """Uncompressed GeoTIFF, ENVI, or ESRI .flt raster memory mapped
+    with numpy. Only the first band is read."""
+
+    # ENVI data type codes
+    envi_types = {1: "u1", 2: "i2", 3: "i4", 4: "f4", 5: "f8", 12: "u2",
+                  13: "u4", 14: "i8", 15: "u8"}
+
+    def __init__(self, raster):
+        RasterReader.__init__(self)
+        self.raster = raster
+        self.array = None
+        self.file_map = None
+        # the first band is one array in the file (offset, shape, band
+        # index) or stored in chunks (tiles or strips) at the offsets
+        self.offset = 0
+        self.shape = None
+        self.band = None
+        self.chunk_offsets = None
+        self.chunk_rows = None
+        self.chunk_cols = None
+        self.samples = 1
+
+        ext = os.path.splitext(raster)[1].lower()
+        if ext in [".tif", ".tiff"]:
+            self.read_tiff_header()
+        elif ext == ".flt":
+            self.read_flt_header()
+        else:
+            self.read_envi_header()
+
+    def read_flt_header(self):
+        """ESRI .flt grid with a .hdr file"""
+        self.data_file = self.raster
+        hdr = read_header(os.path.splitext(self.raster)[0] + ".hdr")
+        self.ncols = int(hdr["ncols"])
+        self.nrows = int(hdr["nrows"])
+        self.x_cellsize = self.y_cellsize = float(hdr["cellsize"])
+        if "xllcenter" in hdr:
+            self.x_min = float(hdr["xllcenter"]) - self.x_cellsize / 2
+            y_min = float(hdr["yllcenter"]) - self.y_cellsize / 2
+        else:
+            self.x_min = float(hdr["xllcorner"])
+            y_min = float(hdr["yllcorner"])
+        self.y_max = y_min + self.nrows * self.y_cellsize
+        if "nodata_value" in hdr:
+            self.nodata = float(hdr["nodata_value"])
+        if hdr.get("byteorder", "LSBFIRST").upper() == "MSBFIRST":
+            self.dtype = numpy.dtype(">f4")
+        else:
+            self.dtype = numpy.dtype("<f4")
+        self.shape = (self.nrows, self.ncols)
+
+    def read_envi_header(self):
+        """ENVI raster. The raster is either the data file or the .hdr"""
+        if self.raster.lower().endswith(".hdr"):
+            header = self.raster
+            base = os.path.splitext(self.raster)[0]
+            self.data_file = None
+            for ext in ["", ".dat", ".img", ".bin", ".raw", ".bsq", ".bil", ".bip"]:
+                if os.path.exists(base + ext):
+                    self.data_file = base + ext
+                    break
+            if self.data_file is None:
+                raise IOError("Can not find the data file for {0}".format(self.raster))
+        else:
+            self.data_file = self.raster
+            header = self.raster + ".hdr"
+            if not os.path.exists(header):
+                header = os.path.splitext(self.raster)[0] + ".hdr"
+
+        hdr = read_header(header)
+        if (hdr.get("file type", "ENVI Standard") != "ENVI Standard" or
+            int(hdr.get("compression", 0)) != 0):
+            raise ValueError("{0} is not an uncompressed ENVI Standard raster. Use the gdal backend".format(self.raster))
+        self.ncols = int(hdr["samples"])
+        self.nrows = int(hdr["lines"])
+        nbands = int(hdr.get("bands", 1))
+        self.offset = int(hdr.get("header offset", 0))
+        byteorder = ">" if int(hdr.get("byte order", 0)) == 1 else "<"
+        self.dtype = numpy.dtype(byteorder + self.envi_types[int(hdr["data type"])])
+        if "data ignore value" in hdr:
+            self.nodata = float(hdr["data ignore value"])
+
+        # map info = {projection, reference x, reference y, easting,
+        # northing, x size, y size, ...}. The reference pixel is 1 based.
+        map_info = [v.strip() for v in hdr["map info"].split(",")]
+        if any(v.lower().startswith("rotation") for v in map_info):
+            raise ValueError("{0} is a rotated raster. Rotated rasters are not supported".format(self.raster))
+        ref_x, ref_y, easting, northing, x_size, y_size = [float(v) for v in map_info[1:7]]
+        self.x_cellsize = x_size
+        self.y_cellsize = y_size
+        self.x_min = easting - (ref_x - 1) * x_size
+        self.y_max = northing + (ref_y - 1) * y_size
+
+        interleave = hdr.get("interleave", "bsq").lower()
+        if interleave == "bil":
+            self.shape = (self.nrows, nbands, self.ncols)
+            self.band = (slice(None), 0, slice(None))
+        elif interleave == "bip":
+            self.shape = (self.nrows, self.ncols, nbands)
+            self.band = (slice(None), slice(None), 0)
+        else:
+            self.shape = (self.nrows, self.ncols)
+
+    def read_tiff_header(self):
+        """Uncompressed GeoTIFF, striped or tiled"""
+        self.data_file = self.raster
+        byteorder, tags = read_tiff_tags(self.raster)
+        if tags.get("Compression", (1,))[0] != 1:
+            raise ValueError("{0} is compressed. Use the gdal backend".format(self.raster))
+        self.ncols = tags["ImageWidth"][0]
+        self.nrows = tags["ImageLength"][0]
+        bits = tags.get("BitsPerSample", (1,))[0]
+        sample_format = tags.get("SampleFormat", (1,))[0]
+        if bits % 8 != 0 or sample_format not in [1, 2, 3]:
+            raise ValueError("{0} has a data type that is not supported".format(self.raster))
+        self.dtype = numpy.dtype(byteorder + {1: "u", 2: "i", 3: "f"}[sample_format] + str(bits // 8))
+        if "GDAL_NODATA" in tags:
+            self.nodata = float(tags["GDAL_NODATA"])
+
+        # georeferencing
+        if "ModelTransformation" in tags:
+            m = tags["ModelTransformation"]
+            if m[1] != 0 or m[4] != 0:
+                raise ValueError("{0} is a rotated raster. Rotated rasters are not supported".format(self.raster))
+            self.x_cellsize, self.x_min = m[0], m[3]
+            self.y_cellsize, self.y_max = -m[5], m[7]
+        else:
+            scale = tags["ModelPixelScale"]
+            tiepoint = tags["ModelTiepoint"]
+            self.x_cellsize = scale[0]
+            self.y_cellsize = scale[1]
+            self.x_min = tiepoint[3] - tiepoint[0] * scale[0]
+            self.y_max = tiepoint[4] + tiepoint[1] * scale[1]
+        geokeys = tags.get("GeoKeyDirectory", ())
+        for k in range(4, len(geokeys) - 3, 4):
+            # GTRasterTypeGeoKey = RasterPixelIsPoint
+            if geokeys[k] == 1025 and geokeys[k + 3] == 2:
+                self.x_min = self.x_min - self.x_cellsize / 2
+                self.y_max = self.y_max + self.y_cellsize / 2
+
+        # pixels are interleaved when there is more than one sample
+        # and PlanarConfiguration is 1. Otherwise the first band is
+        # the first chunks.
+        self.samples = tags.get("SamplesPerPixel", (1,))[0]
+        if tags.get("PlanarConfiguration", (1,))[0] == 2:
+            self.samples = 1
+        if "TileOffsets" in tags:
+            self.chunk_rows = tags["TileLength"][0]
+            self.chunk_cols = tags["TileWidth"][0]
+            self.chunk_offsets = tags["TileOffsets"]
+        else:
+            self.chunk_rows = min(tags.get("RowsPerStrip", (self.nrows,))[0], self.nrows)
+            self.chunk_cols = self.ncols
+            self.chunk_offsets = tags["StripOffsets"]
+
+            # strips that follow each other in the file are one array
+            strip_nbytes = self.chunk_rows * self.ncols * self.samples * self.dtype.itemsize
+            nstrips = int(ceil(self.nrows / self.chunk_rows))
+            if all(self.chunk_offsets[i] == self.chunk_offsets[0] + i * strip_nbytes
+                   for i in range(nstrips)):
+                self.offset = self.chunk_offsets[0]
+                self.chunk_offsets = None
+                if self.samples > 1:
+                    self.shape = (self.nrows, self.ncols, self.samples)
+                    self.band = (slice(None), slice(None), 0)
+                else:
+                    self.shape = (self.nrows, self.ncols)
+
+    def get_array(self):
+        """Returns the memory mapped first band or None if the raster
+        is stored in chunks"""
+        if self.array is None and self.shape is not None:
+            array = numpy.memmap(self.data_file, dtype=self.dtype, mode="r",
+                                 offset=self.offset, shape=self.shape)
+            if self.band is not None:
+                array = array[self.band]
+            self.array = array
+        return self.array
+
+    def get_chunk(self, chunk_row, chunk_col):
+        """Returns a view of one tile or strip of the first band"""
+        if self.file_map is None:
+            self.file_map = numpy.memmap(self.data_file, dtype=numpy.uint8, mode="r")
+        chunks_across = int(ceil(self.ncols / self.chunk_cols))
+        offset = self.chunk_offsets[chunk_row * chunks_across + chunk_col]
+        nrows = self.chunk_rows
+        if self.chunk_cols == self.ncols:
+            # the last strip is not padded
+            nrows = min(nrows, self.nrows - chunk_row * self.chunk_rows)
+        chunk = numpy.ndarray((nrows, self.chunk_cols, self.samples), dtype=self.dtype,
+                              buffer=self.file_map, offset=offset)
+        return chunk[:, :, 0]
+
+    def __getstate__(self):
+        # the file is mapped again in the other process instead of
+        # sending the cells
+        state = self.__dict__.copy()
+        state["array"] = None
+        state["file_map"] = None
+        return state
+
+    def read_cells(self, row, col, nrows, ncols):
+        array = self.get_array()
+        if array is not None:
+            return array[row:row + nrows, col:col + ncols]
+
+        # copy the parts of each tile or strip in the window
+        cells = numpy.empty((nrows, ncols), dtype=self.dtype)
+        for chunk_row in range(row // self.chunk_rows, (row + nrows - 1) // self.chunk_rows + 1):
+            for chunk_col in range(col // self.chunk_cols, (col + ncols - 1) // self.chunk_cols + 1):
+                chunk = self.get_chunk(chunk_row, chunk_col)
+                r0 = max(row, chunk_row * self.chunk_rows)
+                r1 = min(row + nrows, (chunk_row + 1) * self.chunk_rows)
+                c0 = max(col, chunk_col * self.chunk_cols)
+                c1 = min(col + ncols, (chunk_col + 1) * self.chunk_cols)
+                cells[r0 - row:r1 - row, c0 - col:c1 - col] = \
+                    chunk[r0 - chunk_row * self.chunk_rows:r1 - chunk_row * self.chunk_rows,
+                          c0 - chunk_col * self.chunk_cols:c1 - chunk_col * self.chunk_cols]
+        return cells
+
+    def read_window(self, row, col, nrows, ncols, nodata_to_value=-9999):
+        """Same as RasterReader.read_window() but a window inside a
+        raster that is one array in the file is returned as a read
+        only view of the file when there is no conversion to do."""
+
+        if (row >= 0 and col >= 0 and row + nrows <= self.nrows and
+            col + ncols <= self.ncols and self.get_array() is not None and
+            (self.nodata is None or self.nodata == nodata_to_value) and
+            window_dtype(self.dtype, nodata_to_value) == self.dtype):
+            return self.array[row:row + nrows, col:col + ncols]
+        return RasterReader.read_window(self, row, col, nrows, ncols, nodata_to_value)
@@ -0,0 +1,599 @@
+########################################################################
+# TTools
+# Vector tables
+# Ryan Michie
+
+# Feature class and table access used by the TTools steps. Each table
+# has the same interface so the steps do not depend on where the data
+# is stored. Data moves a column at a time instead of a row at a time:
+#
+#   table.list_fields() - list of the field names
+#   table.field_info(name) - (name, type, precision, scale, length)
+#       where the type uses arcpy's AddField names: "SHORT", "LONG",
+#       "FLOAT", "DOUBLE", "TEXT"
+#   table.add_fields(fields) - fields is a list of field tuples in the
+#       same order as field_info. Only the name and type are required.
+#   table.read_columns(fields) - OrderedDict of a list of values for
+#       each field. Nulls are None.
+#   table.iter_rows(fields, where=None, order_by=None) - generator of
+#       row tuples for the rows that match the where dictionary (same
+#       as delete_rows), sorted by the order_by fields. Rows are read
+#       one at a time. In a geodatabase or GeoPackage the database 
+#       sorts the rows so the table is never held in memory. With the
+#       arcpy backend a shapefile or dbf table can not be sorted by 
+#       the cursor, so with order_by the rows of each where chunk 
+#       (the whole table when where is None) are read into memory 
+#       and sorted.
+#   table.write_columns(columns) - adds a row for each value in the
+#       OrderedDict of field lists
+#   table.update_columns(key, columns) - updates the rows where the
+#       key field matches a value in columns[key] with the values in
+#       the other columns
+#   table.delete_rows(where) - deletes the rows where every field in
+#       the where dictionary matches one of the listed values
+#
+# Point geometry is the "SHAPE@X" and "SHAPE@Y" fields, the same as
+# the arcpy.da cursor tokens.
+#
+# Backends
+# "arcpy" - feature classes and tables through arcpy.da
+# "ogr" - GeoPackage layers (path/to/file.gpkg/layer) or shapefiles
+#     through OGR
+# "memory" - in memory tables. Tables are created with create_table()
+#     or added with register_table(). This is for running and testing
+#     the steps without ArcGIS.
+
+# This script requires Python 2.6 or higher.
+
+########################################################################
+
+from __future__ import division, print_function
+import os
+from collections import OrderedDict
+import numpy
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+# tables created or added with register_table() for the memory backend
+table_dict = {}
+
+# arcpy names of the field types
+field_types = ["SHORT", "LONG", "FLOAT", "DOUBLE", "TEXT"]
+
+def open_table(table, backend="arcpy"):
+    """Returns the table object"""
+
+    if backend == "arcpy":
+        return ArcpyTable(table)
+    elif backend == "ogr":
+        return OgrTable(table)
+    elif backend == "memory":
+        if table not in table_dict:
+            raise ValueError("{0} does not exist in the memory backend".format(table))
+        return table_dict[table]
+    else:
+        raise ValueError("{0} is not a vector backend. Use arcpy, ogr, or memory".format(backend))
+
+def create_table(table, fields, geometry_type=None, spatial_reference=None,
+                 backend="arcpy"):
+    """Creates a new table with the fields and returns the table
+    object. geometry_type is None for a table without geometry or
+    "POINT" for a point feature class. spatial_reference is
+    the spatial_reference of another table from the same backend."""
+
+    if backend == "arcpy":
+        import arcpy
+        if geometry_type is None:
+            arcpy.CreateTable_management(os.path.dirname(table),
+                                         os.path.basename(table))
+        else:
+            arcpy.CreateFeatureclass_management(os.path.dirname(table),
+                                                os.path.basename(table),
+                                                geometry_type, "", "DISABLED",
+                                                "DISABLED", spatial_reference)
+        new_table = ArcpyTable(table)
+    elif backend == "ogr":
+        new_table = OgrTable(table)
+        new_table.create(geometry_type, spatial_reference)
+    elif backend == "memory":
+        new_table = MemoryTable(geometry_type, spatial_reference)
+        table_dict[table] = new_table
+    else:
+        raise ValueError("{0} is not a vector backend. Use arcpy, ogr, or memory".format(backend))
+
+    new_table.add_fields(fields)
+    return new_table
+
+def register_table(name, columns, fields=None, geometry_type=None,
+                   spatial_reference=None):
+    """Adds an in memory table that can be opened by name with the
+    memory backend. columns is an OrderedDict of a list of values for
+    each field. fields is a list of field tuples, fields not listed
+    are DOUBLE."""
+
+    if geometry_type is None and "SHAPE@X" in columns:
+        geometry_type = "POINT"
+    table = MemoryTable(geometry_type, spatial_reference)
+    fieldDict = dict((f[0], f) for f in fields or [])
+    table.add_fields([fieldDict.get(f, (f, "DOUBLE")) for f in columns.keys()
+                      if f not in ["SHAPE@X", "SHAPE@Y"]])
+    table.write_columns(columns)
+    table_dict[name] = table
+    return table
+
+def table_exists(table, backend="arcpy"):
+    """Returns True if the table exists"""
+
+    if backend == "arcpy":
+        import arcpy
+        return arcpy.Exists(table)
+    elif backend == "ogr":
+        return OgrTable(table).exists()
+    elif backend == "memory":
+        return table in table_dict
+    else:
+        raise ValueError("{0} is not a vector backend. Use arcpy, ogr, or memory".format(backend))
+
+def delete_table(table, backend="arcpy"):
+    """Deletes the table if it exists"""
+
+    if not table_exists(table, backend):
+        return
+    if backend == "arcpy":
+        import arcpy
+        arcpy.Delete_management(table)
+    elif backend == "ogr":
+        OgrTable(table).delete()
+    elif backend == "memory":
+        del table_dict[table]
+
+def field_tuple(field):
+    """Returns the field as a (name, type, precision, scale, length)
+    tuple"""
+
+    field = tuple(field) + (None,) * (5 - len(field))
+    if field[1] not in field_types:
+        raise ValueError("{0} is not a field type. Use {1}".format(field[1], ", ".join(field_types)))
+    return field
+
+def where_in(where, chunk_size=1000):
+    """Returns a list of SQL where clauses for the where dictionary.
+    The values of the first field are split into chunks so the
+    clauses do not get too long."""
+
+    def values_in(field, values):
+        return "{0} IN ({1})".format(field, ",".join("'{0}'".format(v) if isinstance(v, basestring)
+                                                     else str(v) for v in values))
+
+    fields = list(where.keys())
+    values = list(where[fields[0]])
+    clauses = []
+    for i in range(0, len(values), chunk_size):
+        clauses.append(" AND ".join([values_in(fields[0], values[i:i + chunk_size])] +
+                                    [values_in(f, where[f]) for f in fields[1:]]))
+    return clauses
+
+def where_chunks(where, order_by):
+    """Returns the where clauses for iter_rows. The values of the
+    first where field are sorted before they are split into chunks,
+    so when order_by starts with that field the rows from all the
+    chunks are in order."""
+
+    if where is None:
+        return [None]
+    fields = list(where.keys())
+    where = OrderedDict(where)
+    if order_by and order_by[0] == fields[0]:
+        where[fields[0]] = sorted(where[fields[0]])
+    return where_in(where)
+
+class VectorTable(object):
+    """Base class for the tables"""
+
+    def list_fields(self):
+        raise NotImplementedError
+
+    def field_info(self, name):
+        raise NotImplementedError
+
+    def add_fields(self, fields):
+        raise NotImplementedError
+
+    def read_columns(self, fields):
+        raise NotImplementedError
+
+    def iter_rows(self, fields, where=None, order_by=None):
+        raise NotImplementedError
+
+    def write_columns(self, columns):
+        raise NotImplementedError
+
+    def update_columns(self, key, columns):
+        raise NotImplementedError
+
+    def delete_rows(self, where):
+        raise NotImplementedError
+
+class MemoryTable(VectorTable):
+    """Table held in memory as lists of values"""
+
+    def __init__(self, geometry_type=None, spatial_reference=None):
+        self.geometry_type = geometry_type
+        self.spatial_reference = spatial_reference
+        self.fields = OrderedDict()
+        self.columns = OrderedDict()
+        if geometry_type is not None:
+            self.columns["SHAPE@X"] = []
+            self.columns["SHAPE@Y"] = []
+
+    def list_fields(self):
+        return list(self.fields.keys())
+
+    def field_info(self, name):
+        return self.fields[name]
+
+    def add_fields(self, fields):
+        nrows = self.count()
+        for field in fields:
+            field = field_tuple(field)
+            if field[0] not in self.fields:
+                self.fields[field[0]] = field
+                self.columns[field[0]] = [None] * nrows
+
+    def count(self):
+        if len(self.columns) == 0:
+            return 0
+        return len(list(self.columns.values())[0])
+
+    def read_columns(self, fields):
+        return OrderedDict((f, list(self.columns[f])) for f in fields)
+
+    def iter_rows(self, fields, where=None, order_by=None):
+        rows = range(self.count())
+        if where is not None:
+            where = dict((f, set(values)) for f, values in where.items())
+            rows = [r for r in rows if
+                    all(self.columns[f][r] in values for f, values in where.items())]
+        if order_by:
+            rows = sorted(rows, key=lambda r: [self.columns[f][r] for f in order_by])
+        values = [self.columns[f] for f in fields]
+        for r in rows:
+            yield tuple(v[r] for v in values)
+
+    def write_columns(self, columns):
+        n = len(list(columns.values())[0])
+        for f, values in self.columns.items():
+            if f in columns:
+                values.extend(columns[f])
+            else:
+                values.extend([None] * n)
+
+    def update_columns(self, key, columns):
+        rowIndex = dict((k, i) for i, k in enumerate(columns[key]))
+        fields = [f for f in columns.keys() if f != key]
+        for r, k in enumerate(self.columns[key]):
+            i = rowIndex.get(k)
+            if i is not None:
+                for f in fields:
+                    self.columns[f][r] = columns[f][i]
+
+    def delete_rows(self, where):
+        where = dict((f, set(values)) for f, values in where.items())
+        keep = [r for r in range(self.count()) if not
+                all(self.columns[f][r] in values for f, values in where.items())]
+        for f in self.columns.keys():
+            self.columns[f] = [self.columns[f][r] for r in keep]
+
+class ArcpyTable(VectorTable):
+    """Feature class or table read and written with arcpy.da"""
+
+    # arcpy.ListFields types to the AddField types
+    type_names = {"SmallInteger": "SHORT", "Integer": "LONG",
+                  "Single": "FLOAT", "Double": "DOUBLE", "String": "TEXT"}
+
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def spatial_reference(self):
+        import arcpy
+        return arcpy.Describe(self.table).spatialReference
+
+    def list_fields(self):
+        import arcpy
+        return [f.name for f in arcpy.ListFields(self.table)]
+
+    def field_info(self, name):
+        import arcpy
+        f = arcpy.ListFields(self.table, name)[0]
+        return (f.name, self.type_names.get(f.type, f.type), f.precision,
+                f.scale, f.length)
+
+    def add_fields(self, fields):
+        import arcpy
+        for field in fields:
+            name, type, precision, scale, length = field_tuple(field)
+            arcpy.AddField_management(self.table, name, type,
+                                      "" if precision is None else precision,
+                                      "" if scale is None else scale,
+                                      "" if length is None else length,
+                                      "", "NULLABLE", "NON_REQUIRED")
+
+    # value read for a null in each numeric field type
+    null_values = {"SmallInteger": numpy.iinfo(numpy.int16).min,
+                   "Integer": numpy.iinfo(numpy.int32).min,
+                   "Single": numpy.nan, "Double": numpy.nan}
+
+    def read_columns(self, fields):
+        import arcpy
+        # numeric fields and the point geometry are read in one call
+        # into a numpy array. Other fields use a cursor.
+        types = dict((f.name.upper(), f.type) for f in arcpy.ListFields(self.table))
+        null_value = dict((f, self.null_values[types[f.upper()]]) for f in fields
+                          if types.get(f.upper()) in self.null_values)
+        array_fields = [f for f in fields if f in null_value or f in ["SHAPE@X", "SHAPE@Y"]]
+        cursor_fields = [f for f in fields if f not in array_fields]
+
+        columns = OrderedDict((f, None) for f in fields)
+        if array_fields:
+            if "SHAPE@X" in array_fields or "SHAPE@Y" in array_fields:
+                array = arcpy.da.FeatureClassToNumPyArray(self.table, array_fields,
+                                                          null_value=null_value)
+            else:
+                array = arcpy.da.TableToNumPyArray(self.table, array_fields,
+                                                   null_value=null_value)
+            for f in array_fields:
+                values = array[f].tolist()
+                if f in null_value:
+                    if numpy.isnan(null_value[f]):
+                        nulls = numpy.isnan(array[f])
+                    else:
+                        nulls = array[f] == null_value[f]
+                    for i in numpy.flatnonzero(nulls):
+                        values[i] = None
+                columns[f] = values
+        if cursor_fields:
+            with arcpy.da.SearchCursor(self.table, cursor_fields) as cursor:
+                values = list(zip(*cursor)) or [()] * len(cursor_fields)
+            for f, v in zip(cursor_fields, values):
+                columns[f] = list(v)
+        return columns
+
+    def iter_rows(self, fields, where=None, order_by=None):
+        import arcpy
+        # ORDER BY only works in a database. Tables in a folder
+        # (shapefiles and dbf tables) are sorted here, which holds 
+        # the rows of the where chunk in memory.
+        in_database = arcpy.Describe(os.path.dirname(arcpy.Describe(self.table).catalogPath)).dataType != "Folder"
+        sql_clause = (None, None)
+        if order_by and in_database:
+            sql_clause = (None, "ORDER BY " + ", ".join(order_by))
+        for whereclause in where_chunks(where, order_by):
+            with arcpy.da.SearchCursor(self.table, fields, whereclause,
+                                       sql_clause=sql_clause) as cursor:
+                if order_by and not in_database:
+                    index = [fields.index(f) for f in order_by]
+                    cursor = sorted(cursor, key=lambda row: [row[i] for i in index])
+                for row in cursor:
+                    yield row
+
+    def write_columns(self, columns):
+        import arcpy
+        with arcpy.da.InsertCursor(self.table, list(columns.keys())) as cursor:
+            for row in zip(*columns.values()):
+                cursor.insertRow(row)
+
+    def update_columns(self, key, columns):
+        import arcpy
+        rowIndex = dict((k, i) for i, k in enumerate(columns[key]))
+        fields = [f for f in columns.keys() if f != key]
+        values = [columns[f] for f in fields]
+        for whereclause in where_in({key: columns[key]}):
+            with arcpy.da.UpdateCursor(self.table, [key] + fields, whereclause) as cursor:
+                for row in cursor:
+                    i = rowIndex[row[0]]
+                    cursor.updateRow([row[0]] + [v[i] for v in values])
+
+    def delete_rows(self, where):
+        import arcpy
+        for whereclause in where_in(where):
+            with arcpy.da.UpdateCursor(self.table, list(where.keys())[:1], whereclause) as cursor:
+                for row in cursor:
+                    cursor.deleteRow()
+
+class OgrTable(VectorTable):
+    """GeoPackage layer or shapefile read and written with OGR. The
+    table path is the GeoPackage path and the layer name, the same as
+    a file geodatabase feature class path."""
+
+    # OGR field type and subtype for each field type
+    ogr_types = {"SHORT": ("OFTInteger", "OFSTInt16"),
+                 "LONG": ("OFTInteger", "OFSTNone"),
+                 "FLOAT": ("OFTReal", "OFSTFloat32"),
+                 "DOUBLE": ("OFTReal", "OFSTNone"),
+                 "TEXT": ("OFTString", "OFSTNone")}
+
+    def __init__(self, table):
+        self.table = table
+        if table.lower().endswith((".shp", ".dbf")):
+            self.source = table
+            self.layer_name = os.path.splitext(os.path.basename(table))[0]
+        else:
+            self.source = os.path.dirname(table)
+            self.layer_name = os.path.basename(table)
+        self.dataset = None
+
+    def get_dataset(self):
+        if self.dataset is None:
+            from osgeo import ogr
+            self.dataset = ogr.Open(self.source, 1)
+        return self.dataset
+
+    def get_layer(self):
+        layer = None
+        if self.get_dataset() is not None:
+            layer = self.dataset.GetLayerByName(self.layer_name)
+        if layer is None:
+            raise IOError("OGR can not open {0}".format(self.table))
+        return layer
+
+    def exists(self):
+        if not os.path.exists(self.source) or self.get_dataset() is None:
+            return False
+        return self.dataset.GetLayerByName(self.layer_name) is not None
+
+    def create(self, geometry_type, spatial_reference):
+        from osgeo import ogr
+        if self.get_dataset() is None:
+            if self.source.lower().endswith((".shp", ".dbf")):
+                driver = ogr.GetDriverByName("ESRI Shapefile")
+            else:
+                driver = ogr.GetDriverByName("GPKG")
+            self.dataset = driver.CreateDataSource(self.source)
+        if geometry_type is None:
+            geom_type = ogr.wkbNone
+        else:
+            geom_type = getattr(ogr, "wkb" + geometry_type.title())
+        self.dataset.CreateLayer(self.layer_name, spatial_reference, geom_type)
+
+    def delete(self):
+        self.get_dataset().DeleteLayer(self.layer_name)
+
+    @property
+    def spatial_reference(self):
+        return self.get_layer().GetSpatialRef()
+
+    def list_fields(self):
+        defn = self.get_layer().GetLayerDefn()
+        return [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+    def field_info(self, name):
+        from osgeo import ogr
+        defn = self.get_layer().GetLayerDefn()
+        fd = defn.GetFieldDefn(defn.GetFieldIndex(name))
+        type = "TEXT"
+        for field_type, (ogr_type, ogr_subtype) in self.ogr_types.items():
+            if (fd.GetType() == getattr(ogr, ogr_type) and
+                fd.GetSubType() == getattr(ogr, ogr_subtype)):
+                type = field_type
+        if fd.GetType() == ogr.OFTInteger64:
+            type = "LONG"
+        return (name, type, fd.GetWidth(), fd.GetPrecision(), fd.GetWidth())
+
+    def add_fields(self, fields):
+        from osgeo import ogr
+        layer = self.get_layer()
+        for field in fields:
+            name, type, precision, scale, length = field_tuple(field)
+            ogr_type, ogr_subtype = self.ogr_types[type]
+            fd = ogr.FieldDefn(name, getattr(ogr, ogr_type))
+            fd.SetSubType(getattr(ogr, ogr_subtype))
+            if type == "TEXT" and length:
+                fd.SetWidth(length)
+            layer.CreateField(fd)
+
+    def read_columns(self, fields):
+        layer = self.get_layer()
+        defn = layer.GetLayerDefn()
+        index = [defn.GetFieldIndex(f) for f in fields]
+        columns = OrderedDict((f, []) for f in fields)
+        values = list(columns.values())
+        layer.ResetReading()
+        for feature in layer:
+            for f, i in enumerate(index):
+                if fields[f] == "SHAPE@X":
+                    values[f].append(feature.GetGeometryRef().GetX())
+                elif fields[f] == "SHAPE@Y":
+                    values[f].append(feature.GetGeometryRef().GetY())
+                elif feature.IsFieldNull(i):
+                    values[f].append(None)
+                else:
+                    values[f].append(feature.GetField(i))
+        return columns
+
+    def iter_rows(self, fields, where=None, order_by=None):
+        layer = self.get_layer()
+        columns = [f for f in fields if f not in ["SHAPE@X", "SHAPE@Y"]]
+        if len(columns) < len(fields) and layer.GetGeometryColumn():
+            # GeoPackage SQL only returns the geometry when it is selected
+            columns.append(layer.GetGeometryColumn())
+        for whereclause in where_chunks(where, order_by):
+            sql = "SELECT {0} FROM \"{1}\"".format(", ".join(columns) or "*", self.layer_name)
+            if whereclause is not None:
+                sql += " WHERE " + whereclause
+            if order_by:
+                sql += " ORDER BY " + ", ".join(order_by)
+            result = self.dataset.ExecuteSQL(sql)
+            try:
+                for feature in result:
+                    row = []
+                    for f in fields:
+                        if f == "SHAPE@X":
+                            row.append(feature.GetGeometryRef().GetX())
+                        elif f == "SHAPE@Y":
+                            row.append(feature.GetGeometryRef().GetY())
+                        elif feature.IsFieldNull(f):
+                            row.append(None)
+                        else:
+                            row.append(feature.GetField(f))
+                    yield tuple(row)
+            finally:
+                self.dataset.ReleaseResultSet(result)
+
+    def set_fields(self, feature, fields, row):
+        """Sets the feature fields and point geometry to the row values"""
+        from osgeo import ogr
+        for f, value in zip(fields, row):
+            if f in ["SHAPE@X", "SHAPE@Y"]:
+                continue
+            if value is None:
+                feature.SetFieldNull(f)
+            else:
+                feature.SetField(f, value)
+        if "SHAPE@X" in fields:
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(row[fields.index("SHAPE@X")],
+                              row[fields.index("SHAPE@Y")])
+            feature.SetGeometry(point)
+
+    def write_columns(self, columns):
+        from osgeo import ogr
+        layer = self.get_layer()
+        defn = layer.GetLayerDefn()
+        fields = list(columns.keys())
+        layer.StartTransaction()
+        for row in zip(*columns.values()):
+            feature = ogr.Feature(defn)
+            self.set_fields(feature, fields, row)
+            layer.CreateFeature(feature)
+        layer.CommitTransaction()
+
+    def update_columns(self, key, columns):
+        layer = self.get_layer()
+        rowIndex = dict((k, i) for i, k in enumerate(columns[key]))
+        fields = [f for f in columns.keys() if f != key]
+        values = [columns[f] for f in fields]
+        layer.StartTransaction()
+        for whereclause in where_in({key: columns[key]}):
+            layer.SetAttributeFilter(whereclause)
+            features = [feature for feature in layer]
+            for feature in features:
+                i = rowIndex[feature.GetField(key)]
+                self.set_fields(feature, fields, [v[i] for v in values])
+                layer.SetFeature(feature)
+        layer.SetAttributeFilter(None)
+        layer.CommitTransaction()
+
+    def delete_rows(self, where):
+        layer = self.get_layer()
+        layer.StartTransaction()
+        for whereclause in where_in(where):
+            layer.SetAttributeFilter(whereclause)
+            fids = [feature.GetFID() for feature in layer]
+            for fid in fids:
+                layer.DeleteFeature(fid)
+        layer.SetAttributeFilter(None)
+        layer.CommitTransaction()